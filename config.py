@@ -21,7 +21,38 @@ SERIAL_LOG_NAME = "serial.log"
 AFT_LOG_NAME = "aft.log"
 NFS_FOLDER = "/home/tester/"
 DEVICE_BLACKLIST="/etc/aft/blacklist"
+DEVICE_BLACKLIST_DB = "/var/lib/aft/blacklist.db"
 KNOWN_GOOD_IMAGE_FOLDER = "/home/tester/good_test_images"
+BROKER_SOCKET = "/var/lock/aft_broker"
+WORKER_SOCKET = "/var/lock/aft_worker"
+# Group whose members may submit jobs to the worker, in addition to its user.
+# Empty for the primary group of the worker user.
+WORKER_GROUP = ""
+CONFIG_CACHE_FOLDER = "/etc/aft/cache"
+STATE_DATABASE = "/var/lib/aft/state.db"
+SELECTION_POLICY = "topology"
+RESERVATION_PRIORITY = "nightly"
+FEDERATION_COORDINATOR = ""
+FEDERATION_PORT = 7531
+# Address the coordinator listens on
+FEDERATION_BIND_ADDRESS = "127.0.0.1"
+# Comma separated names of the hosts allowed to join the federation. Jobs are
+# only routed to these hosts.
+FEDERATION_HOSTS = ""
+FEDERATION_HOST_NAME = ""
+FEDERATION_SSH_USER = "tester"
+FEDERATION_PUBLISH_INTERVAL = 10
+SSH_CONTROL_PERSIST = 600
+DUT_PAYLOAD_CACHE = "/var/cache/aft/payloads"
+# Size limit of the payload cache on a device in megabytes. The least recently
+# used payloads are removed beyond it.
+DUT_PAYLOAD_CACHE_SIZE = 512
+# How PC-like devices get the image to flash: "nfs" (read from NFS_FOLDER
+# exported over nfs) or "stream" (streamed over ssh, see
+# aft.tools.image_stream)
+IMAGE_DELIVERY = "nfs"
+# Maximum rate of a streamed image in bytes per second, 0 for no limit
+IMAGE_STREAM_BANDWIDTH = 0
 
 import sys
 import ConfigParser
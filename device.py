@@ -20,12 +20,15 @@ Class representing a DUT.
 
 import threading
 import abc
+import subprocess32
 
 from time import sleep
 from threading import current_thread
 
 from aft.tools.thread_handler import Thread_handler as thread_handler
 import aft.tools.serialrecorder as serialrecorder
+import aft.tools.ssh as ssh
+import aft.tools.payload_cache as payload_cache
 import aft.errors as errors
 from aft.logger import Logger as logger
 
@@ -37,6 +40,11 @@ class Device(object):
 
     _POWER_CYCLE_DELAY = 10
 
+    # Path of the marker file identifying the flashed image on the DUT, or
+    # None if the device does not support skipping reflashing. See
+    # aft.tools.image_state
+    image_marker_path = None
+
     def __init__(self, device_descriptor, channel):
         self.name = device_descriptor["name"]
         self.model = device_descriptor["model"]
@@ -44,11 +52,19 @@ class Device(object):
         self.test_plan = device_descriptor["test_plan"]
         self.parameters = device_descriptor
         self.channel = channel
+        # Hash of the image being flashed, for the marker file
+        self.image_hash = None
+        # Ip address of the device in its current mode, see get_session_ip
+        self._session_ip = None
 
     @abc.abstractmethod
     def write_image(self, file_name):
         """
         Writes the specified image to the device.
+
+        Implementations are decorated with
+        aft.tools.image_state.skips_reflash, which adds the keyword argument
+        force for flashing even if the device already holds the image.
         """
 
     def record_serial(self):
@@ -117,6 +133,22 @@ class Device(object):
         pass
 
 
+    def verify_image_marker(self, image_hash):
+        """
+        Boot the image on the device and check that its marker file contains
+        the given image hash.
+
+        Device classes that set image_marker_path must implement this
+
+        Args:
+            image_hash (str): The expected image hash
+
+        Returns:
+            True if the device holds the image, False otherwise
+        """
+        raise errors.AFTNotImplementedError(
+            "Image marker verification not implemented")
+
     def check_poweron(self):
         """
         Checks that device has been powered on
@@ -164,12 +196,83 @@ class Device(object):
         Open the associated cutter channel.
         """
         self.channel.disconnect()
+        self._end_session()
 
     def attach(self):
         """
         Close the associated cutter channel.
         """
         self.channel.connect()
+        self._end_session()
+
+    def get_connection_ip(self):
+        """
+        Return the ip address last used for connecting to the device, without
+        looking it up, so that pooled ssh connections are closed when the
+        device is power cycled. By default this is the session ip address.
+
+        Returns:
+            (str or None): The ip address, or None if not known
+        """
+        return self._session_ip
+
+    def get_session_ip(self):
+        """
+        Return the ip address for connecting to the device. The address is
+        looked up with get_ip only once per session: a session starts when
+        the device enters a mode, and ends when the device is detached or
+        attached, or a connection to it fails.
+
+        Returns:
+            (str or None): The ip address, or None if it could not be found
+        """
+        if not self._session_ip:
+            self._session_ip = self.get_ip()
+        return self._session_ip
+
+    def _start_session(self, ip_address):
+        """
+        Start a session with the ip address the device has in its new mode
+
+        Args:
+            ip_address (str): The ip address
+
+        Returns:
+            None
+        """
+        self._session_ip = ip_address
+
+    def _end_session(self):
+        """
+        Forget the session ip address, and close the pooled ssh connections
+        to the device, as they do not survive a power cycle.
+        """
+        ip_address = self.get_connection_ip()
+        if ip_address:
+            ssh.close_connections(ip_address)
+        self._session_ip = None
+
+    def _call_in_session(self, function, *args, **kwargs):
+        """
+        Call an ssh function with the session ip address as its first
+        argument. The session ends if ssh fails to connect.
+
+        Args:
+            function (function): The function, such as ssh.remote_execute
+            *args: The remaining positional arguments of the function
+            **kwargs: The keyword arguments of the function
+
+        Returns:
+            The return value of the function
+        """
+        try:
+            return function(self.get_session_ip(), *args, **kwargs)
+        except subprocess32.CalledProcessError as err:
+            # ssh returns 255 on its own errors, such as a refused connection
+            if err.returncode == 255:
+                logger.info("Connection to the device failed, ending session")
+                self._end_session()
+            raise
 
     def execute(self, command, timeout, user="root", verbose=False):
         """
@@ -183,6 +286,20 @@ class Device(object):
         """
         pass
 
+    def push_payload(self, source, destination, user="root"):
+        """
+        Deploys a file or a directory to a directory on the device, unless
+        the device already holds the same content. See
+        aft.tools.payload_cache.
+
+        Args:
+            source (str): The local file or directory
+            destination (str): The remote directory
+            user (str): The user who executes the commands
+        """
+        self._call_in_session(payload_cache.push, source, destination,
+                              user=user)
+
     @abc.abstractmethod
     def get_ip(self):
         """
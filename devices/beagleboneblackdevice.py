@@ -32,6 +32,8 @@ import aft.config as config
 import aft.errors as errors
 import aft.tools.ssh as ssh
 import aft.devices.common as common
+import aft.tools.device_statistics as device_statistics
+import aft.tools.image_state as image_state
 
 def serial_write(stream, text, sleep_time):
     """
@@ -68,6 +70,9 @@ class BeagleBoneBlackDevice(Device):
         _ROOTFS_WRITING_TIMEOUT (integer):
             Rootfs writing timeout. Used when writing the rootfs contents (duh)
 
+        _ROOTFS_PROGRESS_INTERVAL (integer):
+            How often, in extracted files, rootfs writing progress is logged
+
         _SERVICE_MODE_RETRY_ATTEMPTS (integer):
             How many times the device attempts to enter the service mode before
             giving up.
@@ -125,8 +130,12 @@ class BeagleBoneBlackDevice(Device):
     _BOOT_TIMEOUT = 240
     _POLLING_INTERVAL = 10
     _ROOTFS_WRITING_TIMEOUT = 1800
+    _ROOTFS_PROGRESS_INTERVAL = 1000
+    # Timeout per step of a batch of ssh commands, such as mkfs
+    _SSH_STEP_TIMEOUT = 60
     _SERVICE_MODE_RETRY_ATTEMPTS = 4
     _TEST_MODE_RETRY_ATTEMPTS = 4
+    image_marker_path = "/etc/aft_image"
 
 
     def __init__(self, parameters, channel):
@@ -201,6 +210,8 @@ class BeagleBoneBlackDevice(Device):
         self._enter_test_mode()
         return test_case.run(self)
 
+    @image_state.skips_reflash
+    @device_statistics.records_flash
     def write_image(self, root_tarball):
         """
         Writes the new image into the device.
@@ -217,6 +228,30 @@ class BeagleBoneBlackDevice(Device):
         self._flash_image()
         self._remove_temp_dir()
 
+    def verify_image_marker(self, image_hash):
+        """
+        Boot to test mode and check the image marker file.
+
+        Args:
+            image_hash (str): The expected image hash
+
+        Returns:
+            True if the device holds the image, False otherwise
+        """
+        try:
+            self._enter_test_mode()
+            marker = ssh.remote_execute(
+                self.dev_ip,
+                ["cat", self.image_marker_path],
+                ignore_return_codes=[1])
+        except (errors.AFTDeviceError,
+                subprocess32.CalledProcessError,
+                subprocess32.TimeoutExpired) as err:
+            logger.warning("Image marker verification failed: " + str(err))
+            return False
+
+        return marker.strip() == image_hash
+
     def _prepare_support_fs(self, root_tarball):
         """
         Create directories and copy all the necessary files to the support fs
@@ -369,7 +404,8 @@ class BeagleBoneBlackDevice(Device):
             serial_write(stream, "bootz 0x81000000 - 0x80000000", 1)
             stream.close()
 
-            self.dev_ip = self._wait_for_responsive_ip()
+            self.dev_ip = self._wait_for_responsive_ip(
+                self.parameters["service_mode"])
 
             if (self.dev_ip and
                     self._verify_mode(self.parameters["service_mode"])):
@@ -396,7 +432,8 @@ class BeagleBoneBlackDevice(Device):
         logger.info("Entering test mode")
         for _ in range(self._TEST_MODE_RETRY_ATTEMPTS):
             self._power_cycle()
-            self.dev_ip = self._wait_for_responsive_ip()
+            self.dev_ip = self._wait_for_responsive_ip(
+                self.parameters["test_mode"])
 
 
             if self.dev_ip and self._verify_mode(self.parameters["test_mode"]):
@@ -457,34 +494,38 @@ class BeagleBoneBlackDevice(Device):
 
         logger.info(
             "Creating DOS filesystem on " + self.parameters["boot_partition"])
-
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "mkfs.fat",
-                self.parameters["boot_partition"]])
-
-
-        self._mount(self.parameters["boot_partition"])
-
+        logger.info("Mounting " + self.parameters["boot_partition"] + " to " +
+                    self.mount_dir)
         logger.info("Writing new boot partition")
-        self._write_boot_partition_files()
 
-        self._unmount_over_ssh()
+        steps = [
+            ["mkfs.fat", self.parameters["boot_partition"]],
+            ["mount", self.parameters["boot_partition"], self.mount_dir]]
+        steps += self._get_boot_partition_file_steps()
+        steps.append(["umount", self.mount_dir])
+
+        try:
+            ssh.remote_execute_batch(
+                self.dev_ip,
+                steps,
+                timeout=self._SSH_STEP_TIMEOUT * len(steps))
+        except subprocess32.CalledProcessError as err:
+            common.log_subprocess32_error_and_abort(err)
 
 
-    def _write_boot_partition_files(self):
+    def _get_boot_partition_file_steps(self):
         """
-        Copy boot files to boot partition
+        Return the commands that copy the boot files to the mounted boot
+        partition
 
         Return:
-            None
+            (list(list(str))): The commands, for ssh.remote_execute_batch
         """
         mlo_target = os.path.join(self.mount_dir, "MLO")
-        self._copy_file_over_ssh(self.mlo_file, mlo_target)
-
         u_boot_target = os.path.join(self.mount_dir, "u-boot.img")
-        self._copy_file_over_ssh(self.u_boot_file, u_boot_target)
+        return [
+            ["cp", self.mlo_file, mlo_target],
+            ["cp", self.u_boot_file, u_boot_target]]
 
     def _write_root_partition(self):
         """
@@ -511,6 +552,7 @@ class BeagleBoneBlackDevice(Device):
         logger.info("Writing new root partition")
         self._write_root_partition_files()
         self._add_ssh_key()
+        self._write_image_marker()
         self._unmount_over_ssh()
 
     def _write_root_partition_files(self):
@@ -520,9 +562,17 @@ class BeagleBoneBlackDevice(Device):
         Returns:
             None
         """
+        extracted = [0]
+
+        def report_progress(line):
+            # tar -v prints a line per extracted file
+            extracted[0] += 1
+            if extracted[0] % self._ROOTFS_PROGRESS_INTERVAL == 0:
+                logger.info("Extracted " + str(extracted[0]) + " files")
+
         try:
             # this can be slow, so give it plenty of time before timing out
-            ssh.remote_execute(
+            ssh.remote_execute_stream(
                 self.dev_ip,
                 [
                     "tar",
@@ -532,7 +582,9 @@ class BeagleBoneBlackDevice(Device):
                     self.root_tarball,
                     "-C",
                     self.mount_dir],
+                report_progress,
                 timeout=self._ROOTFS_WRITING_TIMEOUT)
+            logger.info("Extracted " + str(extracted[0]) + " files")
 
         except subprocess32.CalledProcessError as err:
             common.log_subprocess32_error_and_abort(err)
@@ -562,19 +614,49 @@ class BeagleBoneBlackDevice(Device):
         ssh_directory = os.path.join(self.mount_dir, "home", "root", ".ssh")
         ssh_target = os.path.join(ssh_directory, "authorized_keys")
 
-        self._make_directory_over_ssh(ssh_directory)
-        self._copy_file_over_ssh(self.ssh_file, ssh_target)
+        steps = [
+            ["mkdir", "-p", ssh_directory],
+            ["cp", self.ssh_file, ssh_target],
+            ["chown", "0:0", ssh_directory],
+            ["chown", "0:0", ssh_target],
+            ["chmod", "700", ssh_directory],
+            ["chmod", "600", ssh_target]]
 
-        self._change_ownership_over_ssh(ssh_directory, 0, 0)
-        self._change_ownership_over_ssh(ssh_target, 0, 0)
+        try:
+            ssh.remote_execute_batch(
+                self.dev_ip,
+                steps,
+                timeout=self._SSH_STEP_TIMEOUT * len(steps))
+        except subprocess32.CalledProcessError as err:
+            common.log_subprocess32_error_and_abort(err)
 
-        self._change_permissions_over_ssh(ssh_directory, "700")
-        self._change_permissions_over_ssh(ssh_target, "600")
+    def _write_image_marker(self):
+        """
+        Write the hash of the image being flashed into the marker file on the
+        mounted root partition.
 
-    def _wait_for_responsive_ip(self):
+        Returns:
+            None
+        """
+        if not self.image_hash:
+            return
+
+        logger.info("Writing image marker.")
+        ssh.remote_execute(
+            self.dev_ip,
+            [
+                "echo",
+                self.image_hash,
+                ">",
+                os.path.join(self.mount_dir, self.image_marker_path.lstrip("/"))])
+
+    def _wait_for_responsive_ip(self, mode_name):
         """
         Wait until the testing harness detects the Beaglebone after boot
 
+        Args:
+            mode_name (str): Name of the mode being booted into
+
         Returns:
             Device ip address, or None if no active ip address was found
         """
@@ -583,7 +665,8 @@ class BeagleBoneBlackDevice(Device):
             self.dev_id,
             self.parameters["leases_file_name"],
             self._BOOT_TIMEOUT,
-            self._POLLING_INTERVAL)
+            self._POLLING_INTERVAL,
+            boot_profile=self.model + " " + mode_name)
 
 
     def _remove_temp_dir(self):
@@ -595,6 +678,15 @@ class BeagleBoneBlackDevice(Device):
                 self.working_directory[1:]))
 
 
+    def get_connection_ip(self):
+        """
+        Return the ip address last used for connecting to the device
+
+        Returns:
+            (str or None): The ip address, or None if not known
+        """
+        return self.dev_ip
+
     def get_ip(self):
         """
         Get device ip
@@ -650,23 +742,6 @@ class BeagleBoneBlackDevice(Device):
     # NOTE: SSH related methods might be better suited for the ssh.py module
     # Consider moving these
 
-    def _make_directory_over_ssh(self, directory):
-        """
-        Make directory safely over ssh or abort on failure
-
-        Args:
-            directory (str): The directory that will be created
-
-        Returns:
-            None
-
-        """
-        try:
-            ssh.remote_execute(self.dev_ip, ["mkdir", "-p", directory])
-        except subprocess32.CalledProcessError as err:
-            common.log_subprocess32_error_and_abort(err)
-
-
     def _copy_file_over_ssh(self, src, dst):
         """
         Copy file safely over ssh or abort on failure
@@ -683,34 +758,6 @@ class BeagleBoneBlackDevice(Device):
         except subprocess32.CalledProcessError as err:
             common.log_subprocess32_error_and_abort(err)
 
-    def _change_ownership_over_ssh(self, file_name, uid, gid):
-        """
-        Change file/directory ownership safely over ssh or abort on failure
-
-        Args:
-            file_name (str): The file which ownership is changed
-            uid (integer): owner id
-            gid (integer): group id
-
-        Returns:
-            None
-        """
-        try:
-            ssh.remote_execute(
-                self.dev_ip,
-                ["chown", str(uid) + ":" + str(gid), file_name])
-        except subprocess32.CalledProcessError as err:
-            common.log_subprocess32_error_and_abort(err)
-
-    def _change_permissions_over_ssh(self, file_name, permission):
-        """
-        Change file/directory permissions safely over ssh
-        """
-        try:
-            ssh.remote_execute(self.dev_ip, ["chmod", permission, file_name])
-        except subprocess32.CalledProcessError as err:
-            common.log_subprocess32_error_and_abort(err)
-
     def _mount(self, device_file):
         """
         Mounts a directory over ssh into self.mount_dir
@@ -21,28 +21,57 @@ the Device base class.
 
 import os
 import subprocess32
-import time
 import sys
+import threading
+import math
+from Queue import Queue, Empty
 
 from aft.logger import Logger as logger
 import aft.config as config
 import aft.tools.ssh as ssh
+import aft.tools.lease_index as lease_index
+import aft.tools.process_engine as process_engine
+import aft.tools.orchestration as orchestration
+import aft.tools.boot_statistics as boot_statistics
+import aft.tools.reservation_queue as reservation_queue
+import aft.tools.blacklist as blacklist
+
+# Lowercase mac address -> the ip address of the device that last answered
+_last_responsive_ips = {}
+_lock = threading.Lock()
+
+# Seconds between probes around the expected ready time of a boot
+_DENSE_POLLING_INTERVAL = 1
+
+# Dense probing starts and ends this many seconds around the range of the
+# recorded ready times
+_DENSE_PROBING_MARGIN = 5
 
 
 def wait_for_responsive_ip_for_pc_device(
     mac_address,
     leases_file_path,
     timeout,
-    polling_interval):
+    polling_interval,
+    boot_profile=None):
     """
     Attempt to acquire active ip address for the device with the given mac
-    address up to timeout seconds.
+    address up to timeout seconds. The timeout includes the time taken by
+    the ssh probes.
+
+    If a boot profile is given, the boot times recorded for it are used. The
+    device is probed every _DENSE_POLLING_INTERVAL seconds around the time it
+    is expected to become ready, and the wait is given up early if the device
+    shows no DHCP activity when it always has by then. The wait is recorded,
+    see aft.tools.boot_statistics.
 
     Args:
         mac_address (str): Device mac address
         leases_file_path (str): Path to dnsmasq leases file
         timeout (integer): Timeout in seconds
         polling_interval (integer): Time between retries in seconds.
+        boot_profile (str or None):
+            Boot profile, such as the device model and the mode booted into
 
     Returns:
         Ip address as a string, or None if ip address was not responsive.
@@ -52,24 +81,120 @@ def wait_for_responsive_ip_for_pc_device(
     logger.debug("Timeout: " + str(timeout))
     logger.debug("Polling interval: " + str(polling_interval))
 
-    for _ in range(timeout / polling_interval):
-        responsive_ip = get_ip_for_pc_device(mac_address, leases_file_path)
+    profile = None
+    if boot_profile:
+        profile = boot_statistics.get_boot_profile(boot_profile)
+        logger.debug("Boot profile " + boot_profile + ": " + str(profile))
+
+    index = lease_index.get_index(leases_file_path)
+    start = process_engine.monotonic()
+    version, leases = index.get_versioned_leases(mac_address)
+    lease_time = None
+    # Start of the latest failed probe. The device became ready after it.
+    last_failed_probe = None
+
+    while True:
+        probe_start = process_engine.monotonic() - start
+        responsive_ip = _get_responsive_ip(
+            mac_address, leases, timeout - probe_start)
+        elapsed = process_engine.monotonic() - start
+        if responsive_ip or elapsed >= timeout:
+            break
+        last_failed_probe = probe_start
+
+        if lease_time is None and profile and profile["lease_window"] and \
+                elapsed >= profile["lease_window"]:
+            logger.warning("No DHCP activity from " + mac_address + " in " +
+                           str(int(elapsed)) + " seconds, giving up")
+            break
+
+        # A new lease wakes this up at once. The leases are still retried
+        # on schedule, as sshd starts after the lease is taken.
+        interval = _get_polling_interval(
+            profile, elapsed, polling_interval, lease_time is None)
+        new_version, leases = index.wait_for_change(
+            mac_address, version, min(interval, timeout - elapsed))
+        if new_version != version and lease_time is None:
+            lease_time = process_engine.monotonic() - start
+        version = new_version
+
+    waited = process_engine.monotonic() - start
+    if responsive_ip:
+        # Fixed interval polling would not have noticed the device before
+        # the first multiple of the polling interval after the failed probe
+        saved = 0
+        if last_failed_probe is not None:
+            saved = (math.floor(last_failed_probe / polling_interval) + 1) * \
+                polling_interval - waited
+        logger.info("Got a response from " + responsive_ip + " after " +
+                    str(round(waited, 1)) + " seconds")
+    else:
+        saved = timeout - waited
+        logger.info("No responsive ip was found")
+
+    if boot_profile:
+        logger.info("Boot wait saved " + str(round(max(saved, 0), 1)) +
+                    " seconds compared to fixed interval polling")
+        boot_statistics.record_boot(
+            boot_profile, responsive_ip is not None, lease_time,
+            waited if responsive_ip else None, waited, max(saved, 0))
+
+    return responsive_ip
+
+
+def _get_polling_interval(profile, elapsed, polling_interval, no_lease):
+    """
+    Return the time until the next probe of a boot wait
+
+    Args:
+        profile (dictionary or None):
+            Boot profile from boot_statistics.get_boot_profile
+        elapsed (float): Seconds waited so far
+        polling_interval (float): Time between probes outside of the
+                                  expected ready time
+        no_lease (boolean): True if no DHCP activity has been seen yet
+
+    Returns:
+        (float): Seconds until the next probe
+    """
+    if not profile:
+        return polling_interval
+
+    dense_start = profile["ready_low"] - _DENSE_PROBING_MARGIN
+    dense_end = profile["ready_high"] + _DENSE_PROBING_MARGIN
+    if dense_start <= elapsed <= dense_end:
+        interval = _DENSE_POLLING_INTERVAL
+    elif elapsed < dense_start:
+        interval = min(polling_interval, dense_start - elapsed)
+    else:
+        interval = polling_interval
+
+    if no_lease and profile["lease_window"]:
+        interval = min(interval, profile["lease_window"] - elapsed)
+    return interval
 
-        if not responsive_ip:
-            time.sleep(polling_interval)
-            continue
 
-        logger.info("Got a response from " + responsive_ip)
-        return responsive_ip
+def wait_for_responsive_ip_async(mac_address, leases_file_path, timeout,
+                                 polling_interval=1):
+    """
+    Start wait_for_responsive_ip_for_pc_device as a task
 
-    logger.info("No responsive ip was found")
+    Returns:
+        (aft.tools.orchestration.Task):
+            The task; its result is the ip address, or None
+    """
+    return orchestration.spawn(
+        wait_for_responsive_ip_for_pc_device,
+        (mac_address, leases_file_path, timeout, polling_interval),
+        name="lease of " + mac_address)
 
 def get_ip_for_pc_device(mac_address, leases_file_path):
     """
     Return active ip address for PC like device that leases it through dnsmasq.
 
     Address is considered to be active if ssh connection can be made
-    successfully
+    successfully. All the leased addresses are probed at the same time, see
+    _get_responsive_ip.
 
     Args:
         mac_address (str): Device mac address
@@ -79,12 +204,74 @@ def get_ip_for_pc_device(mac_address, leases_file_path):
         Device ip address as string or None if device does not have active
         ip address
     """
-    ip_addresses = get_leased_ip_addresses_for_mac(
-        mac_address, leases_file_path)
+    return _get_responsive_ip(
+        mac_address,
+        lease_index.get_index(leases_file_path).get_leases(mac_address))
+
+
+def _get_responsive_ip(mac_address, leases, timeout=None):
+    """
+    Probe the leased ip addresses of a device concurrently, and return the
+    first one that accepts ssh connections. The remaining probes are
+    cancelled, as are all of them on timeout.
+
+    The address that answered last time is probed first, followed by the
+    others from the latest expiring lease to the earliest.
+
+    Args:
+        mac_address (str): Device mac address
+        leases (list(dictionary)): Leases of the device from the lease index
+        timeout (float or None): Seconds to wait for the probes
 
+    Returns:
+        Ip address as string or None if none of the addresses is active
+    """
+    ip_addresses = []
+    for lease in sorted(leases, key=lambda lease: lease["expiry"],
+                        reverse=True):
+        if lease["ip"] not in ip_addresses:
+            ip_addresses.append(lease["ip"])
+
+    with _lock:
+        last_responsive_ip = _last_responsive_ips.get(mac_address.lower())
+    if last_responsive_ip in ip_addresses:
+        ip_addresses.remove(last_responsive_ip)
+        ip_addresses.insert(0, last_responsive_ip)
+
+    finished = Queue()
+    probes = []
     for ip_address in ip_addresses:
-        if ssh.test_ssh_connectivity(ip_address):
-            return ip_address
+        probe = orchestration.spawn(ssh.test_ssh_connectivity, (ip_address,),
+                                    name="probe " + ip_address)
+        probe.add_done_callback(finished.put)
+        probes.append(probe)
+
+    deadline = None
+    if timeout is not None:
+        deadline = process_engine.monotonic() + timeout
+
+    try:
+        for _ in probes:
+            try:
+                if deadline is None:
+                    probe = finished.get()
+                else:
+                    probe = finished.get(
+                        timeout=max(deadline - process_engine.monotonic(), 0))
+            except Empty:
+                logger.info("Probing " + ", ".join(ip_addresses) +
+                            " timed out")
+                break
+            if probe.failed() or not probe.result():
+                continue
+
+            responsive_ip = ip_addresses[probes.index(probe)]
+            with _lock:
+                _last_responsive_ips[mac_address.lower()] = responsive_ip
+            return responsive_ip
+    finally:
+        for probe in probes:
+            probe.cancel()
 
     return None
 
@@ -101,15 +288,14 @@ def get_leased_ip_addresses_for_mac(mac_address, leases_file_path):
     Returns:
         List of ip addresses. Each ip address is a string.
     """
-
-    leases = get_mac_leases_from_dnsmasq(leases_file_path)
-    return [lease["ip"] for lease in leases if lease["mac"].lower() == mac_address.lower()]
+    leases = lease_index.get_index(leases_file_path).get_leases(mac_address)
+    return [lease["ip"] for lease in leases]
 
 
 def get_mac_leases_from_dnsmasq(leases_file_path):
     """
-    Read the active leases from dnsmasq leases file and return a list of
-    active leases as dictionaries.
+    Return the active leases of dnsmasq leases file as dictionaries. The
+    leases come from the shared lease index, so the file is not re-read.
 
     Args:
         file_name (str): Path to leases file, e.g. /path/to/file/dnsmasq.leases
@@ -119,6 +305,7 @@ def get_mac_leases_from_dnsmasq(leases_file_path):
         The dictionaries have the following format:
 
         {
+            "expiry": lease expiry time as seconds since the epoch,
             "mac": "device_mac_address",
             "ip": "device_ip_address",
             "hostname": "device_host_name",
@@ -126,25 +313,7 @@ def get_mac_leases_from_dnsmasq(leases_file_path):
         }
 
     """
-
-    with open(leases_file_path) as lease_file:
-        leases = lease_file.readlines()
-
-    leases_list = []
-    # dnsmasq.leases contains rows with the following format:
-    # <lease_expiry_time_as_epoch_format> <mac> <ip> <hostname> <domain>
-    # See:
-    #http://lists.thekelleys.org.uk/pipermail/dnsmasq-discuss/2005q1/000143.html
-
-    for lease in leases:
-        lease = lease.split()
-        leases_list.append({
-            "mac": lease[1],
-            "ip": lease[2],
-            "hostname": lease[3],
-            "client_id": lease[4],
-        })
-    return leases_list
+    return lease_index.get_index(leases_file_path).get_all_leases()
 
 def log_subprocess32_error_and_abort(err):
     """
@@ -188,7 +357,10 @@ def verify_device_mode(ip, mode):
         True if the device is in the desired mode, False otherwise
     """
     try:
-        sshout = ssh.remote_execute(ip, ["cat", "/proc/version"])
+        # The probe that found the ip address has usually read it already
+        sshout = ssh.get_probed_version(ip)
+        if sshout is None:
+            sshout = ssh.remote_execute(ip, ["cat", "/proc/version"])
         if mode in sshout:
             logger.info("Found device in " + mode + " mode.")
             return True
@@ -218,19 +390,24 @@ def blacklist_device(dev_id, name, reason):
     Returns:
         None
     """
+    blacklist.add(dev_id, name, reason)
 
-    with open(config.DEVICE_BLACKLIST, "a") as blacklist_file:
-        blacklist_file.write(dev_id + " " + name + " " + reason + "\n")
+    # Waiters re-read the blacklist when woken up
+    reservation_queue.notify_waiters()
 
-def unblacklist_device(dev_id):
-    lines = []
-    with open(config.DEVICE_BLACKLIST, "r") as device_blacklist:
-        for line in device_blacklist:
-            if line.split()[0] == dev_id:
-                continue
-            lines.append(line)
+def unblacklist_device(dev_id, reason=""):
+    """
+    Remove the device with given id from the blacklist
 
+    Args:
+        dev_id (str): The device id
+        reason (str): Reason for unblacklisting
+
+    Returns:
+        True if the device was blacklisted, False otherwise
+    """
+    removed = blacklist.remove(dev_id, reason)
 
-    with open(config.DEVICE_BLACKLIST, "w") as device_blacklist:
-        for line in lines:
-            device_blacklist.write(line)
+    # The device may be exactly what someone is waiting for
+    reservation_queue.notify_waiters()
+    return removed
@@ -29,8 +29,11 @@ from aft.logger import Logger as logger
 from aft.device import Device
 import aft.errors as errors
 import aft.tools.misc as misc
+import aft.tools.process_engine as process_engine
 import aft.tools.ssh as ssh
 import aft.devices.common as common
+import aft.tools.device_statistics as device_statistics
+import aft.tools.image_state as image_state
 
 
 
@@ -151,6 +154,8 @@ class EdisonDevice(Device):
             [ip_range, str(int(subnet_parts[3]) + 3)])
         self._root_extension = "ext4"
 
+    @image_state.skips_reflash
+    @device_statistics.records_flash
     def write_image(self, file_name):
         """
         Writes the new image into the Edison
@@ -525,54 +530,35 @@ class EdisonDevice(Device):
 
         attempt = 0
         while attempt < attempts:
-            flashing_log_file = open(self._FLASHER_OUTPUT_LOG, "a")
             self._wait_for_device()
-            execution = subprocess32.Popen(
-                [
-                   "dfu-util", "-v", "--path",
-                    self._usb_path,
-                    "--alt", alt, "-D",
-                    source
-                ] + extras,
-                stdout=flashing_log_file,
-                stderr=flashing_log_file)
-
-            start = time.time()
-            while time.time() - start < timeout:
-                status = execution.poll()
-                if status == None:
-                    continue
+            output = None
+            with open(self._FLASHER_OUTPUT_LOG, "a") as flashing_log_file:
+                try:
+                    return_code, output = process_engine.run(
+                        [
+                           "dfu-util", "-v", "--path",
+                            self._usb_path,
+                            "--alt", alt, "-D",
+                            source
+                        ] + extras,
+                        flashing_log_file.write,
+                        timeout,
+                        tail_lines=10)
+                except subprocess32.TimeoutExpired:
+                    logger.warning("Flashing timeout")
+
+            if output is not None:
+                if not ignore_errors and return_code != 0:
+                    logger.warning("Return value was non-zero - retrying")
+                # dfu-util does not return non-zero value when flashing
+                # fails due to download error. Instead, check if last few
+                # lines in the log contain "Error during download"
+                elif "Error during download" in output:
+                    logger.warning("Error in log - retrying")
                 else:
-                    flashing_log_file.close()
-                    if not ignore_errors and execution.returncode != 0:
-                        logger.warning("Return value was non-zero - retrying")
-                        break
-
-                    # dfu-util does not return non-zero value when flashing
-                    # fails due to download error. Instead, check if last few
-                    # lines in the log contain "Error during download"
-                    with open(self._FLASHER_OUTPUT_LOG) as flash_log:
-                        last_lines = flash_log.readlines()[-10:]
-                        break_outer = False
-                        for line in last_lines:
-                            if "Error during download" in line:
-                                logger.warning("Error in log - retrying")
-                                break_outer = True
-                                break
-                        if break_outer:
-                            break
                     return
 
-            try:
-                execution.kill()
-            except OSError as err:
-                if err.errno == 3: # 3 = errno.ESRCH = no such process
-                    pass
-                else:
-                    raise
             attempt += 1
-            if time.time() - start >= timeout:
-                logger.warning("Flashing timeout")
             logger.warning(
                 "Flashing failed on alt " + alt + " for file " + source +
                 " on USB-path " + self._usb_path +
@@ -580,7 +566,6 @@ class EdisonDevice(Device):
                 str(attempt) + "/" + str(attempts) + " time.")
 
             self._power_cycle()
-        flashing_log_file.close()
         raise errors.AFTDeviceError(
             "Flashing failed " + str(attempts) +
             " times. Raising error (aborting).")
@@ -710,10 +695,8 @@ class EdisonDevice(Device):
             aft.errors.AFTConnectionError on timeout
 
         """
-        start = time.time()
-        while time.time() - start < timeout:
-            if ssh.test_ssh_connectivity(self.get_ip()):
-                return
+        if ssh.wait_until_ready(self.get_ip(), timeout) is not None:
+            return
         logger.critical(
             "Failed to establish ssh-connection in " + str(timeout) +
             " seconds after enabling the network interface.")
@@ -732,6 +715,15 @@ class EdisonDevice(Device):
         return self._dut_ip
 
 
+    def get_connection_ip(self):
+        """
+        Return the ip address used for connecting to the device
+
+        Returns:
+            (str): Device ip address
+        """
+        return self._dut_ip
+
     def get_host_ip(self):
         """
         Return host ip address
@@ -18,7 +18,9 @@ Class representing a PC-like Device with an IP.
 """
 
 import os
+import re
 import json
+import subprocess32
 from multiprocessing import Process, Queue
 
 from aft.logger import Logger as logger
@@ -27,8 +29,10 @@ from aft.device import Device
 import aft.errors as errors
 import aft.tools.ssh as ssh
 import aft.devices.common as common
-
-from pem.main import main as pem_main
+import aft.tools.device_statistics as device_statistics
+import aft.tools.image_state as image_state
+import aft.tools.pem_session as pem_session
+import aft.tools.image_stream as image_stream
 
 VERSION = "0.1.0"
 
@@ -71,9 +75,12 @@ class PCDevice(Device):
     _BOOT_TIMEOUT = 240
     _POLLING_INTERVAL = 10
     _SSH_IMAGE_WRITING_TIMEOUT = 1440
+    # Timeout per step of a batch of ssh commands, such as a slow sync
+    _SSH_STEP_TIMEOUT = 60
     _IMG_NFS_MOUNT_POINT = "/mnt/img_data_nfs"
     _ROOT_PARTITION_MOUNT_POINT = "/mnt/target_root/"
     _SUPER_ROOT_MOUNT_POINT = "/mnt/super_target_root/"
+    image_marker_path = "/etc/aft_image"
 
 
     def __init__(self, parameters, channel):
@@ -98,6 +105,8 @@ class PCDevice(Device):
 
         self.pem_interface = parameters["pem_interface"]
         self.pem_port = parameters["pem_port"]
+        self._pem_session = pem_session.PEMSession(self.pem_interface,
+                                                   self.pem_port)
         self._test_mode = {
             "name": self._test_mode_name,
             "sequence": parameters["test_mode_keystrokes"]}
@@ -118,6 +127,8 @@ class PCDevice(Device):
 
 # pylint: enable=no-self-use
 
+    @image_state.skips_reflash
+    @device_statistics.records_flash
     def write_image(self, file_name):
         """
         Method for writing an image to a device.
@@ -129,23 +140,49 @@ class PCDevice(Device):
         Returns:
             None
         """
-        # NOTE: it is expected that the image is located somewhere
-        # underneath config.NFS_FOLDER (default: /home/tester),
+        # NOTE: with nfs delivery, it is expected that the image is located
+        # somewhere underneath config.NFS_FOLDER (default: /home/tester),
         # therefore symlinks outside of it will not work
         # The config.NFS_FOLDER path is exported as nfs and mounted remotely as
-        # _IMG_NFS_MOUNT_POINT
+        # _IMG_NFS_MOUNT_POINT. Streamed images can be anywhere.
 
         # Bubblegum fix to support both .hddimg and .hdddirect at the same time
         self._uses_hddimg = os.path.splitext(file_name)[-1] == ".hddimg"
 
         self._enter_mode(self._service_mode)
-        file_on_nfs = os.path.abspath(file_name).replace(
-            config.NFS_FOLDER,
-            self._IMG_NFS_MOUNT_POINT)
-
-        self._flash_image(nfs_file_name=file_on_nfs, filename=file_name)
+        if config.IMAGE_DELIVERY == "stream":
+            self._stream_image(file_name)
+        else:
+            file_on_nfs = os.path.abspath(file_name).replace(
+                config.NFS_FOLDER,
+                self._IMG_NFS_MOUNT_POINT)
+            self._flash_image(nfs_file_name=file_on_nfs, filename=file_name)
         self._install_tester_public_key(file_name)
 
+    def verify_image_marker(self, image_hash):
+        """
+        Boot to test mode and check the image marker file.
+
+        Args:
+            image_hash (str): The expected image hash
+
+        Returns:
+            True if the device holds the image, False otherwise
+        """
+        try:
+            self._enter_mode(self._test_mode)
+            marker = ssh.remote_execute(
+                self.dev_ip,
+                ["cat", self.image_marker_path],
+                ignore_return_codes=[1])
+        except (errors.AFTDeviceError,
+                subprocess32.CalledProcessError,
+                subprocess32.TimeoutExpired) as err:
+            logger.warning("Image marker verification failed: " + str(err))
+            return False
+
+        return marker.strip() == image_hash
+
     def _run_tests(self, test_case):
         """
         Boot to test-mode and execute testplan.
@@ -201,7 +238,7 @@ class PCDevice(Device):
 
             self._send_PEM_keystrokes(mode["sequence"])
 
-            ip_address = self._wait_for_responsive_ip()
+            ip_address = self._wait_for_responsive_ip(mode["name"])
 
             if ip_address:
                 if self._verify_mode(mode["name"]):
@@ -233,47 +270,27 @@ class PCDevice(Device):
             aft.errors.AFTDeviceError if PEM connection times out
 
         """
-        def call_pem(exceptions):
-            try:
-                pem_main(
-                [
-                    "pem",
-                    "--interface", self.pem_interface,
-                    "--port", self.pem_port,
-                    "--playback", keystrokes
-                ])
-            except Exception as err:
-                exceptions.put(err)
-
         for i in range(attempts):
             logger.info(
                 "Attempt " + str(i + 1) + " of " + str(attempts) + " to send " +
                 "keystrokes through PEM")
 
-            exception_queue = Queue()
-            process = Process(target=call_pem, args=(exception_queue,))
-            # ensure python process is closed in case main process dies but
-            # the subprocess is still waiting for timeout
-            process.daemon = True
-
-            process.start()
-            process.join(timeout)
-
-            if not exception_queue.empty():
-                raise exception_queue.get()
-
-            if process.is_alive():
-                process.terminate()
-            else:
+            try:
+                self._pem_session.play(keystrokes, timeout)
                 return
+            except errors.AFTTimeoutError as err:
+                logger.warning(str(err))
 
         raise errors.AFTDeviceError("Failed to connect to PEM")
 
-    def _wait_for_responsive_ip(self):
+    def _wait_for_responsive_ip(self, mode_name):
         """
         For a limited amount of time, try to assess if the device
         is in the mode requested.
 
+        Args:
+            mode_name (str): Name of the mode being booted into
+
         Returns:
             (str or None):
                 The device ip, or None if no active ip address was found
@@ -283,7 +300,9 @@ class PCDevice(Device):
             self.dev_id,
             self.parameters["leases_file_name"],
             self._BOOT_TIMEOUT,
-            self._POLLING_INTERVAL)
+            self._POLLING_INTERVAL,
+            boot_profile=self.model + " " + mode_name)
+        self._start_session(self.dev_ip)
 
         return self.dev_ip
 
@@ -326,9 +345,43 @@ class PCDevice(Device):
                          ".bmap. Flashing without it.")
             bmap_args.insert(2, "--nobmap")
 
-        ssh.remote_execute(self.dev_ip, bmap_args,
-                           timeout=self._SSH_IMAGE_WRITING_TIMEOUT)
+        ssh.remote_execute_stream(self.dev_ip, bmap_args,
+                                  self._report_bmaptool_progress,
+                                  timeout=self._SSH_IMAGE_WRITING_TIMEOUT)
+        self._settle_partitions()
 
+    def _stream_image(self, filename):
+        """
+        Writes image into the internal storage of the device, streaming it
+        from the harness. See aft.tools.image_stream.
+
+        Args:
+            filename (str): The image filename
+
+        Returns:
+            None
+        """
+        logger.info("Streaming " + filename + " to internal storage.")
+        if not os.path.isfile(filename + ".bmap"):
+            logger.info("Didn't find " + filename +
+                        ".bmap. Streaming the whole image.")
+
+        image_stream.write_image(
+            self.dev_ip,
+            filename,
+            self._target_device,
+            self._SSH_IMAGE_WRITING_TIMEOUT,
+            self._report_bmaptool_progress,
+            bandwidth=int(config.IMAGE_STREAM_BANDWIDTH))
+        self._settle_partitions()
+
+    def _settle_partitions(self):
+        """
+        Make the device notice the partitions of the written image
+
+        Returns:
+            None
+        """
         # Flashing the same file as already on the disk causes non-blocking
         # removal and re-creation of /dev/disk/by-partuuid/ files. This sequence
         # either delays enough or actually settles it.
@@ -339,6 +392,20 @@ class PCDevice(Device):
         ssh.remote_execute(self.dev_ip, ["udevadm", "settle"])
         ssh.remote_execute(self.dev_ip, ["udevadm", "control", "-S"])
 
+    def _report_bmaptool_progress(self, line):
+        """
+        Log the progress bmaptool reports while copying the image
+
+        Args:
+            line (str): A line of bmaptool output
+
+        Returns:
+            None
+        """
+        match = re.search(r"(\d+)% copied", line)
+        if match:
+            logger.info("Image writing " + match.group(1) + "% done")
+
     def _mount_single_layer(self, image_file_name):
         """
         Mount a hdddirect partition
@@ -443,78 +510,75 @@ class PCDevice(Device):
                 "sed", "-e",
                 '"s/:.*//"']).rstrip().lstrip("/")
 
-        # Ignore return value: directory might exist
+        ssh_directory = os.path.join(
+            self._ROOT_PARTITION_MOUNT_POINT,
+            root_user_home,
+            ".ssh")
+        authorized_keys = os.path.join(ssh_directory, "authorized_keys")
+
         logger.info("Writing ssh-key to device.")
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "mkdir",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh")
-            ],
-            ignore_return_codes=[1])
+        steps = [
+            # Ignore return value: directory might exist
+            {"command": ["mkdir", ssh_directory], "ignore_return_codes": [1]},
+            ["chmod", "700", ssh_directory],
+            ["cat", "~/.ssh/authorized_keys", ">>", authorized_keys],
+            ["chmod", "600", authorized_keys]]
 
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "chmod",
-                "700",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh")
-            ])
+        if not self._uses_hddimg:
+            logger.info("Adding IMA attribute to the ssh-key")
+            steps.append(self._get_ima_attribute_step(authorized_keys))
 
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "cat",
-                "~/.ssh/authorized_keys",
-                ">>",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh/authorized_keys")])
+        steps += self._get_image_marker_steps()
 
-        ssh.remote_execute(
+        logger.info("Flushing and unmounting.")
+        steps += [
+            ["sync"],
+            ["umount", self._ROOT_PARTITION_MOUNT_POINT]]
+
+        ssh.remote_execute_batch(
             self.dev_ip,
-            [
-                "chmod",
-                "600",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh/authorized_keys")
-            ])
+            steps,
+            timeout=self._SSH_STEP_TIMEOUT * len(steps))
+
+    def _get_image_marker_steps(self):
+        """
+        Return the commands that write the hash of the image being flashed
+        into the marker file on the mounted root partition.
+
+        Returns:
+            (list(list(str))): The commands, for ssh.remote_execute_batch
+        """
+        if not self.image_hash:
+            return []
+
+        marker_file = os.path.join(
+            self._ROOT_PARTITION_MOUNT_POINT,
+            self.image_marker_path.lstrip("/"))
 
+        logger.info("Writing image marker to device.")
+        steps = [["echo", self.image_hash, ">", marker_file]]
         if not self._uses_hddimg:
-            logger.info("Adding IMA attribute to the ssh-key")
-            ssh.remote_execute(
-                self.dev_ip,
-                [
-                    "setfattr",
-                    "-n",
-                    "security.ima",
-                    "-v",
-                    "0x01`sha1sum " +
-                    os.path.join(
-                        self._ROOT_PARTITION_MOUNT_POINT,
-                        root_user_home,
-                        ".ssh/authorized_keys") + " | cut '-d ' -f1`",
-                    os.path.join(
-                        self._ROOT_PARTITION_MOUNT_POINT,
-                        root_user_home,
-                        ".ssh/authorized_keys")
-                ])
-
-        logger.info("Flushing.")
-        ssh.remote_execute(self.dev_ip, ["sync"])
+            steps.append(self._get_ima_attribute_step(marker_file))
+        return steps
 
-        logger.info("Unmounting.")
-        ssh.remote_execute(
-            self.dev_ip, ["umount", self._ROOT_PARTITION_MOUNT_POINT])
+    @staticmethod
+    def _get_ima_attribute_step(file_name):
+        """
+        Return the command that adds the IMA attribute to a file
+
+        Args:
+            file_name (str): The file
+
+        Returns:
+            (list(str)): The command
+        """
+        return [
+            "setfattr",
+            "-n",
+            "security.ima",
+            "-v",
+            "0x01`sha1sum " + file_name + " | cut '-d ' -f1`",
+            file_name]
 
     def execute(self, command, timeout, user="root", verbose=False):
         """
@@ -529,8 +593,8 @@ class PCDevice(Device):
         Return:
             Return value of aft.ssh.remote_execute
         """
-        return ssh.remote_execute(
-            self.get_ip(),
+        return self._call_in_session(
+            ssh.remote_execute,
             command,
             timeout=timeout,
             user=user)
@@ -544,8 +608,8 @@ class PCDevice(Device):
             destination (str): The destination file
             user (str): The user who executes the command
         """
-        ssh.push(self.get_ip(), source=source,
-                 destination=destination, user=user)
+        self._call_in_session(ssh.push, source=source,
+                              destination=destination, user=user)
 
 
     def check_poweron(self):
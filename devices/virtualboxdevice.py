@@ -25,6 +25,8 @@ from aft.logger import Logger as logger
 import aft.errors as errors
 import aft.tools.misc as misc
 import aft.devices.common as common
+import aft.tools.device_statistics as device_statistics
+import aft.tools.image_state as image_state
 
 
 class VirtualBoxDevice(Device):
@@ -83,6 +85,8 @@ class VirtualBoxDevice(Device):
 
         self._is_powered_on = False
 
+    @image_state.skips_reflash
+    @device_statistics.records_flash
     def write_image(self, ova_appliance):
         """
         Prepare image for testing. As this is a VM based test, no image is
@@ -346,8 +350,10 @@ class VirtualBoxDevice(Device):
         logger.info("Entering test mode")
         self._set_host_only_nic()
         self._start_vm()
-        if self.get_ip() == None:
+        ip_address = self._wait_for_responsive_ip(self.model + " test")
+        if ip_address == None:
             raise errors.AFTDeviceError("Failed to get responsive ip")
+        self._start_session(ip_address)
 
 
     def _set_host_only_nic(self):
@@ -386,6 +392,7 @@ class VirtualBoxDevice(Device):
         logger.info("Stopping the vm")
         misc.local_execute((
             "VBoxManage controlvm " + self._vm_name + " poweroff").split())
+        self._end_session()
 
     def _unregister_vm(self):
         logger.info("Unregistering the vm")
@@ -394,8 +401,22 @@ class VirtualBoxDevice(Device):
         misc.local_execute(("VBoxManage unregistervm " + self._vm_name).split())
 
     def get_ip(self):
+        return self._wait_for_responsive_ip()
+
+    def _wait_for_responsive_ip(self, boot_profile=None):
+        """
+        Wait until the VM has leased a responsive ip address
+
+        Args:
+            boot_profile (str or None):
+                Boot profile for learning the boot time, if the VM is booting
+
+        Returns:
+            (str or None): The ip address, or None if none was found
+        """
         return common.wait_for_responsive_ip_for_pc_device(
             self._mac_address,
             self.parameters["leases_file_name"],
             self._BOOT_TIMEOUT,
-            self._POLLING_INTERVAL)
+            self._POLLING_INTERVAL,
+            boot_profile=boot_profile)
@@ -29,15 +29,31 @@ import aft.errors as errors
 import aft.config as config
 import aft.devicefactory as devicefactory
 import aft.devices.common as common
+import aft.tools.reservation_queue as reservation_queue
+import aft.tools.config_cache as config_cache
+import aft.tools.blacklist as blacklist
+import aft.tools.misc as misc
+import aft.tools.device_statistics as device_statistics
+import aft.tools.boot_statistics as boot_statistics
+import aft.tools.selection_policies as selection_policies
+import aft.tools.image_state as image_state
+from aft.tools.reservation_broker import BrokerClient
 
 class DevicesManager(object):
     """Class handling devices connected to the same host PC"""
 
     __PLATFORM_FILE_NAME = "/etc/aft/devices/platform.cfg"
 
+    # Processes that die while holding a device lock do not notify the
+    # waiters, so waiters still check the locks this often
+    _FALLBACK_POLL_INTERVAL = 10
+
+    # Period of the reservation wait time report, in seconds
+    _WAIT_STATISTICS_PERIOD = 7 * 24 * 3600
+
     # Construct all device objects of the correct machine type based on the topology config file.
     # args = parsed command line arguments
-    def __init__(self, args):
+    def __init__(self, args, device_pool=None):
         """
         Constructor
 
@@ -47,10 +63,21 @@ class DevicesManager(object):
         Args:
             args (argparse namespace argument object):
                 Command line arguments, as parsed by argparse
+            device_pool (dictionary or None):
+                Device id -> device object. If given, device objects are
+                taken from and added to the pool instead of being constructed
+                for every reservation, so that long running processes can
+                share them between device managers.
         """
 
         self._args = args
+        self._device_pool = device_pool
         self._lockfiles = []
+        self._wait_times = {}
+        # Connection to the reservation broker, opened on first reservation
+        self._broker = None
+        self._broker_checked = False
+        self._broker_devices = set()
         self.device_configs = self._construct_configs()
 
 
@@ -80,6 +107,47 @@ class DevicesManager(object):
         catalog_config_file = self._args.catalog
         topology_config_file = self._args.topology
 
+        # Parsing and merging the files is done only when they have changed
+        configs = config_cache.load(
+            "device_configs",
+            [platform_config_file, catalog_config_file, topology_config_file],
+            lambda: self._merge_configs(
+                platform_config_file,
+                catalog_config_file,
+                topology_config_file))
+
+        for device_param in configs:
+            device_param["settings"]["serial_log_name"] = config.SERIAL_LOG_NAME
+
+        if len(configs) == 0:
+            raise errors.AFTConfigurationError(
+                "Zero device configurations built - is this really correct? " +
+                "Check that paths for topology, catalog and platform files "
+                "are correct and that the files have some settings inside")
+
+
+        logger.info("Built configuration sets for " + str(len(configs)) +
+                     " devices")
+
+        return configs
+
+    def _merge_configs(
+            self,
+            platform_config_file,
+            catalog_config_file,
+            topology_config_file):
+        """
+        Parse the configuration files and merge them into the format returned
+        by _construct_configs
+
+        Args:
+            platform_config_file (str): Path to the platform file
+            catalog_config_file (str): Path to the catalog file
+            topology_config_file (str): Path to the topology file
+
+        Returns:
+            List of device configuration dictionaries
+        """
         platform_config = ConfigParser.SafeConfigParser()
         platform_config.read(platform_config_file)
         catalog_config = ConfigParser.SafeConfigParser()
@@ -108,7 +176,6 @@ class DevicesManager(object):
             settings.update(device_entry)
 
             settings["name"] = device_title.lower()
-            settings["serial_log_name"] = config.SERIAL_LOG_NAME
 
             device_param = {}
             device_param["name"] = device_title.lower()
@@ -116,17 +183,6 @@ class DevicesManager(object):
             device_param["settings"] = settings
             configs.append(device_param)
 
-
-        if len(configs) == 0:
-            raise errors.AFTConfigurationError(
-                "Zero device configurations built - is this really correct? " +
-                "Check that paths for topology, catalog and platform files "
-                "are correct and that the files have some settings inside")
-
-
-        logger.info("Built configuration sets for " + str(len(configs)) +
-                     " devices")
-
         return configs
 
     def _construct_blacklist(self):
@@ -137,46 +193,49 @@ class DevicesManager(object):
             None
 
         Returns:
-            List of dictionaries, where dictionaries have the following format:
+            Dictionary of device id -> blacklist entry, where entries have the
+            following format:
             {
                 "id": "device_id",
                 "name": "device_name",
-                "reason": "reason for blacklisting"
+                "reason": "reason for blacklisting",
+                "timestamp": time of blacklisting
             }
         """
-        blacklist = []
-        with open(config.DEVICE_BLACKLIST, "r") as blacklist_file:
-            for line in blacklist_file:
-                values = line.split()
-
-                reason = ""
-                for i in range(2, len(values)):
-                    reason += values[i] + " "
-                blacklist.append(
-                    {
-                        "id": values[0],
-                        "name": values[1],
-                        "reason": reason.strip()
-                    })
-
-        return blacklist
+        return blacklist.get_entries()
 
-    def reserve(self, timeout = 3600):
+    def reserve(self, timeout = 3600, image_hash=None):
         """
         Reserve and lock a device and return it
-        """
-
-        devices = []
 
-        for device_config in self.device_configs:
-            if device_config["model"].lower() == self._args.machine.lower():
-                cutter = devicefactory.build_cutter(device_config["settings"])
-                device = devicefactory.build_device(device_config["settings"], cutter)
-                devices.append(device)
+        Args:
+            timeout (integer): Timeout in seconds
+            image_hash (str or None):
+                Hash of the image that will be flashed. Free devices that
+                already hold the image are preferred.
 
-        devices = self._remove_blacklisted_devices(devices)
+        Returns:
+            (aft.Device): The reserved device
+        """
 
-        return self._do_reserve(devices, self._args.machine, timeout)
+        broker = self._get_broker()
+        if broker:
+            name, wait_time = broker.reserve(
+                timeout,
+                model=self._args.machine,
+                policy=self._args.selection_policy,
+                priority=self._args.priority,
+                image_hash=image_hash)
+            device = self._take_broker_device(name, wait_time)
+        else:
+            devices = self._get_model_devices(self._args.machine, image_hash)
+            devices, _ = self._do_reserve(
+                devices, self._args.machine, timeout, remove_blacklisted=True)
+            device = devices[0]
+
+        if image_hash:
+            image_state.record_affinity(device, image_hash)
+        return device
 
 
     def reserve_specific(self, machine_name, timeout = 3600, model=None):
@@ -190,9 +249,7 @@ class DevicesManager(object):
         devices = []
         for device_config in self.device_configs:
             if device_config["name"].lower() == machine_name.lower():
-                cutter = devicefactory.build_cutter(device_config["settings"])
-                device = devicefactory.build_device(device_config["settings"], cutter)
-                devices.append(device)
+                devices.append(self._build_device(device_config))
                 break
 
         #Check if device is a given model
@@ -201,75 +258,516 @@ class DevicesManager(object):
                 raise errors.AFTConfigurationError(
                     "Device and machine doesn't match")
 
-        return self._do_reserve(devices, machine_name, timeout)
+        broker = self._get_broker()
+        if broker:
+            name, wait_time = broker.reserve(
+                timeout,
+                name=machine_name,
+                priority=self._args.priority)
+            return self._take_broker_device(name, wait_time)
+
+        devices, _ = self._do_reserve(devices, machine_name, timeout)
+        return devices[0]
+
+    def reserve_many(self, model_or_names, count=None, timeout=3600,
+                     image_hash=None):
+        """
+        Reserve and lock several devices at once, all or nothing.
+
+        Devices are only taken once enough of them are free at the same
+        time, so a partial set is never held while waiting for the rest. The
+        request waits in the same FIFO queue as single reservations, and
+        claims all of its candidate devices while waiting, so it cannot be
+        starved by a stream of single reservations.
+
+        Args:
+            model_or_names (str or list(str)):
+                Device model, or list of device names. Like with
+                reserve_specific, devices reserved by name are taken even if
+                they are blacklisted.
+            count (integer or None):
+                Number of devices to reserve. Defaults to all the named
+                devices, or a single device of the model.
+            timeout (integer): Timeout in seconds
+            image_hash (str or None):
+                Hash of the image that will be flashed. When reserving by
+                model, free devices that already hold the image are
+                preferred.
+
+        Returns:
+            (list(aft.Device)): The reserved devices
+
+        Raises:
+            aft.errors.AFTConfigurationError if there are not enough devices
+            aft.errors.AFTTimeoutError if the devices could not be reserved
+            in time
+        """
+        by_model = isinstance(model_or_names, basestring)
+        if by_model:
+            description = model_or_names
+            devices = self._get_model_devices(model_or_names, image_hash)
+            count = count or 1
+        else:
+            description = ", ".join(model_or_names)
+            devices = []
+            for name in model_or_names:
+                for device_config in self.device_configs:
+                    if device_config["name"].lower() == name.lower():
+                        devices.append(self._build_device(device_config))
+                        break
+                else:
+                    raise errors.AFTConfigurationError(
+                        "No device configuration for " + name)
+            count = count or len(devices)
+
+        broker = self._get_broker()
+        if broker:
+            if by_model:
+                names, wait_time = broker.reserve_many(
+                    timeout,
+                    count,
+                    model=model_or_names,
+                    policy=self._args.selection_policy,
+                    priority=self._args.priority,
+                    image_hash=image_hash)
+            else:
+                names, wait_time = broker.reserve_many(
+                    timeout,
+                    count,
+                    names=model_or_names,
+                    priority=self._args.priority)
+            devices = [self._take_broker_device(name, wait_time)
+                       for name in names]
+        else:
+            devices, _ = self._do_reserve(
+                devices,
+                description,
+                timeout,
+                remove_blacklisted=by_model,
+                count=count)
+
+        if by_model and image_hash:
+            for device in devices:
+                image_state.record_affinity(device, image_hash)
+        return devices
+
+    def _get_model_devices(self, model, image_hash=None):
+        """
+        Construct the devices of the given model, in the order preferred by
+        the selection policy
+
+        Args:
+            model (str): The device model
+            image_hash (str or None):
+                Hash of the image that will be flashed, see
+                aft.tools.selection_policies.order_devices
+
+        Returns:
+            (list(aft.Device)): The devices
+        """
+        device_configs = [
+            device_config for device_config in self.device_configs
+            if device_config["model"].lower() == model.lower()]
+
+        order = selection_policies.order_devices(
+            self._args.selection_policy,
+            [device_config["settings"]["id"] for device_config in device_configs],
+            image_hash)
+        device_configs.sort(
+            key=lambda device_config: order.index(device_config["settings"]["id"]))
+
+        devices = []
+        for device_config in device_configs:
+            devices.append(self._build_device(device_config))
+        return devices
+
+    def _build_device(self, device_config):
+        """
+        Construct the device object and its cutter
+
+        Args:
+            device_config (dictionary): Device configuration, as returned by
+                                        _construct_configs
+
+        Returns:
+            (aft.Device): The device object
+        """
+        dev_id = device_config["settings"]["id"]
+        if self._device_pool is not None and dev_id in self._device_pool:
+            return self._device_pool[dev_id]
+
+        cutter = devicefactory.build_cutter(device_config["settings"])
+        device = devicefactory.build_device(device_config["settings"], cutter)
+
+        if self._device_pool is not None:
+            device = self._device_pool.setdefault(dev_id, device)
+        return device
+
+    def _get_broker(self):
+        """
+        Return the reservation broker client, if the broker is running
+
+        Returns:
+            (aft.tools.reservation_broker.BrokerClient or None):
+                The broker client, or None if the broker is not running
+        """
+        if not self._broker_checked:
+            self._broker_checked = True
+            self._broker = BrokerClient.connect()
+        return self._broker
+
+    def _take_broker_device(self, name, wait_time):
+        """
+        Build the device object for a device reserved through the broker
+
+        Args:
+            name (str): Device name
+            wait_time (float): Time spent waiting for the device
+
+        Returns:
+            (aft.Device): The device object
+        """
+        for device_config in self.device_configs:
+            if device_config["name"].lower() == name.lower():
+                device = self._build_device(device_config)
+                break
+        else:
+            # Broker and this process disagree about the topology
+            self._broker.release(name)
+            raise errors.AFTConfigurationError(
+                "Reservation broker returned unknown device " + name +
+                " - restart the broker after changing the topology")
+
+        self._broker_devices.add(device.dev_id)
+        self._wait_times[device.dev_id] = wait_time
+        device_statistics.record_reservation(
+            device,
+            self._args.priority,
+            wait_time)
+        logger.info("Device " + name + " acquired through the broker after " +
+                    "waiting " + str(round(wait_time, 3)) + " seconds.")
+        return device
+
+    def status(self):
+        """
+        Return the reservation status of every device from the broker
+
+        Returns:
+            (dictionary): See aft.tools.reservation_broker.ReservationBroker.get_status
+
+        Raises:
+            aft.errors.AFTConfigurationError if the broker is not running
+        """
+        broker = self._get_broker()
+        if not broker:
+            raise errors.AFTConfigurationError(
+                "Reservation broker is not running")
+        return broker.status()
 
 
-    def _do_reserve(self, devices, name, timeout):
+    def _do_reserve(
+            self,
+            devices,
+            name,
+            timeout,
+            remove_blacklisted=False,
+            count=1):
         """
-        Try to reserve and lock a device from devices list.
+        Try to reserve and lock count devices from devices list.
+
+        The caller is put into a FIFO queue shared by all the AFT processes
+        on this host and sleeps until a device is released or the blacklist
+        changes. A device is only attempted if no process ahead in the queue
+        (of higher priority, or of the same priority and started waiting
+        earlier) is also waiting for it.
+
+        Args:
+            devices (list(aft.Device)): The candidate devices, most preferred
+                                        first
+            name (str): Model or device name, used in messages
+            timeout (integer): Timeout in seconds
+            remove_blacklisted (boolean):
+                Filter out blacklisted devices. The blacklist is re-read, and
+                the queue ticket rewritten, every time the waiter is woken up.
+            count (integer): Number of devices to reserve
+
+        Returns:
+            Tuple (list(aft.Device), float): The reserved devices and the time
+            in seconds spent waiting for them
+
+        Raises:
+            aft.errors.AFTConfigurationError if there are not enough candidate
+            devices
+            aft.errors.AFTTimeoutError if the devices could not be reserved in
+            time
         """
         if len(devices) == 0:
             raise errors.AFTConfigurationError(
                 "No device configurations when reserving " + name +
                 " - check that given machine type or name is correct")
 
+        if len(devices) < count:
+            raise errors.AFTConfigurationError(
+                "Cannot reserve " + str(count) + " devices of " + name +
+                " - only " + str(len(devices)) + " devices are configured")
+
         start = time.time()
-        while time.time() - start < timeout:
-            for device in devices:
-                logger.info("Attempting to acquire " + device.name)
-                try:
-                    # This is a non-atomic operation which may cause trouble
-                    # Using a locking database system could be a viable fix.
-                    lockfile = os.fdopen(os.open(os.path.join(config.LOCK_FILE,
-                                                                    "aft_" + device.dev_id),
-                                                       os.O_WRONLY | os.O_CREAT, 0660), "w")
-                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-
-                    logger.info("Device acquired.")
-
-                    self._lockfiles.append((device.dev_id, lockfile))
-
-
-                    atexit.register(self.release, device)
-                    return device
-                except IOError as err:
-                    if err.errno in {errno.EACCES, errno.EAGAIN}:
-                        logger.info("Device busy.")
-                    else:
-                        logger.critical("Cannot obtain lock file.")
-                        sys.exit(-1)
-            logger.info("All devices busy ... waiting 10 seconds and trying again.")
-            time.sleep(10)
+        queue = None
+        reported_blacklisted = set()
+
+        try:
+            while True:
+                candidates = devices
+                if remove_blacklisted:
+                    candidates = self._remove_blacklisted_devices(
+                        devices, reported_blacklisted)
+
+                # The ticket only claims the devices that can be taken, so
+                # that blacklisted devices do not block younger waiters
+                dev_ids = [device.dev_id for device in candidates]
+                if queue is None:
+                    queue = reservation_queue.ReservationQueue(
+                        dev_ids,
+                        self._args.priority)
+                else:
+                    queue.update(dev_ids)
+
+                claimed = queue.claimed_by_preceding_waiters()
+
+                available = []
+                for device in candidates:
+                    if device.dev_id in claimed:
+                        logger.info(device.name + " is reserved for an " +
+                                    "earlier waiter.")
+                        continue
+                    available.append(device)
+
+                locked = []
+                if len(available) >= count:
+                    locked = self._try_lock_many(available, count)
+
+                if locked:
+                    wait_time = time.time() - start
+                    for device in locked:
+                        self._wait_times[device.dev_id] = wait_time
+                        device_statistics.record_reservation(
+                            device,
+                            self._args.priority,
+                            wait_time)
+                    logger.info("Acquired " + ", ".join(
+                        [device.name for device in locked]) + " after " +
+                        "waiting " + str(round(wait_time, 3)) + " seconds.")
+                    return locked, wait_time
+
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+
+                logger.info("All devices busy ... waiting for a device to " +
+                            "be released.")
+                # Processes that die while holding a lock cannot notify us,
+                # so we still need to wake up every now and then
+                queue.wait(min(remaining, self._FALLBACK_POLL_INTERVAL))
+        finally:
+            if queue:
+                queue.close()
+                # Our ticket may have been blocking younger waiters
+                reservation_queue.notify_waiters()
+
         raise errors.AFTTimeoutError("Could not reserve " + name +
                                      " in " + str(timeout) + " seconds.")
 
+    def _try_lock_many(self, devices, count):
+        """
+        Try to lock count devices without blocking, all or nothing.
+
+        Several devices are locked in device id order, the same global order
+        every process uses, and no lock is ever waited for while holding
+        others, so concurrent gang reservations cannot deadlock. The count
+        most preferred devices are tried first.
+
+        Args:
+            devices (list(aft.Device)):
+                The candidate devices, most preferred first
+            count (integer): Number of devices to lock
+
+        Returns:
+            (list(aft.Device)): The locked devices, or an empty list if not
+            enough devices could be locked
+        """
+        if count > 1:
+            devices = (
+                sorted(devices[:count], key=lambda device: device.dev_id) +
+                sorted(devices[count:], key=lambda device: device.dev_id))
+
+        locked = []
+        for device in devices:
+            if self._try_lock(device):
+                locked.append(device)
+                if len(locked) == count:
+                    break
+        else:
+            # Nothing was reserved, so there is nobody to wake up. Notifying
+            # here would also wake ourselves and spin the reservation loop.
+            for device in locked:
+                self._unlock(device)
+            return []
+
+        # Long running processes sharing a device pool release their devices
+        # themselves. An exit hook per reservation would keep every device
+        # manager alive until the process exits.
+        if self._device_pool is None:
+            for device in locked:
+                atexit.register(self.release, device)
+        return locked
+
+    def _try_lock(self, device):
+        """
+        Try to lock the device without blocking.
+
+        Args:
+            device (aft.Device): The device that will be locked
+
+        Returns:
+            True if the device was locked, False if it is busy
+        """
+        logger.info("Attempting to acquire " + device.name)
+        path = os.path.join(config.LOCK_FILE, "aft_" + device.dev_id)
+        lockfile = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT, 0660), "w")
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            lockfile.close()
+            if err.errno in {errno.EACCES, errno.EAGAIN}:
+                logger.info("Device busy.")
+                return False
+            else:
+                logger.critical("Cannot obtain lock file.")
+                sys.exit(-1)
+
+        # The previous holder unlinks the lock file on release. If that
+        # happened between our open and flock, we locked an orphaned file.
+        try:
+            same_file = os.fstat(lockfile.fileno()).st_ino == os.stat(path).st_ino
+        except OSError:
+            same_file = False
+
+        if not same_file:
+            logger.info("Lock file was replaced while locking.")
+            lockfile.close()
+            return False
+
+        self._lockfiles.append((device.dev_id, lockfile))
+        return True
+
+    def has_free_device(self, model):
+        """
+        Check whether a device of the model is free right now. The answer
+        is only a hint, as the device may be taken by the time it is
+        reserved.
+
+        Args:
+            model (str): Device model
+
+        Returns:
+            True if a non-blacklisted device of the model is not reserved
+        """
+        broker = self._get_broker()
+        if broker:
+            return any(device["model"].lower() == model.lower() and
+                       device["state"] == "free"
+                       for device in broker.status()["devices"])
+
+        device_blacklist = self._construct_blacklist()
+        for device_config in self.device_configs:
+            dev_id = device_config["settings"]["id"]
+            if device_config["model"].lower() != model.lower() or \
+                    dev_id in device_blacklist:
+                continue
+
+            path = os.path.join(config.LOCK_FILE, "aft_" + dev_id)
+            try:
+                lockfile = open(path, "r")
+            except IOError as err:
+                if err.errno == errno.ENOENT:
+                    # Lock files are removed on release
+                    return True
+                continue
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                pass
+            finally:
+                lockfile.close()
+        return False
+
+    def is_preempted(self, device):
+        """
+        Check whether a waiter of higher priority than this manager's
+        reservations is waiting for the device. Preemptible jobs poll this
+        at safe points and give up the device if it returns True.
+
+        Args:
+            device (aft.Device): A device reserved by this manager
+
+        Returns:
+            True if the device should be given up
+        """
+        if device.dev_id in self._broker_devices:
+            return self._broker.is_preempted(device.name)
+        return reservation_queue.has_higher_priority_waiter(
+            device.dev_id,
+            self._args.priority)
+
+    def get_wait_time(self, device):
+        """
+        Return the time spent waiting for the reservation of the device
+
+        Args:
+            device (aft.Device): A device reserved by this manager
+
+        Returns:
+            (float or None): Wait time in seconds, or None if the device was
+            not reserved through this manager
+        """
+        return self._wait_times.get(device.dev_id)
+
 
-    def _remove_blacklisted_devices(self, devices):
+    def _remove_blacklisted_devices(self, devices, reported=None):
         """
         Remove blacklisted devices from the device list
 
         Args:
             List of devices
+            reported (set(str) or None):
+                Ids of the devices whose removal has already been reported.
+                Updated in place. If None, every removal is reported.
 
         Returns:
             Filtered list of devices
         """
+        if reported is None:
+            reported = set()
+
         _device_blacklist = self._construct_blacklist()
 
         filtered_devices = []
 
         for device in devices:
-            for blacklisted_device in _device_blacklist:
-                if blacklisted_device["id"] == device.dev_id:
-                    msg = ("Removed blacklisted device " +
-                            blacklisted_device["name"] + " from device pool " +
-                            "(Reason: " + blacklisted_device["reason"] + ")")
-
-                    logger.info(msg)
-                    print(msg)
-                    break
-            else: # else clause for the for loop
+            blacklisted_device = _device_blacklist.get(device.dev_id)
+            if not blacklisted_device:
                 filtered_devices.append(device)
+                continue
+
+            if device.dev_id not in reported:
+                msg = ("Removed blacklisted device " +
+                        blacklisted_device["name"] + " from device pool " +
+                        "(Reason: " + blacklisted_device["reason"] + ")")
+
+                logger.info(msg)
+                print(msg)
+                reported.add(device.dev_id)
 
         return filtered_devices
 
@@ -280,21 +778,53 @@ class DevicesManager(object):
         the process dies, but this removes the stale lockfile.
         """
 
-        lockfile = None
+        if not reserved_device:
+            return
+
+        if reserved_device.dev_id in self._broker_devices:
+            self._broker_devices.discard(reserved_device.dev_id)
+            self._broker.release(reserved_device.name)
+            return
+
+        if self._unlock(reserved_device):
+            reservation_queue.notify_waiters()
+
+    def _unlock(self, device):
+        """
+        Remove the lock file of the device and unlock it, without waking up
+        the waiters.
+
+        Args:
+            device (aft.Device): The device that will be unlocked
+
+        Returns:
+            True if the device was locked by this manager, False otherwise
+        """
         for i in self._lockfiles:
-            if i[0] == reserved_device.dev_id:
+            if i[0] == device.dev_id:
+                # Unlink while still holding the lock, so that nobody can
+                # lock the file we are about to remove
+                path = os.path.join(config.LOCK_FILE, "aft_" + device.dev_id)
+
+                if os.path.isfile(path):
+                    os.unlink(path)
+
                 i[1].close()
                 self._lockfiles.remove(i)
-                break
+                return True
+        return False
 
-        if reserved_device:
-            path = os.path.join(
-                config.LOCK_FILE,
-                "aft_" + reserved_device.dev_id)
-
-            if os.path.isfile(path):
-                os.unlink(path)
 
+    def close(self):
+        """
+        Close the connection to the reservation broker, releasing the devices
+        reserved through it
+        """
+        if self._broker:
+            self._broker.close()
+            self._broker = None
+            self._broker_checked = False
+            self._broker_devices.clear()
 
     def get_configs(self):
         return self.device_configs
@@ -317,12 +847,13 @@ class DevicesManager(object):
         common.blacklist_device(dev_id, device, reason)
 
 
-    def unblacklist_device(self, device):
+    def unblacklist_device(self, device, reason=""):
         """
         Unblacklist a device
 
         Args:
             Device (str): Name of the device
+            reason (str): Reason for unblacklisting
         """
         dev_id = None
 
@@ -331,15 +862,116 @@ class DevicesManager(object):
                 dev_id = config["settings"]["id"]
                 break
 
-        common.unblacklist_device(dev_id)
+        common.unblacklist_device(dev_id, reason)
 
     def blacklist_print(self):
         """
-        Print the contents of the blacklist file
+        Print the contents of the blacklist
+        """
+        entries = sorted(
+            self._construct_blacklist().values(),
+            key=lambda entry: entry["timestamp"])
+
+        if len(entries) < 1:
+            print("Blacklist is empty")
+            return
+
+        for entry in entries:
+            print(entry["id"] + " " + entry["name"] + " " + entry["reason"] +
+                  " (" + misc.format_time(entry["timestamp"]) + ")")
+
+    def blacklist_history_print(self, device=None):
+        """
+        Print the blacklisting history
+
+        Args:
+            device (str or None): Print only the history of this device
         """
-        with open(config.DEVICE_BLACKLIST, "r") as blacklist_file:
-            blacklist = blacklist_file.read().strip()
-            if len(blacklist) < 1:
-                print("Blacklist is empty")
+        dev_id = None
+        if device:
+            for config in self.device_configs:
+                if config["name"].lower() == device.lower():
+                    dev_id = config["settings"]["id"]
+                    break
+            else:
+                print("Unknown device " + device)
+                return
+
+        history = blacklist.get_history(dev_id)
+        if len(history) < 1:
+            print("Blacklist history is empty")
+            return
+
+        for event in history:
+            print(misc.format_time(event["timestamp"]) + " " +
+                  event["action"] + " " + event["id"] + " " + event["name"] +
+                  " " + event["reason"])
+
+    def statistics_print(self):
+        """
+        Print the statistics of every device, the reservation wait times
+        of every priority class, the image affinity hit rate and the boot
+        wait times of every boot profile
+        """
+        statistics = device_statistics.get_statistics(
+            [device_config["settings"]["id"]
+             for device_config in self.device_configs])
+
+        print("Statistics of the " + str(device_statistics.RECENT_EVENTS) +
+              " most recent flashings and test runs:")
+        for device_config in self.device_configs:
+            device = statistics[device_config["settings"]["id"]]
+
+            if device["last_reserved"]:
+                last_reserved = misc.format_time(device["last_reserved"])
+            else:
+                last_reserved = "never"
+
+            if device["flash_time"] is not None:
+                flash_time = str(round(device["flash_time"], 1)) + " s"
             else:
-                print(blacklist)
+                flash_time = "-"
+
+            print(device_config["name"] + " (" + device_config["model"] + "): " +
+                  "last reserved " + last_reserved + ", " +
+                  str(device["flash_failures"]) + "/" + str(device["flashes"]) +
+                  " flashings failed, mean flash time " + flash_time + ", " +
+                  str(device["test_failures"]) + "/" + str(device["tests"]) +
+                  " test runs failed")
+
+        since = time.time() - self._WAIT_STATISTICS_PERIOD
+        wait_statistics = device_statistics.get_wait_statistics(since)
+        print("Reservation wait times during the last " +
+              str(self._WAIT_STATISTICS_PERIOD / 3600) + " hours:")
+        for priority in reservation_queue.PRIORITY_CLASSES:
+            if priority not in wait_statistics:
+                continue
+            waits = wait_statistics[priority]
+            print(priority + ": " + str(waits["reservations"]) +
+                  " reservations, mean " + str(round(waits["mean"], 1)) +
+                  " s, median " + str(round(waits["median"], 1)) +
+                  " s, max " + str(round(waits["max"], 1)) + " s")
+
+        affinity = image_state.get_affinity_statistics(since)
+        print("Image affinity during the last " +
+              str(self._WAIT_STATISTICS_PERIOD / 3600) + " hours:")
+        if affinity["reservations"]:
+            hit_rate = 100.0 * affinity["hits"] / affinity["reservations"]
+            print(str(affinity["hits"]) + "/" +
+                  str(affinity["reservations"]) + " reservations got a " +
+                  "device already holding the image (" +
+                  str(round(hit_rate, 1)) + " %)")
+        print(str(affinity["skips"]) + " flashings skipped, saving an " +
+              "estimated " + str(round(affinity["saved_time"] / 60, 1)) +
+              " minutes")
+
+        boots = boot_statistics.get_statistics(since)
+        print("Boot waits during the last " +
+              str(self._WAIT_STATISTICS_PERIOD / 3600) + " hours:")
+        for profile in sorted(boots):
+            boot = boots[profile]
+            print(profile + ": " + str(boot["failures"]) + "/" +
+                  str(boot["boots"]) + " boots failed, mean wait " +
+                  str(round(boot["mean_wait"], 1)) + " s, " +
+                  str(round(boot["time_saved"], 1)) + " s saved by learned " +
+                  "probing")
@@ -50,3 +50,15 @@ class AFTPotentiallyBrokenBootloader(Exception):
     Device might have a broken bootloader
     """
     pass
+
+class AFTPreemptedError(Exception):
+    """
+    Test run gave up its device to a higher priority reservation
+    """
+    pass
+
+class AFTCancelledError(Exception):
+    """
+    Operation was cancelled
+    """
+    pass
@@ -32,10 +32,12 @@ class Logger(object):
     Logger class for holding logging methods and variables
 
     THREADS: Dictionary with threads filename prefixes
+    LOGGERS: Dictionary with the names of each threads loggers
     LOGGING_LEVEL: Logging level threshold for new loggers
     '''
 
     THREADS = {}
+    LOGGERS = {}
     LOGGING_LEVEL = logging.INFO
 
     @staticmethod
@@ -69,6 +71,31 @@ class Logger(object):
         '''
         Logger.THREADS[current_thread().name] = log_prefix
 
+    @staticmethod
+    def close_thread():
+        '''
+        Close threads log files and remove its filename prefix from dictionary.
+        Long running processes, such as the worker daemon, call this when a
+        thread has finished, so that its file handlers are not left open.
+        '''
+        thread_name = current_thread().name
+        for name in Logger.LOGGERS.pop(thread_name, []):
+            logger = logging.getLogger(name)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+            # Forget the logger too, as thread names are not reused. Logger
+            # names contain dots (aft.log), so logging has made placeholders
+            # for their parents.
+            logger_dict = logging.Logger.manager.loggerDict
+            logger_dict.pop(name, None)
+            parent = name.rpartition(".")[0]
+            if isinstance(logger_dict.get(parent), logging.PlaceHolder):
+                logger_dict[parent].loggerMap.pop(logger, None)
+                if not logger_dict[parent].loggerMap:
+                    del logger_dict[parent]
+        Logger.THREADS.pop(thread_name, None)
+
     @staticmethod
     def get_logger(filename):
         '''
@@ -142,3 +169,5 @@ class Logger(object):
         handler.setFormatter(formatter)
         logger.addHandler(handler)
         logger.propagate = False #Don't pass anything to parent logger (root)
+        Logger.LOGGERS.setdefault(current_thread().name, []).append(
+            logger.name)
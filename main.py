@@ -24,6 +24,7 @@ import argparse
 import logging
 
 import aft.config as config
+import aft.errors as errors
 import aft.tools.device_configuration_checker as device_config
 from aft.logger import Logger as logger
 import aft.devices.common as common
@@ -31,6 +32,13 @@ from aft.tools.thread_handler import Thread_handler as thread_handler
 from aft.tools.topology_builder import TopologyBuilder
 from aft.tools.edison_recovery_flasher import recover_edisons
 from aft.devicesmanager import DevicesManager
+from aft.tools.reservation_broker import ReservationBroker, format_status
+import aft.tools.selection_policies as selection_policies
+import aft.tools.reservation_queue as reservation_queue
+import aft.tools.federation as federation
+import aft.tools.image_state as image_state
+from aft.tools.parallel_flasher import flash_parallel
+from aft.tools.worker import Worker, submit_job
 from aft.tester import Tester
 
 
@@ -95,17 +103,52 @@ def main(argv=None):
             if not args.device:
                 print("Device must be specified for unblacklisting")
                 return 1
-            device_manager.unblacklist_device(args.device)
+            device_manager.unblacklist_device(args.device, args.reason)
             return 0
 
         if args.blacklist_print:
             device_manager.blacklist_print()
             return 0
 
+        if args.blacklist_history:
+            device_manager.blacklist_history_print(args.device)
+            return 0
+
+        if args.statistics:
+            device_manager.statistics_print()
+            return 0
+
         if args.recover_edisons:
             recover_edisons(device_manager, args.verbose)
             return 0
 
+        if args.broker:
+            ReservationBroker(device_manager).serve_forever()
+            return 0
+
+        if args.broker_status:
+            print(format_status(device_manager.status()))
+            return 0
+
+        if args.serve:
+            Worker(args).serve_forever()
+            return 0
+
+        if args.coordinator:
+            federation.FederationCoordinator(
+                config.FEDERATION_BIND_ADDRESS,
+                int(config.FEDERATION_PORT)).serve_forever()
+            return 0
+
+        if args.federation_status:
+            client = federation.FederationClient.connect()
+            if not client:
+                print("Federation coordinator is not available")
+                return 1
+            print(federation.format_status(client.status()))
+            client.close()
+            return 0
+
         if not args.machine:
             print("Both machine and image must be specified")
             return 1
@@ -120,14 +163,49 @@ def main(argv=None):
                 logger.error("Didn't find image: " + args.file_name)
                 return 1
 
-        if args.device:
-            device, tester = try_flash_specific(args, device_manager)
-        else:
-            device, tester = try_flash_model(args, device_manager)
+        if args.submit:
+            if args.record or args.parallel:
+                print("--record and --parallel cannot be used with --submit")
+                return 1
+            return submit_job(args)
+
+        if args.parallel:
+            if args.device:
+                print("--parallel cannot be used with --device")
+                return 1
+            return flash_parallel(args, device_manager)
+
+        if args.federate and not args.device and \
+                not device_manager.has_free_device(args.machine):
+            host = federation.find_remote_host(args.machine)
+            if host:
+                return_code = federation.run_remote_job(host, args)
+                if return_code is not None:
+                    return return_code
+                print("Running the job on " + host + " failed, waiting " +
+                      "for a local device")
+
+        while True:
+            if args.device:
+                device, tester = try_flash_specific(args, device_manager)
+            else:
+                device, tester = try_flash_model(args, device_manager)
+
+            if args.notest:
+                break
+
+            preemption_check = None
+            if args.preemptible:
+                preemption_check = lambda: device_manager.is_preempted(device)
 
-        if not args.notest:
             print("Testing " + str(device.name) + ".")
-            tester.execute()
+            try:
+                tester.execute(preemption_check)
+                break
+            except errors.AFTPreemptedError as err:
+                print(str(err) + ", requeuing the job")
+                logger.info(str(err) + ", requeuing the job")
+                device_manager.release(device)
 
         if not args.nopoweroff:
             device.detach()
@@ -165,14 +243,14 @@ def try_flash_specific(args, device_manager):
         device, tester: Reserved machine and tester handles.
     '''
     device = device_manager.reserve_specific(args.device, model=args.machine)
-    tester = Tester(device)
+    tester = Tester(device, test_plan_name=args.test_plan)
 
     if args.record:
         device.record_serial()
 
     if not args.noflash:
         print("Flashing " + str(device.name) + ".")
-        device.write_image(args.file_name)
+        device.write_image(args.file_name, force=args.force_flash)
         print("Flashing successful.")
 
     return device, tester
@@ -191,12 +269,13 @@ def try_flash_model(args, device_manager):
     '''
     machine_attempt = 0
     machine_retries = args.machine_retries
+    image_hash = image_state.get_requested_image_hash(args)
 
     while machine_attempt < machine_retries:
         machine_attempt += 1
 
-        device = device_manager.reserve()
-        tester = Tester(device)
+        device = device_manager.reserve(image_hash=image_hash)
+        tester = Tester(device, test_plan_name=args.test_plan)
 
         if args.record:
             device.record_serial()
@@ -213,7 +292,7 @@ def try_flash_model(args, device_manager):
             try:
                 print("Flashing " + str(device.name) + ", attempt " +
                     str(flash_attempt) + " of " + str(flash_retries) + ".")
-                device.write_image(args.file_name)
+                device.write_image(args.file_name, force=args.force_flash)
                 print("Flashing successful.")
                 return device, tester
 
@@ -302,6 +381,23 @@ def parse_args():
         default="2",
         help="Specify how many time flashing one machine will be tried.")
 
+    parser.add_argument(
+        "--test_plan",
+        action="store",
+        default=None,
+        help=("Test plan to run instead of the default test plan of the "
+            "device, without the .cfg suffix"))
+
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        action="store",
+        default=0,
+        metavar="N",
+        help=("Reserve N devices of the model and flash and test all of them "
+            "at the same time. Each device gets its own logs; the results "
+            "are merged into results.xml"))
+
     parser.add_argument(
         "--record",
         action="store_true",
@@ -315,6 +411,14 @@ def parse_args():
         default=False,
         help="Skip device flashing")
 
+    parser.add_argument(
+        "--force_flash",
+        action="store_true",
+        default=False,
+        help=("Flash the image even if the device already holds it. By "
+            "default flashing is skipped when the image on the device is "
+            "verified to be the same"))
+
     parser.add_argument(
         "--notest",
         action="store_true",
@@ -384,11 +488,88 @@ def parse_args():
         action="store_true",
         help="Print the contents of the blacklist")
 
+    parser.add_argument(
+        "--blacklist_history",
+        action="store_true",
+        help=("Print the blacklisting history. Can be limited to a single "
+            "device with --device"))
+
+    parser.add_argument(
+        "--selection_policy",
+        action="store",
+        choices=selection_policies.get_policy_names(),
+        default=config.SELECTION_POLICY,
+        help=("How to choose between free devices of the model: topology "
+            "order, least recently used, fastest flashing or lowest recent "
+            "failure rate. Default: " + config.SELECTION_POLICY))
+
+    parser.add_argument(
+        "--priority",
+        action="store",
+        choices=reservation_queue.PRIORITY_CLASSES,
+        default=config.RESERVATION_PRIORITY,
+        help=("Reservation priority class. Free devices go to the highest "
+            "priority waiter first. Default: " + config.RESERVATION_PRIORITY))
+
+    parser.add_argument(
+        "--preemptible",
+        action="store_true",
+        help=("Give up the device between test cases if a higher priority "
+            "reservation is waiting for it. The job is requeued and flashed "
+            "again once a device is available."))
+
+    parser.add_argument(
+        "--federate",
+        action="store_true",
+        help=("If no device of the model is free on this host, run the job "
+            "on another host of the federation that has one"))
+
+    parser.add_argument(
+        "--coordinator",
+        action="store_true",
+        help=("Run the federation coordinator, which collects the device "
+            "inventories of the federated hosts and routes jobs between "
+            "them"))
+
+    parser.add_argument(
+        "--federation_status",
+        action="store_true",
+        help="Print the devices of every host in the federation")
+
+    parser.add_argument(
+        "--statistics",
+        action="store_true",
+        help="Print the flashing and testing statistics of every device")
+
     parser.add_argument(
         "--recover_edisons",
         action="store_true",
         help="Lock all Edisons and recover blacklisted ones")
 
+    parser.add_argument(
+        "--broker",
+        action="store_true",
+        help=("Run the reservation broker. While the broker is running, "
+            "device reservations go through it"))
+
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help=("Run the AFT worker daemon, which keeps the configurations and "
+            "device objects loaded and runs jobs submitted with --submit"))
+
+    parser.add_argument(
+        "--submit",
+        action="store_true",
+        help=("Run the job on the AFT worker daemon instead of in this "
+            "process. Progress is printed as the job runs and the results "
+            "are saved into results.xml"))
+
+    parser.add_argument(
+        "--broker_status",
+        action="store_true",
+        help="Print the reservation state of the devices from the broker")
+
     return parser.parse_args()
 
 if __name__ == "__main__":
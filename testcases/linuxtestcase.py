@@ -16,6 +16,7 @@ Linux Test Case class.
 """
 
 import os
+import subprocess32
 
 from aft.logger import Logger as logger
 from aft.testcases.unixtestcase import UnixTestCase
@@ -56,27 +57,31 @@ class LinuxTestCase(UnixTestCase):
 
     def _deploy_file(self, payload, user, timeout, device):
         """
-        Deploys a file to the target device.
+        Deploys a file or a directory to the target device. The content is
+        only transferred if the device does not already hold it, see
+        aft.tools.payload_cache.
         """
         #  Test for presence of the file
         full_path_to_payload = os.path.join(self._TEST_DATA_PATH, payload)
-        if not os.path.isfile(full_path_to_payload):
+        if not os.path.exists(full_path_to_payload):
             self.output = "Error: media file \"{0}\" not found.".\
                 format(full_path_to_payload)
             return False
-        #  Push the file to the device
-        self.output = device.push(source=full_path_to_payload,
-                                  destination=self._DUT_TMP,
-                                  user=user)
-        if self.output != None:
-            logger.critical("Couldn't copy " + str(full_path_to_payload) + " to " +
-                             str(self._DUT_TMP) + ".\n" + str(self.output)
-                             .format(full_path_to_payload, self._DUT_TMP,
-                                     self.output))
+        #  Push the file to the device. The cache on the device belongs to
+        #  root; the ownership is handed to the user below.
+        try:
+            device.push_payload(full_path_to_payload, self._DUT_TMP,
+                                user="root")
+        except (subprocess32.CalledProcessError,
+                subprocess32.TimeoutExpired) as err:
+            self.output = str(err) + "\n" + str(err.output)
+            logger.critical("Couldn't copy " + str(full_path_to_payload) +
+                            " to " + str(self._DUT_TMP) + ".\n" +
+                            self.output)
             return False
         self.output = device.execute(
             environment=self._MEDIA_ENV,
-            command=('chown', '-R', self.user,
+            command=('chown', '-R', user,
                      os.path.join(self._DUT_TMP, payload)),
             user="root", timeout=timeout)
         return True
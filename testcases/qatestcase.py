@@ -49,7 +49,7 @@ class QATestCase(BasicTestCase):
                           }
 
     def run(self, device):
-        ip_address = device.get_ip()
+        ip_address = device.get_session_ip()
 
         # Append --target-ip parameter
         if not "--target-ip" in self.parameters:
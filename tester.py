@@ -19,71 +19,153 @@ Class implementing a Tester interface.
 import os
 import time
 import ConfigParser
+from xml.sax.saxutils import quoteattr
 
 from aft.logger import Logger as logger
 import aft.errors as errors
 import aft.testcasefactory
+import aft.tools.config_cache as config_cache
+import aft.tools.device_statistics as device_statistics
+import aft.tools.payload_cache as payload_cache
 
 class Tester(object):
     """
     Class representing a Tester interface.
     """
 
-    def __init__(self, device):
+    def __init__(self, device, results_file_name="results.xml",
+                 test_plan_name=None):
         self._device = device
+        self._results_file_name = results_file_name
         self.test_cases = []
         self._results = []
         self._start_time = None
         self._end_time = None
 
-        test_plan_name = device.test_plan
-        test_plan_file = os.path.join("/etc/aft/test_plan/", device.test_plan + ".cfg")
-        test_plan_config = ConfigParser.SafeConfigParser()
-        test_plan_config.read(test_plan_file)
+        test_plan_name = test_plan_name or device.test_plan
+        test_plan_file = os.path.join("/etc/aft/test_plan/", test_plan_name + ".cfg")
+        test_plan = config_cache.load(
+            "test_plan",
+            [test_plan_file],
+            lambda: self._parse_test_plan(test_plan_file))
 
-        if len(test_plan_config.sections()) == 0:
+        if len(test_plan) == 0:
             raise errors.AFTConfigurationError("Test plan " + str(test_plan_name) +
                                                " (" + str(test_plan_file) + ") doesn't " +
                                                "have any test cases. Does the file exist?")
 
-        for test_case_name in test_plan_config.sections():
-            test_case_config = dict(test_plan_config.items(test_case_name))
-            test_case_config["name"] = test_case_name
+        for test_case_config in test_plan:
             test_case = aft.testcasefactory.build_test_case(test_case_config)
             self.test_cases.append(test_case)
 
         logger.info("Built test plan with " + str(len(self.test_cases)) + " test cases.")
 
 
-    def execute(self):
+    @staticmethod
+    def _parse_test_plan(test_plan_file):
+        """
+        Parse the test plan file
+
+        Args:
+            test_plan_file (str): Path to the test plan file
+
+        Returns:
+            List of test case configuration dictionaries, in the order the
+            test cases appear in the file
+        """
+        test_plan_config = ConfigParser.SafeConfigParser()
+        test_plan_config.read(test_plan_file)
+
+        test_plan = []
+        for test_case_name in test_plan_config.sections():
+            test_case_config = dict(test_plan_config.items(test_case_name))
+            test_case_config["name"] = test_case_name
+            test_plan.append(test_case_config)
+        return test_plan
+
+    def execute(self, preemption_check=None):
         """
         Execute the test plan.
+
+        Args:
+            preemption_check (function or None):
+                Function without arguments, called between test cases. If it
+                returns True, the test run is abandoned so that the device can
+                be given to a higher priority reservation.
+
+        Raises:
+            aft.errors.AFTPreemptedError if the test run was preempted
         """
         logger.info("Executing the test plan")
         self._start_time = time.time()
         logger.info("Test plan start time: " + str(self._start_time))
 
-        for index, test_case in enumerate(self.test_cases, 1):
-            logger.info("Executing test case " + str(index) + " of " + str(self.test_cases))
-            test_case.execute(self._device)
-            self._results.append(test_case.result)
+        try:
+            for index, test_case in enumerate(self.test_cases, 1):
+                if preemption_check and preemption_check():
+                    raise errors.AFTPreemptedError(
+                        "Test run on " + self._device.name + " preempted " +
+                        "by a higher priority reservation after " +
+                        str(index - 1) + " test cases")
+
+                logger.info("Executing test case " + str(index) + " of " + str(self.test_cases))
+                test_case.execute(self._device)
+                self._results.append(test_case.result)
+        except errors.AFTPreemptedError:
+            # Says nothing about the device
+            raise
+        except:
+            device_statistics.record_event(
+                self._device,
+                device_statistics.TEST,
+                False,
+                time.time() - self._start_time)
+            raise
+        finally:
+            payloads = payload_cache.pop_statistics()
 
         self._end_time = time.time()
+        device_statistics.record_event(
+            self._device,
+            device_statistics.TEST,
+            all(self._results),
+            self._end_time - self._start_time)
         logger.info("Test plan end time: " + str(self._end_time))
+        if payloads["pushes"]:
+            logger.info("Test data pushes: " + str(payloads["pushes"]) +
+                        ", " + str(payloads["bytes_transferred"]) +
+                        " bytes transferred, " +
+                        str(payloads["bytes_skipped"]) +
+                        " bytes skipped as already cached on the device")
         self._save_test_results()
 
     def _results_to_xunit(self):
         """
         Return test results formatted in xunit XML
         """
-        xml = [('<?xml version="1.0" encoding="utf-8"?>\n'
-                '<testsuite errors="0" failures="{0}" '
+        return ('<?xml version="1.0" encoding="utf-8"?>\n' +
+                self.get_xunit_testsuite())
+
+    def get_xunit_testsuite(self, name=None):
+        """
+        Return the xunit testsuite element of the test results
+
+        Args:
+            name (str or None):
+                Name of the testsuite. Defaults to aft.<start time>.<pid>
+
+        Returns:
+            (str): The testsuite element
+        """
+        if not name:
+            name = "aft.{0}.{1}".format(
+                time.strftime("%Y%m%d%H%M%S", time.localtime(self._start_time)),
+                os.getpid())
+
+        xml = [('<testsuite errors="0" failures="{0}" '
                 .format(len([test_case for test_case in self.test_cases
                              if not test_case.result])) +
-                'name="aft.{0}.{1}" skips="0" '
-                .format(time.strftime("%Y%m%d%H%M%S",
-                                      time.localtime(self._start_time)),
-                        os.getpid()) +
+                'name={0} skips="0" '.format(quoteattr(name)) +
                 'tests="{0}" time="{1}">\n'
                 .format(len(self._results),
                         self._end_time - self._start_time))]
@@ -92,13 +174,11 @@ class Tester(object):
         xml.append('</testsuite>\n')
         return "".join(xml)
 
-# pylint: disable=no-self-use
     def get_results_location(self):
         """
         Returns the file path of the results xml-file.
         """
-        return os.path.join(os.getcwd(), "results.xml")
-#pylint: enable=no-self-use
+        return os.path.join(os.getcwd(), self._results_file_name)
 
     def _save_test_results(self):
         """
@@ -119,3 +199,25 @@ class Tester(object):
         for test_case in self.test_cases:
             arr.append(test_case.xunit_section)
         return "".join(arr)
+
+
+def save_merged_results(testsuites, results_file_name="results.xml"):
+    """
+    Store the results of several test runs as a single xunit report
+
+    Args:
+        testsuites (list(str)): xunit testsuite elements
+        results_file_name (str): Report file name in the working directory
+
+    Returns:
+        (str): Path of the report
+    """
+    results_location = os.path.join(os.getcwd(), results_file_name)
+    with open(results_location, "w") as results_file:
+        results_file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        results_file.write('<testsuites>\n')
+        for testsuite in testsuites:
+            results_file.write(testsuite)
+        results_file.write('</testsuites>\n')
+    logger.info("Merged results saved to " + results_location + ".")
+    return results_location
@@ -0,0 +1,278 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Device blacklist, stored in an SQLite database.
+
+Every change is a single transaction, so concurrent AFT processes can add and
+remove entries safely. Besides the current blacklist, the database keeps the
+history of every blacklisting and unblacklisting with reasons and timestamps.
+
+Entries of the old flat blacklist file (config.DEVICE_BLACKLIST) are imported
+when the database is created.
+"""
+
+import os
+import time
+import contextlib
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.tools.database as database
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blacklist (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    action TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_id ON history (id, timestamp);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+@contextlib.contextmanager
+def _transaction():
+    """
+    Context manager that opens the database and runs the block inside a
+    write transaction.
+
+    Yields:
+        sqlite3.Connection: The database connection
+    """
+    connection = _connect()
+    try:
+        with database.transaction(connection):
+            yield connection
+    finally:
+        connection.close()
+
+
+def _connect():
+    """
+    Open the database, creating it if necessary
+
+    Returns:
+        sqlite3.Connection: The database connection
+    """
+    connection = database.connect(config.DEVICE_BLACKLIST_DB, _SCHEMA)
+    _import_legacy_blacklist(connection)
+    return connection
+
+
+def _import_legacy_blacklist(connection):
+    """
+    Import the entries of the old flat blacklist file, once
+
+    Args:
+        connection (sqlite3.Connection): The database connection
+
+    Returns:
+        None
+    """
+    if connection.execute(
+            "SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone():
+        return
+
+    with database.transaction(connection):
+        # Someone else may have imported the file while we waited for the lock
+        if not connection.execute(
+                "SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone():
+
+            timestamp = time.time()
+            if os.path.isfile(config.DEVICE_BLACKLIST):
+                with open(config.DEVICE_BLACKLIST, "r") as blacklist_file:
+                    for line in blacklist_file:
+                        values = line.split()
+                        if len(values) < 2:
+                            continue
+                        logger.info("Importing blacklist entry for " + values[1])
+                        _insert(
+                            connection,
+                            values[0],
+                            values[1],
+                            " ".join(values[2:]),
+                            timestamp)
+
+            connection.execute(
+                "INSERT INTO meta (key, value) VALUES ('legacy_imported', 1)")
+
+
+def _insert(connection, dev_id, name, reason, timestamp):
+    """
+    Add or replace a blacklist entry and record it in the history. Must be
+    called inside a transaction.
+
+    Args:
+        connection (sqlite3.Connection): The database connection
+        dev_id (str): The device id
+        name (str): The human readable device name
+        reason (str): Reason for blacklisting
+        timestamp (float): Time of blacklisting
+
+    Returns:
+        None
+    """
+    connection.execute(
+        "INSERT OR REPLACE INTO blacklist (id, name, reason, timestamp) "
+        "VALUES (?, ?, ?, ?)",
+        (dev_id, name, reason, timestamp))
+    connection.execute(
+        "INSERT INTO history (id, name, action, reason, timestamp) "
+        "VALUES (?, ?, 'blacklist', ?, ?)",
+        (dev_id, name, reason, timestamp))
+    _increment_generation(connection)
+
+
+def _increment_generation(connection):
+    """
+    Increment the generation counter that tells readers the blacklist has
+    changed. Must be called inside a transaction.
+
+    Args:
+        connection (sqlite3.Connection): The database connection
+
+    Returns:
+        None
+    """
+    connection.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', "
+        "COALESCE((SELECT value FROM meta WHERE key = 'generation'), 0) + 1)")
+
+
+def add(dev_id, name, reason):
+    """
+    Blacklist a device. Blacklisting an already blacklisted device updates
+    the reason.
+
+    Args:
+        dev_id (str): The device id
+        name (str): The human readable device name
+        reason (str): Reason for blacklisting
+
+    Returns:
+        None
+    """
+    with _transaction() as connection:
+        _insert(connection, dev_id, name, reason, time.time())
+
+
+def remove(dev_id, reason=""):
+    """
+    Remove a device from the blacklist
+
+    Args:
+        dev_id (str): The device id
+        reason (str): Reason for unblacklisting, recorded in the history
+
+    Returns:
+        True if the device was blacklisted, False otherwise
+    """
+    with _transaction() as connection:
+        row = connection.execute(
+            "SELECT name FROM blacklist WHERE id = ?",
+            (dev_id,)).fetchone()
+
+        if not row:
+            return False
+
+        connection.execute("DELETE FROM blacklist WHERE id = ?", (dev_id,))
+        connection.execute(
+            "INSERT INTO history (id, name, action, reason, timestamp) "
+            "VALUES (?, ?, 'unblacklist', ?, ?)",
+            (dev_id, row["name"], reason, time.time()))
+        _increment_generation(connection)
+        return True
+
+
+def get_entries():
+    """
+    Return the current blacklist
+
+    Returns:
+        Dictionary of device id -> entry, where entries have the following
+        format:
+        {
+            "id": "device_id",
+            "name": "device_name",
+            "reason": "reason for blacklisting",
+            "timestamp": time of blacklisting, in seconds since the epoch
+        }
+    """
+    connection = _connect()
+    try:
+        rows = connection.execute(
+            "SELECT id, name, reason, timestamp FROM blacklist").fetchall()
+    finally:
+        connection.close()
+
+    return dict((row["id"], database.row_to_dict(row)) for row in rows)
+
+
+def get_generation():
+    """
+    Return a counter that changes whenever the blacklist changes. Cheaper
+    than get_entries() for checking whether a cached blacklist is still
+    current.
+
+    Returns:
+        (int): The generation counter
+    """
+    connection = _connect()
+    try:
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    finally:
+        connection.close()
+
+    if not row:
+        return 0
+    return row["value"]
+
+
+def get_history(dev_id=None):
+    """
+    Return the blacklisting history, oldest first
+
+    Args:
+        dev_id (str or None): Return only the history of this device
+
+    Returns:
+        List of dictionaries with keys "id", "name", "action" ("blacklist" or
+        "unblacklist"), "reason" and "timestamp"
+    """
+    connection = _connect()
+    try:
+        if dev_id:
+            rows = connection.execute(
+                "SELECT id, name, action, reason, timestamp FROM history "
+                "WHERE id = ? ORDER BY timestamp", (dev_id,)).fetchall()
+        else:
+            rows = connection.execute(
+                "SELECT id, name, action, reason, timestamp FROM history "
+                "ORDER BY timestamp").fetchall()
+    finally:
+        connection.close()
+
+    return [database.row_to_dict(row) for row in rows]
+
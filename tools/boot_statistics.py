@@ -0,0 +1,190 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Boot time history. Every wait for a device to boot is recorded with the time
+the device took to show DHCP activity and to accept ssh connections, per boot
+profile (device model and mode, such as "MinnowboardMAX test"). The history
+of a profile tells common.wait_for_responsive_ip_for_pc_device when to probe
+densely, and how long to wait for DHCP activity before giving up. Stored in
+the state database (config.STATE_DATABASE).
+
+Recording never fails the boot being recorded; database errors are only
+logged.
+"""
+
+import time
+import sqlite3
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.tools.database as database
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS boot_waits (
+    profile TEXT NOT NULL,
+    success INTEGER NOT NULL,
+    lease_time REAL,
+    ready_time REAL,
+    waited REAL NOT NULL,
+    saved REAL NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS boot_waits_profile
+    ON boot_waits (profile, timestamp);
+"""
+
+# Number of most recent successful boots a profile is learned from
+RECENT_BOOTS = 20
+
+# Number of successful boots needed before the history is used
+MIN_BOOTS = 3
+
+# The DHCP activity window is this many times the slowest recent DHCP
+# activity, plus the margin in seconds
+_LEASE_WINDOW_FACTOR = 2
+_LEASE_WINDOW_MARGIN = 30
+
+
+def _connect():
+    """
+    Open the state database, creating it if necessary
+
+    Returns:
+        sqlite3.Connection: The database connection
+    """
+    return database.connect(config.STATE_DATABASE, _SCHEMA)
+
+
+def record_boot(profile, success, lease_time, ready_time, waited, saved):
+    """
+    Record a wait for a device to boot
+
+    Args:
+        profile (str): The boot profile
+        success (boolean): Whether the device became responsive
+        lease_time (float or None):
+            Seconds until DHCP activity was seen, or None if there was none
+        ready_time (float or None):
+            Seconds until the device accepted ssh connections, or None
+        waited (float): Seconds waited in total
+        saved (float): Seconds saved compared to fixed interval polling
+
+    Returns:
+        None
+    """
+    try:
+        connection = _connect()
+        try:
+            connection.execute(
+                "INSERT INTO boot_waits "
+                "(profile, success, lease_time, ready_time, waited, saved, "
+                "timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (profile, int(bool(success)), lease_time, ready_time, waited,
+                 saved, time.time()))
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to record boot statistics: " + str(err))
+
+
+def get_boot_profile(profile):
+    """
+    Return the expected boot timing of a profile, learned from its recent
+    successful boots
+
+    Args:
+        profile (str): The boot profile
+
+    Returns:
+        None if there are fewer than MIN_BOOTS recorded boots, otherwise a
+        dictionary with the following format:
+        {
+            "ready_low": seconds by which the fastest 10% of boots were ready,
+            "ready_high": seconds by which 90% of boots were ready,
+            "lease_window": seconds to wait for DHCP activity, or None if
+                            the history has no DHCP activity times
+        }
+    """
+    try:
+        connection = _connect()
+        try:
+            rows = connection.execute(
+                "SELECT lease_time, ready_time FROM boot_waits "
+                "WHERE profile = ? AND success = 1 "
+                "ORDER BY timestamp DESC LIMIT ?",
+                (profile, RECENT_BOOTS)).fetchall()
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to read boot statistics: " + str(err))
+        return None
+
+    if len(rows) < MIN_BOOTS:
+        return None
+
+    ready_times = sorted(row["ready_time"] for row in rows)
+    lease_times = [row["lease_time"] for row in rows
+                   if row["lease_time"] is not None]
+
+    lease_window = None
+    # A device that was up before the wait started shows no DHCP activity, so
+    # the window is only used if every recent boot showed some
+    if len(lease_times) == len(rows):
+        lease_window = max(lease_times) * _LEASE_WINDOW_FACTOR + \
+            _LEASE_WINDOW_MARGIN
+
+    return {
+        "ready_low": ready_times[len(ready_times) / 10],
+        "ready_high": ready_times[len(ready_times) * 9 / 10],
+        "lease_window": lease_window
+    }
+
+
+def get_statistics(since):
+    """
+    Return boot wait statistics per boot profile
+
+    Args:
+        since (float): Only include boots after this time
+
+    Returns:
+        Dictionary of profile -> statistics, where statistics have the
+        following format:
+        {
+            "boots": number of boot waits,
+            "failures": number of boot waits without a responsive device,
+            "mean_wait": mean time waited in seconds,
+            "time_saved": total seconds saved compared to fixed interval
+                          polling
+        }
+    """
+    connection = _connect()
+    try:
+        rows = connection.execute(
+            "SELECT profile, COUNT(*) AS boots, "
+            "SUM(1 - success) AS failures, AVG(waited) AS mean_wait, "
+            "SUM(saved) AS time_saved FROM boot_waits "
+            "WHERE timestamp > ? GROUP BY profile",
+            (since,)).fetchall()
+    finally:
+        connection.close()
+
+    statistics = {}
+    for row in rows:
+        statistics[row["profile"]] = {
+            "boots": row["boots"],
+            "failures": row["failures"],
+            "mean_wait": row["mean_wait"],
+            "time_saved": row["time_saved"]
+        }
+    return statistics
@@ -0,0 +1,182 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Cache for data built from configuration files, such as the merged device
+configurations and the test plans.
+
+Cached data is kept both in memory, for repeated use within one process, and
+as JSON files in config.CONFIG_CACHE_FOLDER, for use by later processes. A
+cache entry is valid as long as its source files are unchanged: files with
+the recorded modification time and size are trusted as is, other files are
+compared by their SHA-1 hash.
+"""
+
+import os
+import copy
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.tools.misc as misc
+
+_MEMORY_CACHE = {}
+_MEMORY_CACHE_LOCK = threading.Lock()
+
+
+def load(name, source_files, builder):
+    """
+    Return cached data, or build and cache it if the sources have changed.
+
+    Args:
+        name (str): Name of the cached data, e.g. "device_configs"
+        source_files (list(str)): Files the data is built from
+        builder (function):
+            Function without arguments that builds the data. The data must
+            be serializable to JSON.
+
+    Returns:
+        The data. The caller gets its own copy and can modify it freely.
+    """
+    source_files = [os.path.abspath(path) for path in source_files]
+    key = name + ":" + ":".join(source_files)
+    stats = [_stat(path) for path in source_files]
+
+    with _MEMORY_CACHE_LOCK:
+        entry = _MEMORY_CACHE.get(key)
+
+    if entry and entry["stats"] == stats:
+        return copy.deepcopy(entry["data"])
+
+    cache_file = os.path.join(
+        config.CONFIG_CACHE_FOLDER,
+        name + "_" + hashlib.sha1(key).hexdigest() + ".json")
+
+    entry = _load_from_disk(cache_file, source_files, stats)
+    if entry:
+        logger.debug("Using cached " + name + " from " + cache_file)
+    else:
+        logger.debug("Building " + name + " from " + ", ".join(source_files))
+        entry = {
+            "sources": source_files,
+            "stats": stats,
+            "hashes": [_hash(path) for path in source_files],
+            "data": builder()
+        }
+        _save_to_disk(cache_file, entry)
+
+    with _MEMORY_CACHE_LOCK:
+        _MEMORY_CACHE[key] = entry
+
+    return copy.deepcopy(entry["data"])
+
+
+def _stat(path):
+    """
+    Return the modification time and size of a file
+
+    Args:
+        path (str): The file
+
+    Returns:
+        (list or None): [mtime, size], or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            return None
+        raise
+    return [stat.st_mtime, stat.st_size]
+
+
+def _hash(path):
+    """
+    Return the SHA-1 hash of a file
+
+    Args:
+        path (str): The file
+
+    Returns:
+        (str or None): Hex digest, or None if the file does not exist
+    """
+    try:
+        with open(path, "rb") as source:
+            return hashlib.sha1(source.read()).hexdigest()
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _load_from_disk(cache_file, source_files, stats):
+    """
+    Load a cache entry from disk if it is still valid
+
+    Args:
+        cache_file (str): The cache file
+        source_files (list(str)): The source files
+        stats (list): Current _stat() of the source files
+
+    Returns:
+        (dictionary or None): The cache entry, or None if there is no valid
+        entry
+    """
+    try:
+        with open(cache_file, "r") as cache:
+            entry = misc.byteify(json.load(cache))
+    except (IOError, ValueError):
+        return None
+
+    if entry.get("sources") != source_files:
+        return None
+
+    changed = False
+    for index, path in enumerate(source_files):
+        if entry["stats"][index] == stats[index]:
+            continue
+        # Touched, copied or reinstalled files keep their content
+        if entry["hashes"][index] != _hash(path):
+            return None
+        entry["stats"][index] = stats[index]
+        changed = True
+
+    if changed:
+        _save_to_disk(cache_file, entry)
+    return entry
+
+
+def _save_to_disk(cache_file, entry):
+    """
+    Atomically write a cache entry to disk. Failures are not fatal, as the
+    cache is only an optimization.
+
+    Args:
+        cache_file (str): The cache file
+        entry (dictionary): The cache entry
+    """
+    try:
+        directory = os.path.dirname(cache_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temporary_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "w") as cache:
+            json.dump(entry, cache)
+        os.chmod(temporary_path, 0664)
+        os.rename(temporary_path, cache_file)
+    except (IOError, OSError) as err:
+        logger.debug("Could not write configuration cache " + cache_file +
+                     ": " + str(err))
@@ -0,0 +1,97 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Helpers for the SQLite databases shared by all the AFT processes on the host
+(blacklist, device statistics etc.)
+"""
+
+import os
+import sqlite3
+import contextlib
+
+# Seconds to wait for other processes to finish their transactions
+_BUSY_TIMEOUT = 60
+
+
+def connect(path, schema):
+    """
+    Open a database, creating the database and its schema if necessary.
+
+    The connection is in autocommit mode; use transaction() for changes that
+    consist of more than one statement.
+
+    Args:
+        path (str): Path to the database file
+        schema (str): SQL script creating the tables. Must use
+                      "CREATE ... IF NOT EXISTS".
+
+    Returns:
+        sqlite3.Connection: The database connection
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+        os.chmod(directory, 0777)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+    created = not os.path.isfile(path)
+    connection = sqlite3.connect(
+        path,
+        timeout=_BUSY_TIMEOUT,
+        isolation_level=None)
+    connection.text_factory = str
+    connection.row_factory = sqlite3.Row
+
+    if created:
+        os.chmod(path, 0666)
+
+    connection.executescript(schema)
+    return connection
+
+
+@contextlib.contextmanager
+def transaction(connection):
+    """
+    Context manager that runs the block inside a write transaction. The
+    transaction is committed if the block succeeds and rolled back otherwise.
+
+    Args:
+        connection (sqlite3.Connection): Connection returned by connect()
+
+    Yields:
+        sqlite3.Connection: The same connection
+    """
+    # Take the write lock immediately, so that read-modify-write sequences
+    # cannot interleave with other processes
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def row_to_dict(row):
+    """
+    Convert a result row into a dictionary
+
+    Args:
+        row (sqlite3.Row): The row
+
+    Returns:
+        (dictionary): Column name -> value
+    """
+    return dict(zip(row.keys(), row))
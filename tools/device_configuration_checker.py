@@ -17,14 +17,13 @@ Module for device configuration check functionality.
 """
 import os
 import copy
-from Queue import Queue
-from threading import Thread
 from multiprocessing import Process
 from multiprocessing import Queue as multiprocessing_queue
 
 import aft.config as config
 import aft.errors as errors
 import aft.devices.common as common
+import aft.tools.orchestration as orchestration
 from aft.tester import Tester
 from aft.devicesmanager import DevicesManager
 from aft.logger import Logger as logger
@@ -82,50 +81,32 @@ def check_all_parallel(args, configs):
     if args.verbose:
         print("Running parallel configuration check on all devices")
 
-    threads = []
-
-    return_values = Queue()
-
-    def check_wrapper(args, queue):
-        """
-        Wrapper function for check. Calls check and stores the result in a queue
-
-        Args:
-            args (configuration object):
-                Process command line arguments, modified for current device
-
-            queue (multiprocessing.Queue):
-                Queue used to communicate results back to the main thread.
-        """
-        ret = check(args)
-        queue.put((ret, args.device))
-
-
     # IMPORTANT NOTE:
     # Currently (at the time of writing), serial recorder is run in a separate
     # python process, and killed with atexit-handler. These handlers are not
-    # called when Process is joined, so Threads must be used instead
-    for dev_config in configs:
-        device_args = _get_device_args(args, dev_config)
-
-        thread = Thread(
-            target=check_wrapper,
-            args=(device_args, return_values))
-        thread.start()
-        threads.append(thread)
-
-    for thread in threads:
-        thread.join()
-
+    # called when Process is joined, so Threads must be used instead. Tasks
+    # run in threads.
+    tasks = []
+    with orchestration.TaskGroup(cancel_on_error=False) as group:
+        for dev_config in configs:
+            device_args = _get_device_args(args, dev_config)
+            tasks.append(group.spawn(
+                check,
+                (device_args,),
+                name=device_args.device,
+                log_prefix=device_args.device + "_"))
 
     success = True
     result = ""
 
-    while not return_values.empty():
-        item = return_values.get()
+    for task in tasks:
+        try:
+            check_result = task.result()
+        except Exception as err:
+            check_result = (False, "Configuration check failed: " + str(err))
         success, result = _handle_result(
-            item[0],
-            item[1],
+            check_result,
+            task.name,
             success,
             result)
 
@@ -464,7 +445,7 @@ def _run_tests_on_know_good_image(args, device):
             #        os.remove(f)
 
 
-            device.write_image(image)
+            device.write_image(image, force=True)
 
             tester = Tester(device)
             tester.execute()
@@ -0,0 +1,277 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Per-device statistics: reservation times, and the outcome and duration of
+every flashing and test run. Stored in the state database
+(config.STATE_DATABASE) and used by the device selection policies. Also
+records reservation wait times per priority class.
+
+Recording statistics never fails the operation being recorded; database
+errors are only logged.
+"""
+
+import time
+import sqlite3
+import functools
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.tools.database as database
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_events (
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    success INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS device_events_id
+    ON device_events (id, kind, timestamp);
+CREATE TABLE IF NOT EXISTS device_reservations (
+    id TEXT PRIMARY KEY,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reservation_waits (
+    priority TEXT NOT NULL,
+    wait_time REAL NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservation_waits_priority
+    ON reservation_waits (priority, timestamp);
+"""
+
+FLASH = "flash"
+TEST = "test"
+
+# Number of most recent events used for durations and failure rates
+RECENT_EVENTS = 20
+
+
+def _connect():
+    """
+    Open the state database, creating it if necessary
+
+    Returns:
+        sqlite3.Connection: The database connection
+    """
+    return database.connect(config.STATE_DATABASE, _SCHEMA)
+
+
+def record_reservation(device, priority, wait_time):
+    """
+    Record that the device was reserved
+
+    Args:
+        device (aft.Device): The device
+        priority (str): Priority class of the reservation
+        wait_time (float): Seconds spent waiting for the device
+
+    Returns:
+        None
+    """
+    try:
+        connection = _connect()
+        try:
+            with database.transaction(connection):
+                connection.execute(
+                    "INSERT OR REPLACE INTO device_reservations "
+                    "(id, timestamp) VALUES (?, ?)",
+                    (device.dev_id, time.time()))
+                connection.execute(
+                    "INSERT INTO reservation_waits "
+                    "(priority, wait_time, timestamp) VALUES (?, ?, ?)",
+                    (priority, wait_time, time.time()))
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to record reservation statistics: " + str(err))
+
+
+def record_event(device, kind, success, duration):
+    """
+    Record the outcome of an operation on the device
+
+    Args:
+        device (aft.Device): The device
+        kind (str): FLASH or TEST
+        success (boolean): Whether the operation succeeded
+        duration (float): Duration of the operation in seconds
+
+    Returns:
+        None
+    """
+    try:
+        connection = _connect()
+        try:
+            connection.execute(
+                "INSERT INTO device_events "
+                "(id, name, kind, success, duration, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (device.dev_id, device.name, kind, int(bool(success)),
+                 duration, time.time()))
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to record " + kind + " statistics: " + str(err))
+
+
+def records_flash(write_image):
+    """
+    Decorator for Device.write_image implementations. Records the outcome
+    and the duration of flashing, including booting the flashed image.
+
+    Args:
+        write_image (function): The write_image method
+
+    Returns:
+        (function): The decorated method
+    """
+    @functools.wraps(write_image)
+    def _write_image(self, *args, **kwargs):
+        start = time.time()
+        try:
+            result = write_image(self, *args, **kwargs)
+        except:
+            record_event(self, FLASH, False, time.time() - start)
+            raise
+        record_event(self, FLASH, True, time.time() - start)
+        return result
+    return _write_image
+
+
+def get_statistics(dev_ids):
+    """
+    Return the statistics of the devices
+
+    Args:
+        dev_ids (list(str)): The device ids
+
+    Returns:
+        Dictionary of device id -> statistics, where statistics have the
+        following format:
+        {
+            "last_reserved": time of the latest reservation, or None,
+            "flashes": number of recent flashings,
+            "flash_failures": number of failed recent flashings,
+            "flash_time": mean duration of recent successful flashings,
+                          or None,
+            "tests": number of recent test runs,
+            "test_failures": number of failed recent test runs,
+            "failure_rate": failed share of recent flashings and test runs,
+                            or None if there are none
+        }
+    """
+    statistics = {}
+    connection = _connect()
+    try:
+        for dev_id in dev_ids:
+            statistics[dev_id] = _get_device_statistics(connection, dev_id)
+    finally:
+        connection.close()
+    return statistics
+
+
+def _get_device_statistics(connection, dev_id):
+    """
+    Return the statistics of a single device. See get_statistics.
+
+    Args:
+        connection (sqlite3.Connection): The database connection
+        dev_id (str): The device id
+
+    Returns:
+        (dictionary): The statistics
+    """
+    row = connection.execute(
+        "SELECT timestamp FROM device_reservations WHERE id = ?",
+        (dev_id,)).fetchone()
+
+    flashes = _get_recent_events(connection, dev_id, FLASH)
+    tests = _get_recent_events(connection, dev_id, TEST)
+    flash_times = [event["duration"] for event in flashes if event["success"]]
+    flash_failures = len([event for event in flashes if not event["success"]])
+    test_failures = len([event for event in tests if not event["success"]])
+    runs = len(flashes) + len(tests)
+
+    return {
+        "last_reserved": row["timestamp"] if row else None,
+        "flashes": len(flashes),
+        "flash_failures": flash_failures,
+        "flash_time":
+            sum(flash_times) / len(flash_times) if flash_times else None,
+        "tests": len(tests),
+        "test_failures": test_failures,
+        "failure_rate":
+            float(flash_failures + test_failures) / runs if runs else None
+    }
+
+
+def _get_recent_events(connection, dev_id, kind):
+    """
+    Return the most recent events of the given kind
+
+    Args:
+        connection (sqlite3.Connection): The database connection
+        dev_id (str): The device id
+        kind (str): FLASH or TEST
+
+    Returns:
+        (list(sqlite3.Row)): Rows with "success" and "duration", newest first
+    """
+    return connection.execute(
+        "SELECT success, duration FROM device_events "
+        "WHERE id = ? AND kind = ? ORDER BY timestamp DESC LIMIT ?",
+        (dev_id, kind, RECENT_EVENTS)).fetchall()
+
+
+def get_wait_statistics(since):
+    """
+    Return reservation wait times per priority class
+
+    Args:
+        since (float): Only include reservations made after this time
+
+    Returns:
+        Dictionary of priority class -> statistics, where statistics have
+        the following format:
+        {
+            "reservations": number of reservations,
+            "mean": mean wait time in seconds,
+            "median": median wait time in seconds,
+            "max": longest wait time in seconds
+        }
+    """
+    connection = _connect()
+    try:
+        rows = connection.execute(
+            "SELECT priority, wait_time FROM reservation_waits "
+            "WHERE timestamp > ? ORDER BY priority, wait_time",
+            (since,)).fetchall()
+    finally:
+        connection.close()
+
+    wait_times = {}
+    for row in rows:
+        wait_times.setdefault(row["priority"], []).append(row["wait_time"])
+
+    statistics = {}
+    for priority, times in wait_times.items():
+        statistics[priority] = {
+            "reservations": len(times),
+            "mean": sum(times) / len(times),
+            "median": times[len(times) / 2],
+            "max": times[-1]
+        }
+    return statistics
@@ -17,10 +17,11 @@ Edison recovery flasher. Lock all the Edisons, then recover blacklisted
 Edisons one by one.
 """
 
-from time import sleep
-import aft.devicefactory as devicefactory
-import aft.errors as errors
-import aft.config as config
+import aft.tools.reservation_queue as reservation_queue
+import aft.tools.blacklist as blacklist
+
+# Seconds to wait for all the Edisons to become free
+_RESERVATION_TIMEOUT = 24 * 3600
 
 
 def recover_edisons(device_manager, verbose):
@@ -48,32 +49,25 @@ def recover_edisons(device_manager, verbose):
             print("No blacklisted Edisons - doing nothing")
         return
 
-    working_edison_names = list(
-        set(all_edison_names).difference(blacklisted_edison_names))
-
-
     if verbose:
-        print("Locking working edisons")
+        print("Acquiring all Edisons")
 
-    locked_edisons = _lock_working_edisons(
-        device_manager,
-        working_edison_names,
-        verbose)
-
-
-    if verbose:
-        print("Acquiring blacklisted Edisons")
-
-    blacklisted_edisons = _get_blacklisted_edison_devices(
-        device_manager,
-        blacklisted_edison_names)
+    # All or nothing: holding some of the Edisons while waiting for the rest
+    # would block testing without making any progress
+    edisons = device_manager.reserve_many(
+        all_edison_names,
+        timeout=_RESERVATION_TIMEOUT)
 
+    working_edisons = [edison for edison in edisons
+                       if edison.name not in blacklisted_edison_names]
+    blacklisted_edisons = [edison for edison in edisons
+                           if edison.name in blacklisted_edison_names]
 
     if verbose:
         print("Powering down working edisons")
 
     # power down the working edisons
-    for edison in locked_edisons:
+    for edison in working_edisons:
         edison.detach()
 
     if verbose:
@@ -94,8 +88,8 @@ def recover_edisons(device_manager, verbose):
 
     _update_blacklist(blacklisted_edison_names)
 
-    # release the working edisons
-    for edison in locked_edisons:
+    # release the edisons
+    for edison in edisons:
         device_manager.release(edison)
 
 
@@ -130,90 +124,11 @@ def _get_blacklisted_edison_names(all_edisons):
         list(str): List of blacklisted Edison names
     """
 
-    blacklisted_edisons = []
-    with open(config.DEVICE_BLACKLIST, "r") as device_blacklist:
-        for line in device_blacklist:
-            split_line = line.split()
-            if split_line[1] in all_edisons:
-                blacklisted_edisons.append(split_line[1])
-
-    return blacklisted_edisons
-
-
-
-def _lock_working_edisons(device_manager, working_edison_names, verbose):
-    """
-    Lock and return all working Edison. If Edison could not be locked (device
-    is busy), release all the Edisons and sleep for some time, so that testing
-    is not blocked
-
-    Args:
-        device_manager (aft.devicesmanager): Device manager
-        working_edison_names (list(str)): Names of the working edisons
-        verbose (boolean): Controls verbosity
-
-    Returns:
-        list(aft.Device): List of locked, working Edison devices
-
-    """
-    locked_edisons = []
-    attempt = 1
-    while True:
-
-        if verbose:
-            print("Attempt " + str(attempt) + " to acquire Edisons")
-            attempt += 1
-
-        try:
-            for edison in working_edison_names:
-                device = device_manager.reserve_specific(edison, timeout=20)
-                locked_edisons.append(device)
-
-            return locked_edisons
-
-        except errors.AFTTimeoutError:
-            if verbose:
-                print("A device is busy - releasing all acquired Edisons")
-            for device in locked_edisons:
-                device_manager.release(device)
-
-            if verbose:
-                print("Sleeping for a while before retrying")
-
-            locked_edisons = []
-            sleep(120)
+    return [entry["name"] for entry in blacklist.get_entries().values()
+            if entry["name"] in all_edisons]
 
 
 
-
-def _get_blacklisted_edison_devices(device_manager, blacklisted_edison_names):
-    """
-    Return list of blacklisted Edison devices
-
-    Args:
-        device_manager (aft.devicesmanager): Device manager
-        blacklisted_edison_names (list(str)):
-            List of names of blacklisted Edisons
-
-    Returns:
-        list(aft.Device): List of blacklisted Edison devices
-
-    """
-    configs = device_manager.get_configs()
-
-    blacklisted_edisons = []
-    for edison in blacklisted_edison_names:
-        for conf in configs:
-            if conf["name"] == edison:
-                cutter = devicefactory.build_cutter(conf["settings"])
-                device = devicefactory.build_device(
-                    conf["settings"],
-                    cutter)
-                blacklisted_edisons.append(device)
-
-    return blacklisted_edisons
-
-
 def _recover(blacklisted_edison_devices):
 
     for edison in blacklisted_edison_devices:
@@ -232,14 +147,8 @@ def _update_blacklist(blacklisted_edison_names):
     Returns:
         None
     """
-    lines = []
-    with open(config.DEVICE_BLACKLIST, "r") as device_blacklist:
-        for line in device_blacklist:
-            if line.split()[1] in blacklisted_edison_names:
-                continue
-            lines.append(line)
-
+    for entry in blacklist.get_entries().values():
+        if entry["name"] in blacklisted_edison_names:
+            blacklist.remove(entry["id"], "Recovered by the Edison recovery flasher")
 
-    with open(config.DEVICE_BLACKLIST, "w") as device_blacklist:
-        for line in lines:
-            device_blacklist.write(line)
+    reservation_queue.notify_waiters()
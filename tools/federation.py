@@ -0,0 +1,565 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Federation of several harness hosts into one device pool.
+
+Every host that runs the reservation broker periodically publishes its
+device inventory and device states to a coordinator process (aft
+--coordinator) at config.FEDERATION_COORDINATOR. When a job started with
+--federate finds no free device of its model on the local host, it asks the
+coordinator for a host that has one, and runs the whole flash and test
+pipeline on that host over ssh. The test results are copied back into the
+working directory.
+
+The coordinator only routes jobs; the devices are still reserved by the AFT
+process running on the chosen host, so a routing decision based on a stale
+inventory just means the job waits on that host.
+
+As jobs, and their images, are sent to the hosts in the federation, only the
+hosts listed in config.FEDERATION_HOSTS can join, and only from an address
+their name resolves to. Jobs are never sent to other hosts.
+"""
+
+import os
+import time
+import pipes
+import socket
+import threading
+import SocketServer
+import subprocess32
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.errors as errors
+import aft.tools.json_socket as json_socket
+
+
+def get_host_name():
+    """
+    Return the name this host uses in the federation
+
+    Returns:
+        (str): config.FEDERATION_HOST_NAME, or the fully qualified host name
+    """
+    return config.FEDERATION_HOST_NAME or socket.getfqdn()
+
+
+def get_allowed_hosts():
+    """
+    Return the hosts allowed in the federation
+
+    Returns:
+        (list(str)): The host names in config.FEDERATION_HOSTS
+    """
+    return [host.strip() for host in config.FEDERATION_HOSTS.split(",")
+            if host.strip()]
+
+
+def _get_addresses(host):
+    """
+    Return the addresses a host name resolves to
+
+    Args:
+        host (str): Host name
+
+    Returns:
+        (set(str)): The addresses, empty if the name does not resolve
+    """
+    try:
+        return set(info[4][0] for info in socket.getaddrinfo(host, None))
+    except socket.error:
+        return set()
+
+
+class FederationClient(object):
+    """
+    Connection to the federation coordinator
+    """
+
+    # Seconds to wait for the coordinator to reply
+    _TIMEOUT = 10
+
+    def __init__(self, connection):
+        """
+        Constructor
+
+        Args:
+            connection (socket.socket): Connected socket
+        """
+        self._connection = json_socket.JsonConnection(connection)
+
+    @staticmethod
+    def connect():
+        """
+        Connect to the coordinator given in config.FEDERATION_COORDINATOR
+
+        Returns:
+            (FederationClient or None): The client, or None if federation is
+            not configured or the coordinator cannot be reached
+        """
+        if not config.FEDERATION_COORDINATOR:
+            return None
+
+        host, _, port = config.FEDERATION_COORDINATOR.rpartition(":")
+        try:
+            connection = socket.create_connection(
+                (host, int(port)),
+                FederationClient._TIMEOUT)
+        except (socket.error, ValueError) as err:
+            logger.warning("Cannot connect to federation coordinator " +
+                           config.FEDERATION_COORDINATOR + ": " + str(err))
+            return None
+        return FederationClient(connection)
+
+    def register(self, host, devices):
+        """
+        Publish the device inventory of a host
+
+        Args:
+            host (str): Host name
+            devices (list(dictionary)):
+                Devices of the host, in the format of
+                ReservationBroker.get_status()["devices"]
+        """
+        self._request({"op": "register", "host": host, "devices": devices})
+
+    def find_host(self, model, exclude_host):
+        """
+        Find a host with a free device of the model
+
+        Args:
+            model (str): Device model
+            exclude_host (str): Host that will not be considered
+
+        Returns:
+            (str or None): Host name, or None if no host has a free device
+        """
+        return self._request({
+            "op": "find",
+            "model": model,
+            "exclude": exclude_host})["host"]
+
+    def status(self):
+        """
+        Query the aggregate status of the federation
+
+        Returns:
+            (dictionary): See FederationCoordinator.get_status
+        """
+        return self._request({"op": "status"})["status"]
+
+    def _request(self, message):
+        """
+        Send a request and convert error replies into exceptions
+
+        Args:
+            message (dictionary): The request
+
+        Returns:
+            (dictionary): The reply
+        """
+        reply = self._connection.request(message)
+        if reply is None:
+            raise errors.AFTConnectionError(
+                "Federation coordinator closed the connection")
+        if reply.get("error"):
+            raise errors.AFTConnectionError(
+                "Federation coordinator error: " + reply["message"])
+        return reply
+
+    def close(self):
+        """
+        Close the connection
+        """
+        self._connection.close()
+
+
+class _CoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Threaded TCP server for the coordinator
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _CoordinatorRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a single coordinator connection
+    """
+
+    def handle(self):
+        # Loggers are per thread name; share the log of the serving thread
+        threading.current_thread().name = self.server.thread_name
+
+        try:
+            while True:
+                message = json_socket.receive_message(self.rfile)
+                if message is None:
+                    return
+                reply = self.server.coordinator.handle_message(
+                    message,
+                    self.client_address[0])
+                json_socket.send_message(self.wfile, reply)
+        except socket.error as err:
+            logger.info("Federation client connection error: " + str(err))
+
+
+class FederationCoordinator(object):
+    """
+    Keeps the device inventories of the federated hosts and routes jobs.
+
+    Attributes:
+        _hosts (dictionary): Host name -> {"devices": [...], "seen": time}
+        _lock (threading.Lock): Protects _hosts
+    """
+
+    def __init__(self, address, port):
+        """
+        Constructor
+
+        Args:
+            address (str): Address to listen on
+            port (integer): TCP port to listen on
+        """
+        self._address = address
+        self._port = port
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        """
+        Start serving requests
+
+        Returns:
+            None
+
+        Raises:
+            aft.errors.AFTConfigurationError:
+                If no hosts are allowed in the federation
+        """
+        if not get_allowed_hosts():
+            raise errors.AFTConfigurationError(
+                "No hosts are allowed in the federation; set " +
+                "federation_hosts in aft.cfg")
+
+        server = _CoordinatorServer(
+            (self._address, self._port),
+            _CoordinatorRequestHandler)
+        server.coordinator = self
+        server.thread_name = threading.current_thread().name
+
+        message = "Federation coordinator listening on " + self._address + \
+            ":" + str(self._port)
+        logger.info(message)
+        print(message)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def handle_message(self, message, client_address):
+        """
+        Handle a single request
+
+        Args:
+            message (dictionary): The request
+            client_address (str): Address the request came from
+
+        Returns:
+            (dictionary): The reply
+        """
+        operation = message.get("op")
+        if operation == "register":
+            if not self._is_allowed(message["host"], client_address):
+                logger.warning("Rejected the registration of " +
+                               str(message["host"]) + " from " +
+                               client_address)
+                return {"error": "denied",
+                        "message": "Host " + str(message["host"]) +
+                                   " is not allowed in the federation"}
+            self._register(message["host"], message["devices"])
+            return {}
+        elif operation == "find":
+            return {"host": self._find_host(message["model"],
+                                            message.get("exclude"))}
+        elif operation == "status":
+            return {"status": self.get_status()}
+        return {"error": "protocol",
+                "message": "Unknown operation " + str(operation)}
+
+    @staticmethod
+    def _is_allowed(host, client_address):
+        """
+        Check whether a host may register. It must be listed in
+        config.FEDERATION_HOSTS, and connect from one of its addresses.
+
+        Args:
+            host (str): Host name given in the registration
+            client_address (str): Address the registration came from
+
+        Returns:
+            (boolean): True if the host may register
+        """
+        return host in get_allowed_hosts() and \
+            client_address in _get_addresses(host)
+
+    def _register(self, host, devices):
+        """
+        Store the device inventory of a host
+
+        Args:
+            host (str): Host name
+            devices (list(dictionary)): The devices
+        """
+        with self._lock:
+            if host not in self._hosts:
+                logger.info("Host " + host + " joined the federation with " +
+                            str(len(devices)) + " devices")
+            self._hosts[host] = {"devices": devices, "seen": time.time()}
+
+    def _get_live_hosts(self):
+        """
+        Return the hosts that have published their inventory recently. Must
+        be called with self._lock held.
+
+        Returns:
+            (list(str)): Host names
+        """
+        expiry = time.time() - 3 * int(config.FEDERATION_PUBLISH_INTERVAL)
+        return sorted(host for host, entry in self._hosts.items()
+                      if entry["seen"] > expiry)
+
+    def _find_host(self, model, exclude_host):
+        """
+        Choose the host with the most free devices of the model
+
+        Args:
+            model (str): Device model
+            exclude_host (str or None): Host that will not be chosen
+
+        Returns:
+            (str or None): Host name, or None if no host has a free device
+        """
+        with self._lock:
+            best_host = None
+            best_free = []
+            for host in self._get_live_hosts():
+                if host == exclude_host:
+                    continue
+                free = [device for device in self._hosts[host]["devices"]
+                        if device["model"].lower() == model.lower() and
+                        device["state"] == "free"]
+                if len(free) > len(best_free):
+                    best_host = host
+                    best_free = free
+
+            if best_host:
+                # Until the host publishes again, assume the job took the
+                # device, so that concurrent jobs spread over the hosts
+                best_free[0]["state"] = "routed"
+                logger.info("Routing a job for " + model + " to " + best_host)
+            return best_host
+
+    def get_status(self):
+        """
+        Return the aggregate status of the federation
+
+        Returns:
+            Dictionary of host name -> list of devices, in the format of
+            ReservationBroker.get_status()["devices"]. Only hosts that have
+            published their inventory recently are included.
+        """
+        with self._lock:
+            return dict((host, self._hosts[host]["devices"])
+                        for host in self._get_live_hosts())
+
+
+def publish_inventory(get_devices):
+    """
+    Publish the device inventory of this host to the coordinator every
+    config.FEDERATION_PUBLISH_INTERVAL seconds. Never returns; run it in a
+    daemon thread.
+
+    Args:
+        get_devices (function):
+            Function without arguments that returns the device states, in the
+            format of ReservationBroker.get_status()["devices"]
+    """
+    host = get_host_name()
+    client = None
+    while True:
+        try:
+            if not client:
+                client = FederationClient.connect()
+            if client:
+                client.register(host, get_devices())
+        except (socket.error, errors.AFTConnectionError) as err:
+            logger.warning("Publishing the inventory failed: " + str(err))
+            if client:
+                client.close()
+            client = None
+        time.sleep(int(config.FEDERATION_PUBLISH_INTERVAL))
+
+
+def find_remote_host(model):
+    """
+    Ask the coordinator for another host with a free device of the model
+
+    Args:
+        model (str): Device model
+
+    Returns:
+        (str or None): Host name, or None if there is none or federation is
+        not available
+    """
+    client = FederationClient.connect()
+    if not client:
+        return None
+    try:
+        host = client.find_host(model, get_host_name())
+    except (socket.error, errors.AFTConnectionError) as err:
+        logger.warning("Querying the federation coordinator failed: " +
+                       str(err))
+        return None
+    finally:
+        client.close()
+
+    if host and host not in get_allowed_hosts():
+        logger.warning("Federation coordinator offered " + host +
+                       ", which is not in federation_hosts")
+        return None
+    return host
+
+
+def _get_remote_arguments(args, remote_image):
+    """
+    Build the command line for running the job on another host
+
+    Args:
+        args (argparse namespace argument object): The local arguments
+        remote_image (str or None): Path of the image on the remote host
+
+    Returns:
+        (list(str)): The aft command line
+    """
+    command = ["aft", args.machine]
+    if remote_image:
+        command.append(remote_image)
+
+    command += [
+        "--machine_retries", str(args.machine_retries),
+        "--flash_retries", str(args.flash_retries),
+        "--selection_policy", args.selection_policy,
+        "--priority", args.priority]
+    if args.test_plan:
+        command += ["--test_plan", args.test_plan]
+
+    for flag in ["record", "noflash", "force_flash", "notest", "nopoweroff",
+                 "preemptible", "verbose", "debug"]:
+        if getattr(args, flag):
+            command.append("--" + flag)
+    return command
+
+
+def run_remote_job(host, args):
+    """
+    Run the flash and test pipeline on another host over ssh. The image is
+    copied to a temporary directory on the host, and the test results and
+    logs are copied back into the current working directory.
+
+    Args:
+        host (str): The host
+        args (argparse namespace argument object): The job arguments
+
+    Returns:
+        (integer or None): Exit code of the remote aft process, or None if
+        the job could not be started on the host
+    """
+    destination = config.FEDERATION_SSH_USER + "@" + host
+    ssh = ["ssh", "-o", "BatchMode=yes", destination]
+
+    try:
+        remote_directory = subprocess32.check_output(
+            ssh + ["mktemp", "-d", "/tmp/aft_federation.XXXXXX"],
+            timeout=60).strip()
+    except (subprocess32.CalledProcessError,
+            subprocess32.TimeoutExpired) as err:
+        logger.warning("Cannot prepare " + host + " for the job: " + str(err))
+        return None
+
+    try:
+        remote_image = None
+        if not args.noflash:
+            remote_image = os.path.join(
+                remote_directory,
+                os.path.basename(args.file_name))
+            print("Copying " + args.file_name + " to " + host)
+            try:
+                subprocess32.check_call(
+                    ["scp", "-B", args.file_name,
+                     destination + ":" + remote_image])
+            except subprocess32.CalledProcessError as err:
+                logger.warning("Copying the image to " + host + " failed: " +
+                               str(err))
+                return None
+
+        command = _get_remote_arguments(args, remote_image)
+        print("Running the job on " + host)
+        logger.info("Running on " + host + ": " + " ".join(command))
+
+        # Output is passed through as is
+        return_code = subprocess32.call(
+            ssh + ["cd " + pipes.quote(remote_directory) + " && " +
+                   " ".join(pipes.quote(part) for part in command)])
+
+        # The remote run may have failed before writing some of these
+        subprocess32.call(
+            ["scp", "-B", "-q",
+             destination + ":" + remote_directory + "/*.xml",
+             destination + ":" + remote_directory + "/*.log",
+             "."])
+        return return_code
+    finally:
+        try:
+            subprocess32.call(
+                ssh + ["rm", "-rf", pipes.quote(remote_directory)],
+                timeout=60)
+        except subprocess32.TimeoutExpired:
+            logger.warning("Removing " + remote_directory + " from " + host +
+                           " timed out")
+
+
+def format_status(status):
+    """
+    Format the federation status as human readable text
+
+    Args:
+        status (dictionary): Status as returned by
+                             FederationCoordinator.get_status
+
+    Returns:
+        (str): The formatted status
+    """
+    if not status:
+        return "No hosts in the federation"
+
+    lines = []
+    for host in sorted(status):
+        devices = status[host]
+        free = len([device for device in devices if device["state"] == "free"])
+        lines.append(host + ": " + str(free) + "/" + str(len(devices)) +
+                     " devices free")
+        for device in devices:
+            lines.append("\t" + device["name"] + " (" + device["model"] +
+                         "): " + device["state"])
+    return "\n".join(lines)
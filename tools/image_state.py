@@ -0,0 +1,381 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Tracking of the image each device holds, so that flashing the same image
+again can be skipped.
+
+The content hash of the last image written to every device is stored in the
+state database (config.STATE_DATABASE). Devices that support it
+(Device.image_marker_path is set) also write the hash into a marker file on
+the flashed root filesystem. When the same image is requested again, the
+device boots the image and the marker is checked over ssh; flashing is
+skipped only if it matches.
+
+Image hashes are cached by path, size and modification time, so that large
+images are only read once.
+
+Reservations can prefer devices that already hold the image (image
+affinity, see aft.tools.selection_policies). How often that works out, and
+how much flashing time the skipped flashings save, is recorded as well.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import functools
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.tools.database as database
+import aft.tools.device_statistics as device_statistics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS device_images (
+    id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS affinity_reservations (
+    id TEXT NOT NULL,
+    hit INTEGER NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reflash_skips (
+    id TEXT NOT NULL,
+    saved_time REAL NOT NULL,
+    timestamp REAL NOT NULL
+);
+"""
+
+# Bytes read at a time when hashing an image
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _connect():
+    """
+    Open the state database, creating it if necessary
+
+    Returns:
+        sqlite3.Connection: The database connection
+    """
+    return database.connect(config.STATE_DATABASE, _SCHEMA)
+
+
+def get_image_hash(file_name):
+    """
+    Return the content hash of an image
+
+    Args:
+        file_name (str): The image file
+
+    Returns:
+        (str): SHA-1 of the image contents, as a hex string
+    """
+    path = os.path.realpath(file_name)
+    stat = os.stat(path)
+
+    try:
+        connection = _connect()
+        try:
+            row = connection.execute(
+                "SELECT hash FROM image_hashes "
+                "WHERE path = ? AND size = ? AND mtime = ?",
+                (path, stat.st_size, stat.st_mtime)).fetchone()
+            if row:
+                return row["hash"]
+
+            image_hash = _hash_file(path)
+            connection.execute(
+                "INSERT OR REPLACE INTO image_hashes (path, size, mtime, hash) "
+                "VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime, image_hash))
+            return image_hash
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Image hash cache unavailable: " + str(err))
+        return _hash_file(path)
+
+
+def _hash_file(path):
+    """
+    Compute the SHA-1 of a file
+
+    Args:
+        path (str): The file
+
+    Returns:
+        (str): The hash as a hex string
+    """
+    logger.info("Computing the hash of " + path)
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as image_file:
+        while True:
+            block = image_file.read(_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_device_image(device):
+    """
+    Return the hash of the image last written to the device
+
+    Args:
+        device (aft.Device): The device
+
+    Returns:
+        (str or None): The image hash, or None if it is not known
+    """
+    try:
+        connection = _connect()
+        try:
+            row = connection.execute(
+                "SELECT hash FROM device_images WHERE id = ?",
+                (device.dev_id,)).fetchone()
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to read the image state: " + str(err))
+        return None
+
+    return row["hash"] if row else None
+
+
+def get_device_images(dev_ids):
+    """
+    Return the hashes of the images last written to the devices
+
+    Args:
+        dev_ids (list(str)): The device ids
+
+    Returns:
+        Dictionary of device id -> image hash, for the devices whose image is
+        known
+    """
+    try:
+        connection = _connect()
+        try:
+            rows = connection.execute(
+                "SELECT id, hash FROM device_images").fetchall()
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to read the image state: " + str(err))
+        return {}
+
+    wanted = set(dev_ids)
+    return dict((row["id"], row["hash"]) for row in rows if row["id"] in wanted)
+
+
+def get_requested_image_hash(args):
+    """
+    Return the hash of the image a job is going to flash, if flashing could
+    be skipped for a device already holding it
+
+    Args:
+        args (argparse namespace argument object): The job arguments
+
+    Returns:
+        (str or None): The image hash, or None if the job will not flash or
+        will always flash
+    """
+    if args.noflash or args.force_flash or not args.file_name:
+        return None
+    return get_image_hash(args.file_name)
+
+
+def record_affinity(device, image_hash):
+    """
+    Record whether a reservation that preferred devices holding the image got
+    one
+
+    Args:
+        device (aft.Device): The reserved device
+        image_hash (str): Hash of the image the reservation asked for
+
+    Returns:
+        None
+    """
+    hit = get_device_image(device) == image_hash
+    logger.info("Image affinity " + ("hit" if hit else "miss") + " on " +
+                device.name)
+    _insert("affinity_reservations", "hit", device, int(hit))
+
+
+def _record_skip(device, verification_time):
+    """
+    Record a skipped flashing and the time it saved, estimated from the mean
+    flashing time of the device
+
+    Args:
+        device (aft.Device): The device
+        verification_time (float): Time spent verifying the image marker
+
+    Returns:
+        None
+    """
+    try:
+        flash_time = device_statistics.get_statistics(
+            [device.dev_id])[device.dev_id]["flash_time"]
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Device statistics unavailable: " + str(err))
+        flash_time = None
+
+    saved_time = max((flash_time or 0) - verification_time, 0)
+    _insert("reflash_skips", "saved_time", device, saved_time)
+
+
+def _insert(table, column, device, value):
+    """
+    Insert a timestamped row for the device
+
+    Args:
+        table (str): The table
+        column (str): The value column
+        device (aft.Device): The device
+        value (number): The value
+
+    Returns:
+        None
+    """
+    try:
+        connection = _connect()
+        try:
+            connection.execute(
+                "INSERT INTO " + table + " (id, " + column + ", timestamp) "
+                "VALUES (?, ?, ?)",
+                (device.dev_id, value, time.time()))
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to record image affinity statistics: " +
+                       str(err))
+
+
+def get_affinity_statistics(since):
+    """
+    Return the image affinity statistics
+
+    Args:
+        since (float): Only include events after this time
+
+    Returns:
+        Dictionary with the following format:
+        {
+            "reservations": number of reservations that asked for an image,
+            "hits": number of those that got a device holding the image,
+            "skips": number of skipped flashings,
+            "saved_time": estimated flashing time saved, in seconds
+        }
+    """
+    connection = _connect()
+    try:
+        reservations = connection.execute(
+            "SELECT COUNT(*), TOTAL(hit) FROM affinity_reservations "
+            "WHERE timestamp > ?", (since,)).fetchone()
+        skips = connection.execute(
+            "SELECT COUNT(*), TOTAL(saved_time) FROM reflash_skips "
+            "WHERE timestamp > ?", (since,)).fetchone()
+    finally:
+        connection.close()
+
+    return {
+        "reservations": reservations[0],
+        "hits": int(reservations[1]),
+        "skips": skips[0],
+        "saved_time": skips[1]
+    }
+
+
+def set_device_image(device, image_hash):
+    """
+    Store the hash of the image the device holds
+
+    Args:
+        device (aft.Device): The device
+        image_hash (str or None):
+            The image hash, or None if the contents of the device are unknown
+
+    Returns:
+        None
+    """
+    try:
+        connection = _connect()
+        try:
+            if image_hash:
+                connection.execute(
+                    "INSERT OR REPLACE INTO device_images "
+                    "(id, hash, timestamp) VALUES (?, ?, ?)",
+                    (device.dev_id, image_hash, time.time()))
+            else:
+                connection.execute(
+                    "DELETE FROM device_images WHERE id = ?",
+                    (device.dev_id,))
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Failed to store the image state: " + str(err))
+
+
+def skips_reflash(write_image):
+    """
+    Decorator for Device.write_image implementations. Skips flashing if the
+    device already holds the image and its marker file confirms it.
+
+    The decorated method takes an additional keyword argument force; if True,
+    the image is always flashed. While flashing, device.image_hash holds the
+    hash the device should write into its marker file.
+
+    Args:
+        write_image (function): The write_image method
+
+    Returns:
+        (function): The decorated method
+    """
+    @functools.wraps(write_image)
+    def _write_image(self, file_name, force=False):
+        if not self.image_marker_path:
+            return write_image(self, file_name)
+
+        image_hash = get_image_hash(file_name)
+        if not force and get_device_image(self) == image_hash:
+            logger.info(self.name + " should already hold " + file_name +
+                        ", verifying")
+            start = time.time()
+            if self.verify_image_marker(image_hash):
+                logger.info("Image verified, skipping flashing " + self.name)
+                _record_skip(self, time.time() - start)
+                print("Device " + self.name + " already holds the image, " +
+                      "skipping flashing.")
+                return None
+            logger.info("Image marker does not match, flashing " + self.name)
+
+        # Until flashing has succeeded, the contents of the device are unknown
+        set_device_image(self, None)
+        self.image_hash = image_hash
+        try:
+            result = write_image(self, file_name)
+        finally:
+            self.image_hash = None
+        set_device_image(self, image_hash)
+        return result
+    return _write_image
@@ -0,0 +1,290 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Image delivery streamed from the harness over ssh, as an alternative to the
+device reading the image from the NFS export.
+
+The sending side runs this module as a program (python -m
+aft.tools.image_stream). It reads the ranges of the image that hold data, as
+listed by the bmap file of the image, or the whole image without one. The
+ranges are sent gzip compressed, each preceded by a header line with its
+offset and length and followed by a line with its SHA-256 digest, and the
+stream is ended by an "end" line. The ranges are checked against the
+checksums in the bmap file while they are read. The sending rate can be
+limited per flashing job.
+
+On the device, a shell loop writes the ranges into place with dd. Once the
+whole stream has been received and its gzip checksum verified, the ranges are
+read back from the storage and compared with their digests. The device needs
+a shell with pipefail (bash or busybox ash), gzip, sha256sum and GNU dd.
+
+As every job sends its image itself, concurrent flashings do not compete for
+the NFS server, and the images need not be on the NFS export.
+"""
+
+import os
+import sys
+import time
+import zlib
+import pipes
+import hashlib
+import argparse
+import xml.etree.ElementTree as ElementTree
+
+import aft.tools.ssh as ssh
+import aft.tools.process_engine as process_engine
+
+# Bytes read from the image at a time
+_CHUNK_SIZE = 1024 * 1024
+
+# zlib compression level. Higher levels cost more CPU than they save in
+# transfer time.
+_COMPRESSION_LEVEL = 1
+
+# Percentage of the data between progress reports
+_PROGRESS_STEP = 5
+
+# Receives the stream on the device. The last range is followed by an "end"
+# line, so that a truncated stream is noticed. The rest of the stream is read
+# after it, so that gzip verifies its checksum, and pipefail fails the
+# pipeline if gzip does. The digests of the ranges are collected into a file,
+# and checked once the ranges are on the storage instead of the page cache.
+_RECEIVER = (
+    "set -o pipefail; "
+    "sums=$(mktemp) || exit 1; "
+    "trap 'rm -f \"$sums\"' EXIT; "
+    "gzip -dc | {{ "
+    "while read offset length; do "
+    "if [ \"$offset\" = end ]; then cat > /dev/null; exit 0; fi; "
+    "dd of={device} bs=1M seek=$offset count=$length conv=notrunc "
+    "oflag=seek_bytes iflag=count_bytes,fullblock 2>/dev/null || "
+    "{{ echo \"Writing $length bytes at $offset failed\"; exit 1; }}; "
+    "read check digest; "
+    "[ \"$check\" = check ] || "
+    "{{ echo \"The digest of $length bytes at $offset is missing\"; exit 1; }}; "
+    "echo \"$offset $length $digest\" >> \"$sums\"; "
+    "done; "
+    "echo \"The image stream ended early\"; exit 1; }} || exit 1; "
+    "sync; "
+    "{{ echo 3 > /proc/sys/vm/drop_caches; }} 2>/dev/null; "
+    "echo \"Verifying the written ranges\"; "
+    "while read offset length digest; do "
+    "written=$(dd if={device} bs=1M skip=$offset count=$length "
+    "iflag=skip_bytes,count_bytes 2>/dev/null | sha256sum) || exit 1; "
+    "[ \"${{written%% *}}\" = \"$digest\" ] || "
+    "{{ echo \"Checksum mismatch in $length bytes at $offset\"; exit 1; }}; "
+    "done < \"$sums\"")
+
+
+def write_image(remote_ip, image, target_device, timeout, line_handler=None,
+                bandwidth=0, user="root"):
+    """
+    Write an image into a block device of the device. Only the data ranges
+    listed in <image>.bmap are sent, if the file exists.
+
+    Args:
+        remote_ip (str): Device ip address
+        image (str): The image file
+        target_device (str): The block device on the device, e.g. /dev/sda
+        timeout (integer): Timeout in seconds
+        line_handler (function):
+            Called with each output line. The progress is reported as lines
+            "<percentage>% copied".
+        bandwidth (integer): Maximum sending rate in bytes per second, or 0
+                             for no limit
+        user (str): User that will be used with ssh
+
+    Returns:
+        Output tail of the transfer
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired
+        subprocess32.CalledProcessError:
+            If reading, sending, writing or verifying the image failed
+    """
+    command = [sys.executable, "-m", "aft.tools.image_stream", image,
+               "--bandwidth", str(bandwidth)]
+    if os.path.isfile(image + ".bmap"):
+        command += ["--bmap", image + ".bmap"]
+
+    return ssh.pipe_to_remote(
+        remote_ip,
+        command,
+        _RECEIVER.format(device=pipes.quote(target_device)),
+        timeout=timeout,
+        line_handler=line_handler,
+        user=user)
+
+
+def get_ranges(image, bmap=None):
+    """
+    Return the byte ranges of an image that hold data
+
+    Args:
+        image (str): The image file
+        bmap (str or None): The bmap file of the image
+
+    Returns:
+        (list(tuple)): (offset, length, checksum) of each range. Offset and
+        length are in bytes. Checksum is a tuple (hash name, hex digest) from
+        the bmap file, or None.
+    """
+    image_size = os.path.getsize(image)
+    if not bmap:
+        return [(0, image_size, None)]
+
+    root = ElementTree.parse(bmap).getroot()
+    block_size = int(root.findtext("BlockSize"))
+    # Before bmap format 1.4 the checksums were always SHA-1
+    checksum_type = (root.findtext("ChecksumType") or "sha1").strip()
+
+    ranges = []
+    for block_range in root.find("BlockMap").findall("Range"):
+        # A range is "first-last", or a single block
+        blocks = block_range.text.strip().split("-")
+        first = int(blocks[0])
+        last = int(blocks[-1])
+        offset = first * block_size
+        # The last block of the image may be partial
+        length = min((last + 1) * block_size, image_size) - offset
+        checksum = block_range.get("chksum") or block_range.get("sha1")
+        if checksum:
+            checksum = (checksum_type, checksum)
+        if length > 0:
+            ranges.append((offset, length, checksum))
+    return ranges
+
+
+class _TokenBucket(object):
+    """
+    Limits a rate. Bursts of up to one second worth of the rate are allowed.
+    """
+
+    def __init__(self, rate):
+        """
+        Constructor
+
+        Args:
+            rate (float): Units per second
+        """
+        self._rate = float(rate)
+        self._tokens = self._rate
+        self._time = process_engine.monotonic()
+
+    def consume(self, amount):
+        """
+        Take units, sleeping until the rate allows them
+        """
+        now = process_engine.monotonic()
+        self._tokens = min(self._rate,
+                           self._tokens + (now - self._time) * self._rate)
+        self._time = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self._rate)
+
+
+def _send(image, bmap, bandwidth, output, progress):
+    """
+    Write the compressed stream of an image
+
+    Args:
+        image (str): The image file
+        bmap (str or None): The bmap file of the image
+        bandwidth (integer): Maximum rate in bytes per second, or 0
+        output (file): Where the stream is written
+        progress (file): Where the progress is reported
+    """
+    ranges = get_ranges(image, bmap)
+    total = sum(length for _, length, _ in ranges)
+    progress.write("Sending " + str(total) + " bytes of " + image + " in " +
+                   str(len(ranges)) + " ranges\n")
+
+    # gzip format, for gzip on the device
+    compressor = zlib.compressobj(_COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    bucket = _TokenBucket(bandwidth) if bandwidth else None
+
+    def write(data):
+        data = compressor.compress(data)
+        if not data:
+            return
+        if bucket:
+            bucket.consume(len(data))
+        output.write(data)
+
+    sent = 0
+    reported = 0
+    # An empty image is done from the start
+    total = max(total, 1)
+    with open(image, "rb") as image_file:
+        for offset, length, checksum in ranges:
+            write(str(offset) + " " + str(length) + "\n")
+            image_file.seek(offset)
+            digest = hashlib.sha256()
+            bmap_digest = hashlib.new(checksum[0]) if checksum else None
+            remaining = length
+            while remaining:
+                data = image_file.read(min(_CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError(image + " is shorter than its block map")
+                digest.update(data)
+                if bmap_digest:
+                    bmap_digest.update(data)
+                write(data)
+                remaining -= len(data)
+                sent += len(data)
+
+                percentage = 100 * sent / total
+                if percentage >= reported + _PROGRESS_STEP:
+                    reported = percentage
+                    progress.write(str(percentage) + "% copied\n")
+                    progress.flush()
+
+            # Stopping without the digest fails the stream on the device
+            if bmap_digest and bmap_digest.hexdigest() != checksum[1]:
+                raise IOError(
+                    "The " + str(length) + " bytes at " + str(offset) +
+                    " of " + image + " do not match the block map checksum")
+            write("check " + digest.hexdigest() + "\n")
+
+    write("end 0\n")
+    output.write(compressor.flush())
+    output.flush()
+
+
+def _main(argv):
+    """
+    Entry point of the sending side
+
+    Args:
+        argv (list(str)): The command line arguments
+
+    Returns:
+        (integer): Exit status
+    """
+    parser = argparse.ArgumentParser(
+        description="Write an image stream for aft.tools.image_stream")
+    parser.add_argument("image", help="The image file")
+    parser.add_argument("--bmap", default=None, help="Bmap file of the image")
+    parser.add_argument("--bandwidth", type=int, default=0,
+                        help="Maximum rate in bytes per second, 0 for none")
+    args = parser.parse_args(argv)
+
+    _send(args.image, args.bmap, args.bandwidth, sys.stdout, sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,146 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Helpers for exchanging newline delimited JSON messages over stream sockets.
+
+Every message is a single JSON object on its own line. Used by the AFT
+daemons (reservation broker etc.) and their clients.
+"""
+
+import json
+import socket
+import errno
+
+import aft.tools.misc as misc
+
+
+def send_message(stream, message):
+    """
+    Write a message into a file-like stream
+
+    Args:
+        stream (file): Writable file object, e.g. from socket.makefile()
+        message (dictionary): The message
+
+    Returns:
+        None
+    """
+    stream.write(json.dumps(message) + "\n")
+    stream.flush()
+
+
+def receive_message(stream):
+    """
+    Read a message from a file-like stream
+
+    Args:
+        stream (file): Readable file object, e.g. from socket.makefile()
+
+    Returns:
+        (dictionary or None): The message, or None if the other end closed
+        the connection
+    """
+    line = stream.readline()
+    if not line:
+        return None
+    return misc.byteify(json.loads(line))
+
+
+def connect_unix(path, timeout=None):
+    """
+    Connect to a unix stream socket
+
+    Args:
+        path (str): Path to the socket
+        timeout (float or None): Socket timeout
+
+    Returns:
+        (socket.socket or None): Connected socket, or None if nobody is
+        listening on the path
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(path)
+    except socket.error as err:
+        connection.close()
+        if err.errno in {errno.ENOENT, errno.ECONNREFUSED}:
+            return None
+        raise
+    return connection
+
+
+class JsonConnection(object):
+    """
+    A connection that exchanges JSON messages.
+
+    Attributes:
+        _socket (socket.socket): The underlying socket
+        _reader (file): Buffered reader for the socket
+        _writer (file): Buffered writer for the socket
+    """
+
+    def __init__(self, connection):
+        """
+        Constructor
+
+        Args:
+            connection (socket.socket): A connected socket
+        """
+        self._socket = connection
+        self._reader = connection.makefile("r")
+        self._writer = connection.makefile("w")
+
+    def request(self, message):
+        """
+        Send a message and wait for the reply
+
+        Args:
+            message (dictionary): The request
+
+        Returns:
+            (dictionary or None): The reply, or None if the connection was
+            closed
+        """
+        send_message(self._writer, message)
+        return receive_message(self._reader)
+
+    def send(self, message):
+        """
+        Send a message without waiting for a reply
+
+        Args:
+            message (dictionary): The message
+        """
+        send_message(self._writer, message)
+
+    def receive(self):
+        """
+        Receive a message
+
+        Returns:
+            (dictionary or None): The message, or None if the connection was
+            closed
+        """
+        return receive_message(self._reader)
+
+    def close(self):
+        """
+        Close the connection
+        """
+        for stream in (self._reader, self._writer):
+            try:
+                stream.close()
+            except socket.error:
+                pass
+        self._socket.close()
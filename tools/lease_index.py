@@ -0,0 +1,350 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Process wide index of the dnsmasq leases, keyed by lowercase MAC address.
+
+The index of a leases file is loaded once and kept up to date by a watcher
+thread. The thread sleeps until inotify reports a change in the directory of
+the file, or, where inotify is not available, polls the file for changes.
+Only lines that changed since the last read are parsed, and only the MAC
+addresses whose leases changed are reported to the waiters and subscribers.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import threading
+
+from aft.logger import Logger as logger
+import aft.tools.process_engine as process_engine
+
+# Seconds between checks of the file when inotify is not available. With
+# inotify, the file is checked this often anyway, in case an event is missed.
+_POLL_INTERVAL = 1
+_FALLBACK_CHECK_INTERVAL = 10
+
+# inotify(7) constants
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+# Leases file path -> LeaseIndex, for the process in _pid. A forked child
+# does not inherit the watcher threads, so it builds indexes of its own.
+_indexes = {}
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def get_index(leases_file_path):
+    """
+    Return the index of a leases file, creating it on first use
+
+    Args:
+        leases_file_path (str): Path to dnsmasq leases file
+
+    Returns:
+        (LeaseIndex): The index
+    """
+    global _pid
+    path = os.path.realpath(leases_file_path)
+    with _lock:
+        if _pid != os.getpid():
+            _indexes.clear()
+            _pid = os.getpid()
+        if path not in _indexes:
+            _indexes[path] = LeaseIndex(path)
+        return _indexes[path]
+
+
+def parse_lease(line):
+    """
+    Parse a line of a dnsmasq leases file. The lines have the format
+    <lease_expiry_time_as_epoch_format> <mac> <ip> <hostname> <client id>
+    See:
+    http://lists.thekelleys.org.uk/pipermail/dnsmasq-discuss/2005q1/000143.html
+
+    Args:
+        line (str): The line
+
+    Returns:
+        Dictionary with the following format, or None if the line is not a
+        lease:
+        {
+            "expiry": lease expiry time as seconds since the epoch,
+            "mac": "device_mac_address",
+            "ip": "device_ip_address",
+            "hostname": "device_host_name",
+            "client_id": "client_id_or_*_if_unset"
+        }
+    """
+    fields = line.split()
+    if len(fields) < 5:
+        return None
+    try:
+        expiry = int(fields[0])
+    except ValueError:
+        return None
+    return {
+        "expiry": expiry,
+        "mac": fields[1],
+        "ip": fields[2],
+        "hostname": fields[3],
+        "client_id": fields[4],
+    }
+
+
+class LeaseIndex(object):
+    """
+    Index of the leases of one dnsmasq leases file.
+
+    Attributes:
+        _path (str): The leases file
+        _condition (threading.Condition): Protects the attributes below and
+                                          wakes up the waiters
+        _leases (list(dictionary)): All the leases, in file order
+        _by_mac (dictionary): Lowercase MAC -> list of leases
+        _versions (dictionary):
+            Lowercase MAC -> number of times the leases of the MAC changed
+        _lines (dictionary): Raw line -> parsed lease, for the current lines
+        _stat (tuple): Identity of the last read file version
+        _subscribers (dictionary): Lowercase MAC -> list of callbacks
+    """
+
+    def __init__(self, path):
+        """
+        Constructor. Loads the file and starts the watcher thread.
+
+        Args:
+            path (str): Path to dnsmasq leases file
+        """
+        self._path = path
+        self._condition = threading.Condition()
+        self._leases = []
+        self._by_mac = {}
+        self._versions = {}
+        self._lines = {}
+        self._stat = None
+        self._subscribers = {}
+        self._refresh()
+
+        thread = threading.Thread(target=self._watch, name="lease_index")
+        thread.daemon = True
+        thread.start()
+
+    def get_all_leases(self):
+        """
+        Return all the leases
+
+        Returns:
+            List of leases in the format of parse_lease, in file order
+        """
+        with self._condition:
+            return [dict(lease) for lease in self._leases]
+
+    def get_leases(self, mac_address):
+        """
+        Return the leases of a MAC address
+
+        Args:
+            mac_address (str): The MAC address, in any case
+
+        Returns:
+            List of leases in the format of parse_lease, in file order
+        """
+        return self.get_versioned_leases(mac_address)[1]
+
+    def get_versioned_leases(self, mac_address):
+        """
+        Return the leases of a MAC address, and a version number that changes
+        whenever they change. See wait_for_change.
+
+        Args:
+            mac_address (str): The MAC address, in any case
+
+        Returns:
+            Tuple (version, list of leases)
+        """
+        mac_address = mac_address.lower()
+        with self._condition:
+            return (self._versions.get(mac_address, 0),
+                    [dict(lease) for lease in
+                     self._by_mac.get(mac_address, [])])
+
+    def wait_for_change(self, mac_address, version, timeout):
+        """
+        Wait until the leases of a MAC address differ from a version
+
+        Args:
+            mac_address (str): The MAC address, in any case
+            version (integer): Version from get_versioned_leases
+            timeout (float): Maximum time to wait, in seconds
+
+        Returns:
+            Tuple (version, list of leases), as get_versioned_leases
+        """
+        key = mac_address.lower()
+        deadline = process_engine.monotonic() + timeout
+        with self._condition:
+            while self._versions.get(key, 0) == version:
+                remaining = deadline - process_engine.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        return self.get_versioned_leases(mac_address)
+
+    def subscribe(self, mac_address, callback):
+        """
+        Register a function called with the new list of leases whenever the
+        leases of a MAC address change. It is called from the watcher thread.
+
+        Args:
+            mac_address (str): The MAC address, in any case
+            callback (function): The function
+
+        Returns:
+            (function): Function without arguments that unsubscribes
+        """
+        key = mac_address.lower()
+        with self._condition:
+            self._subscribers.setdefault(key, []).append(callback)
+
+        def unsubscribe():
+            with self._condition:
+                if callback in self._subscribers.get(key, []):
+                    self._subscribers[key].remove(callback)
+        return unsubscribe
+
+    def _watch(self):
+        """
+        Body of the watcher thread. It is shared by all the jobs, so it logs
+        into a file of its own.
+        """
+        logger.init_thread("lease_index_")
+        inotify = self._init_inotify()
+        if inotify is None:
+            logger.info("inotify not available, polling " + self._path)
+
+        while True:
+            if inotify is None:
+                time.sleep(_POLL_INTERVAL)
+            elif select.select([inotify], [], [], _FALLBACK_CHECK_INTERVAL)[0]:
+                # Which file changed does not matter; the file is checked
+                _drain(inotify)
+
+            try:
+                self._refresh()
+            except (IOError, OSError) as err:
+                logger.warning("Reading " + self._path + " failed: " + str(err))
+
+    def _init_inotify(self):
+        """
+        Start watching the directory of the leases file. dnsmasq may replace
+        the file instead of writing it in place.
+
+        Returns:
+            (integer or None): The inotify file descriptor, or None if inotify
+            is not available
+        """
+        try:
+            inotify = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        except AttributeError:
+            return None
+        if inotify < 0:
+            return None
+
+        watch = _libc.inotify_add_watch(
+            inotify,
+            os.path.dirname(self._path),
+            _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE |
+            _IN_DELETE)
+        if watch < 0:
+            os.close(inotify)
+            return None
+        return inotify
+
+    def _refresh(self):
+        """
+        Re-read the leases file if it has changed, and notify the waiters and
+        subscribers of the MAC addresses whose leases changed
+        """
+        try:
+            stat = os.stat(self._path)
+            identity = (stat.st_ino, stat.st_size, stat.st_mtime)
+        except OSError:
+            # dnsmasq has not written the file yet
+            identity = None
+
+        if identity == self._stat and identity is not None:
+            return
+
+        lines = []
+        if identity is not None:
+            with open(self._path) as leases_file:
+                lines = leases_file.readlines()
+
+        # Only new lines are parsed
+        parsed = {}
+        leases = []
+        for line in lines:
+            lease = self._lines.get(line) or parsed.get(line)
+            if lease is None:
+                lease = parse_lease(line)
+            if lease is None:
+                continue
+            parsed[line] = lease
+            leases.append(lease)
+
+        by_mac = {}
+        for lease in leases:
+            by_mac.setdefault(lease["mac"].lower(), []).append(lease)
+
+        with self._condition:
+            changed = [mac for mac in set(by_mac) | set(self._by_mac)
+                       if by_mac.get(mac) != self._by_mac.get(mac)]
+            self._leases = leases
+            self._by_mac = by_mac
+            self._lines = parsed
+            self._stat = identity
+            for mac in changed:
+                self._versions[mac] = self._versions.get(mac, 0) + 1
+            callbacks = [(callback, by_mac.get(mac, []))
+                         for mac in changed
+                         for callback in self._subscribers.get(mac, [])]
+            if changed:
+                self._condition.notify_all()
+
+        for callback, mac_leases in callbacks:
+            try:
+                callback([dict(lease) for lease in mac_leases])
+            except Exception as err:
+                logger.warning("Lease subscriber failed: " + str(err))
+
+
+def _drain(fd):
+    """
+    Read and discard the pending inotify events
+    """
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError:
+        # EAGAIN: nothing more to read
+        pass
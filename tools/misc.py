@@ -15,8 +15,10 @@
 Convenience functions for (unix) command execution
 """
 
-import subprocess32
 import time
+import subprocess32
+
+import aft.tools.process_engine as process_engine
 
 def local_execute(command, timeout = 60, ignore_return_codes = None):
     """
@@ -24,26 +26,47 @@ def local_execute(command, timeout = 60, ignore_return_codes = None):
     return code is 0 or included in the list 'ignore_return_codes'. Otherwise
     raises a subprocess32 error.
     """
-    process = subprocess32.Popen(command, universal_newlines=True,
-                                 stdout = subprocess32.PIPE,
-                                 stderr = subprocess32.STDOUT)
-
-    # Loop until process returns or timeout expires.
-    start = time.time()
-    output = ""
-    return_code = None
-    while time.time() < start + timeout and return_code == None:
-        return_code = process.poll()
-        if return_code == None:
-            try:
-                output += process.communicate(timeout = 1)[0]
-            except subprocess32.TimeoutExpired:
-                pass
-    
-    if return_code == None:
-        # Time ran out but the process didn't end.
-        raise subprocess32.TimeoutExpired(cmd = command, output = output,
-                                          timeout = timeout)
+    output = []
+    try:
+        local_execute_stream(command, output.append, timeout,
+                             ignore_return_codes)
+    except (subprocess32.CalledProcessError,
+            subprocess32.TimeoutExpired) as err:
+        err.output = "".join(output)
+        raise
+    return "".join(output)
+
+def local_execute_stream(command, line_handler = None, timeout = 60,
+                         ignore_return_codes = None,
+                         tail_lines = process_engine.TAIL_LINES):
+    """
+    Execute a command on local machine, passing its combined stdout and stderr
+    to line_handler one line at a time as it is produced. Only the last
+    tail_lines lines are kept, so output of any size can be handled. See
+    aft.tools.process_engine.run.
+
+    Args:
+        command (list(str)): The command
+        line_handler (function):
+            Called with each output line, including its line terminator
+        timeout (integer): Timeout in seconds. The process is killed if it
+                           has not finished by then
+        ignore_return_codes (list(integer)):
+            Return codes that are not considered errors
+        tail_lines (integer): Number of lines kept for the return value
+
+    Returns:
+        The last tail_lines lines of output
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired. The output of the error is the output tail.
+        subprocess32.CalledProcessError:
+            If the process returns non-zero, non-ignored return code. The
+            output of the error is the output tail.
+    """
+    return_code, output = process_engine.run(
+        command, line_handler, timeout, tail_lines)
 
     if ignore_return_codes == None:
         ignore_return_codes = []
@@ -51,10 +74,42 @@ def local_execute(command, timeout = 60, ignore_return_codes = None):
         return output
     else:
         raise subprocess32.CalledProcessError(returncode = return_code,
-                                              cmd = command, output = output)
+                                              cmd = command,
+                                              output = output)
 
 def subprocess_killer(process):
     """
     A function to kill subprocesses, intended to be used as 'atexit' handle.
     """
     process.terminate()
+
+def byteify(data):
+    """
+    Convert unicode strings produced by the json module back to str
+
+    Args:
+        data: Decoded JSON data
+
+    Returns:
+        The same data, with all unicode strings converted to str
+    """
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    if isinstance(data, list):
+        return [byteify(item) for item in data]
+    if isinstance(data, dict):
+        return dict(
+            (byteify(key), byteify(value)) for key, value in data.items())
+    return data
+
+def format_time(timestamp):
+    """
+    Format a timestamp for printing
+
+    Args:
+        timestamp (float): Seconds since the epoch
+
+    Returns:
+        (str): The formatted local time
+    """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
@@ -0,0 +1,547 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Orchestration of concurrent operations on many devices.
+
+Operations are started as Tasks, which are futures for a function running in
+a thread of its own. The *_async functions of this module start the common
+blocking operations (command execution, cutter control, flashing and
+testing) as tasks; the blocking functions themselves remain the synchronous
+API. Waiting for a lease is started as a task with
+common.wait_for_responsive_ip_async, as aft.devices.common uses this module.
+
+Tasks are structured: a task started from within another task is its child,
+and a TaskGroup waits for all the tasks spawned into it before its block is
+left. Cancelling a task cancels its children. If a task of a group fails or
+the group times out, the rest of the group is cancelled.
+
+Python threads cannot be interrupted, so cancellation is cooperative. A
+cancelled task has the process groups of the commands it is running killed
+(see aft.tools.process_engine), and checkpoint() and sleep() raise
+aft.errors.AFTCancelledError in it. Anything else runs until it returns.
+"""
+
+import sys
+import time
+import threading
+
+from aft.logger import Logger as logger
+import aft.errors as errors
+import aft.tools.misc as misc
+import aft.tools.ssh as ssh
+import aft.tools.process_engine as process_engine
+
+# The task running in the current thread
+_current = threading.local()
+
+
+def current_task():
+    """
+    Return the task running in the calling thread
+
+    Returns:
+        (Task or None): The task, or None if not called from a task
+    """
+    return getattr(_current, "task", None)
+
+
+def checkpoint():
+    """
+    Raise if the task running in the calling thread has been cancelled
+
+    Returns:
+        None
+
+    Raises:
+        aft.errors.AFTCancelledError: If the task has been cancelled
+    """
+    task = current_task()
+    if task and task.cancelled():
+        raise errors.AFTCancelledError(task.name + " was cancelled")
+
+
+def sleep(seconds):
+    """
+    time.sleep that ends early if the task running in the calling thread is
+    cancelled
+
+    Args:
+        seconds (float): Time to sleep
+
+    Returns:
+        None
+
+    Raises:
+        aft.errors.AFTCancelledError: If the task has been cancelled
+    """
+    task = current_task()
+    if not task:
+        time.sleep(seconds)
+        return
+    task._cancel_event.wait(seconds)
+    checkpoint()
+
+
+def _on_process_start(kill):
+    """
+    Process engine hook that kills the processes of cancelled tasks
+    """
+    task = current_task()
+    if not task:
+        return None
+
+    task.add_cancel_callback(kill)
+    if task.cancelled():
+        kill()
+    return lambda: task.remove_cancel_callback(kill)
+
+process_engine.add_start_hook(_on_process_start)
+
+
+class Task(object):
+    """
+    A function running in a thread of its own
+
+    Attributes:
+        name (str): Name of the task
+        _function (function): The function
+        _args (tuple): Positional arguments of the function
+        _kwargs (dictionary): Keyword arguments of the function
+        _log_prefix (str or None):
+            Log file prefix of the task, or None to log into the log files of
+            the thread that started it
+        _lock (threading.Lock): Protects the callback lists
+        _cancel_event (threading.Event): Set when the task is cancelled
+        _done_event (threading.Event): Set when the function has returned
+        _cancel_callbacks (list(function)): Called when the task is cancelled
+        _done_callbacks (list(function)): Called with the task when done
+        _children (list(Task)): Tasks started from within this task
+        _result: Return value of the function
+        _exception (tuple): sys.exc_info() if the function raised
+    """
+
+    def __init__(self, function, args=(), kwargs=None, name=None,
+                 log_prefix=None):
+        """
+        Constructor
+
+        Args:
+            function (function): The function
+            args (tuple): Positional arguments of the function
+            kwargs (dictionary): Keyword arguments of the function
+            name (str): Name of the task, for messages
+            log_prefix (str or None):
+                Log file prefix for the task, see Logger.init_thread. If None,
+                the task logs into the log files of the thread starting it.
+        """
+        self.name = name or getattr(function, "__name__", "task")
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._log_prefix = log_prefix
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._done_event = threading.Event()
+        self._cancel_callbacks = []
+        self._done_callbacks = []
+        self._children = []
+        self._result = None
+        self._exception = None
+
+    def start(self):
+        """
+        Start the task. A task started from within another task becomes its
+        child.
+
+        Returns:
+            (Task): The task itself
+        """
+        parent = current_task()
+        if parent:
+            parent._add_child(self)
+            self.add_done_callback(parent._remove_child)
+
+        # Loggers are per thread name. Share those of the starting thread,
+        # unless the task has log files of its own.
+        thread_name = threading.current_thread().name
+        if self._log_prefix not in (None, logger.THREADS.get(thread_name)):
+            thread_name = "task-" + self._log_prefix
+
+        thread = threading.Thread(target=self._run, name=thread_name)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _run(self):
+        """
+        Body of the task thread
+        """
+        _current.task = self
+        if threading.current_thread().name not in logger.THREADS:
+            logger.init_thread(self._log_prefix or "")
+
+        try:
+            checkpoint()
+            self._result = self._function(*self._args, **self._kwargs)
+        except BaseException:
+            self._exception = sys.exc_info()
+            if not self.cancelled():
+                logger.info(self.name + " failed: " + str(self._exception[1]))
+
+        with self._lock:
+            self._done_event.set()
+            callbacks = list(self._done_callbacks)
+        for callback in callbacks:
+            callback(self)
+
+    def _add_child(self, task):
+        """
+        Add a child task. It is cancelled right away if this task already is.
+        """
+        with self._lock:
+            self._children.append(task)
+        if self.cancelled():
+            task.cancel()
+
+    def _remove_child(self, task):
+        """
+        Forget a child task that is done
+        """
+        with self._lock:
+            self._children.remove(task)
+
+    def add_cancel_callback(self, callback):
+        """
+        Register a function without arguments called when the task is
+        cancelled
+
+        Args:
+            callback (function): The function
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._cancel_callbacks.append(callback)
+
+    def remove_cancel_callback(self, callback):
+        """
+        Unregister a function registered with add_cancel_callback
+
+        Args:
+            callback (function): The function
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if callback in self._cancel_callbacks:
+                self._cancel_callbacks.remove(callback)
+
+    def add_done_callback(self, callback):
+        """
+        Register a function called with the task when it is done. If the task
+        is already done, the function is called right away.
+
+        Args:
+            callback (function): The function
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if not self._done_event.is_set():
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        """
+        Cancel the task and its children
+
+        Returns:
+            (boolean): False if the task was already done
+        """
+        with self._lock:
+            if self._done_event.is_set():
+                return False
+            self._cancel_event.set()
+            callbacks = list(self._cancel_callbacks)
+            children = list(self._children)
+
+        logger.info("Cancelling " + self.name)
+        for callback in callbacks:
+            callback()
+        for child in children:
+            child.cancel()
+        return True
+
+    def cancelled(self):
+        """
+        Returns:
+            (boolean): True if the task has been cancelled
+        """
+        return self._cancel_event.is_set()
+
+    def done(self):
+        """
+        Returns:
+            (boolean): True if the function of the task has returned
+        """
+        return self._done_event.is_set()
+
+    def failed(self):
+        """
+        Returns:
+            (boolean): True if the task is done and did not succeed
+        """
+        return self.done() and (self.cancelled() or bool(self._exception))
+
+    def wait(self, timeout=None):
+        """
+        Wait for the task to be done
+
+        Args:
+            timeout (float or None): Maximum time to wait, in seconds
+
+        Returns:
+            (boolean): True if the task is done
+        """
+        if timeout is None:
+            # Event.wait() without a timeout blocks without polling
+            self._done_event.wait()
+        else:
+            self._done_event.wait(max(timeout, 0))
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the task and return the return value of its function
+
+        Args:
+            timeout (float or None): Maximum time to wait, in seconds
+
+        Returns:
+            The return value of the function
+
+        Raises:
+            aft.errors.AFTTimeoutError: If the task is not done in time
+            aft.errors.AFTCancelledError: If the task was cancelled
+            The exception the function raised, if any
+        """
+        if not self.wait(timeout):
+            raise errors.AFTTimeoutError(
+                self.name + " did not finish in " + str(timeout) + " seconds")
+        if self.cancelled():
+            raise errors.AFTCancelledError(self.name + " was cancelled")
+        if self._exception:
+            raise self._exception[0], self._exception[1], self._exception[2]
+        return self._result
+
+
+class TaskGroup(object):
+    """
+    Context manager that waits for the tasks spawned into it when its block
+    is left. If a task fails, or the group does not finish within its
+    timeout, the remaining tasks are cancelled and the error is raised.
+
+        with orchestration.TaskGroup(timeout=3600) as group:
+            for device in devices:
+                group.spawn(flash, (device,), log_prefix=device.name + "_")
+        results = group.results()
+
+    Attributes:
+        _timeout (float or None): Seconds the group may run
+        _cancel_on_error (boolean):
+            Whether a failing task cancels the others
+        _tasks (list(Task)): The spawned tasks
+        _changed (threading.Event): Set whenever a task is done
+        _deadline (float): Monotonic time when the group times out
+    """
+
+    def __init__(self, timeout=None, cancel_on_error=True):
+        """
+        Constructor
+
+        Args:
+            timeout (float or None): Seconds the group may run
+            cancel_on_error (boolean):
+                If False, the tasks are independent: a failing task does not
+                cancel the others, and the errors are left for results()
+        """
+        self._timeout = timeout
+        self._cancel_on_error = cancel_on_error
+        self._tasks = []
+        self._changed = threading.Event()
+        self._deadline = None
+
+    def __enter__(self):
+        if self._timeout is not None:
+            self._deadline = process_engine.monotonic() + self._timeout
+        return self
+
+    def spawn(self, function, args=(), kwargs=None, name=None,
+              log_prefix=None):
+        """
+        Start a task in the group. See Task.
+
+        Returns:
+            (Task): The started task
+        """
+        task = Task(function, args, kwargs, name, log_prefix)
+        self._tasks.append(task)
+        task.add_done_callback(lambda _: self._changed.set())
+        return task.start()
+
+    def cancel(self):
+        """
+        Cancel all the tasks of the group
+
+        Returns:
+            None
+        """
+        for task in self._tasks:
+            task.cancel()
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type:
+            self.cancel()
+            self._wait_all()
+            return False
+
+        while True:
+            self._changed.clear()
+            pending = [task for task in self._tasks if not task.done()]
+            if self._cancel_on_error:
+                failed = [task for task in self._tasks if task.failed()]
+                if failed:
+                    self.cancel()
+                    self._wait_all()
+                    # Raises the error of the task
+                    failed[0].result()
+            if not pending:
+                return False
+
+            if self._deadline is None:
+                self._changed.wait()
+                continue
+
+            remaining = self._deadline - process_engine.monotonic()
+            if remaining <= 0:
+                logger.warning("Task group timed out, cancelling " +
+                               ", ".join(task.name for task in pending))
+                self.cancel()
+                self._wait_all()
+                raise errors.AFTTimeoutError(
+                    "Tasks did not finish in " + str(self._timeout) +
+                    " seconds: " + ", ".join(task.name for task in pending))
+            self._changed.wait(remaining)
+
+    def _wait_all(self):
+        """
+        Wait until every task of the group is done
+        """
+        for task in self._tasks:
+            task.wait()
+
+    def results(self):
+        """
+        Return the results of the tasks, in the order they were spawned
+
+        Returns:
+            (list): The return values of the task functions
+
+        Raises:
+            The error of the first failed task, if any
+        """
+        return [task.result() for task in self._tasks]
+
+
+def spawn(function, args=(), kwargs=None, name=None, log_prefix=None):
+    """
+    Start a task. See Task.
+
+    Returns:
+        (Task): The started task
+    """
+    return Task(function, args, kwargs, name, log_prefix).start()
+
+
+def local_execute_async(command, timeout=60, ignore_return_codes=None):
+    """
+    Start misc.local_execute as a task
+
+    Returns:
+        (Task): The task; its result is the command output
+    """
+    return spawn(misc.local_execute, (command, timeout, ignore_return_codes),
+                 name=" ".join(command))
+
+
+def remote_execute_async(remote_ip, command, timeout=60,
+                         ignore_return_codes=None, user="root"):
+    """
+    Start ssh.remote_execute as a task
+
+    Returns:
+        (Task): The task; its result is the command output
+    """
+    return spawn(ssh.remote_execute,
+                 (remote_ip, command, timeout, ignore_return_codes, user),
+                 name=str(remote_ip) + ": " + " ".join(command))
+
+
+def connect_async(cutter):
+    """
+    Start powering on a device through its cutter as a task
+
+    Returns:
+        (Task): The task
+    """
+    return spawn(cutter.connect, name="connect " + str(cutter))
+
+
+def disconnect_async(cutter):
+    """
+    Start powering off a device through its cutter as a task
+
+    Returns:
+        (Task): The task
+    """
+    return spawn(cutter.disconnect, name="disconnect " + str(cutter))
+
+
+def write_image_async(device, file_name, force=False):
+    """
+    Start flashing a device as a task. The task logs into the log files of the
+    device (<device name>_aft.log etc.).
+
+    Returns:
+        (Task): The task
+    """
+    return spawn(device.write_image, (file_name,), {"force": force},
+                 name="flash " + device.name,
+                 log_prefix=device.name + "_")
+
+
+def test_async(device, test_case):
+    """
+    Start running a test case on a device as a task. The task logs into the
+    log files of the device.
+
+    Returns:
+        (Task): The task; its result is the test result
+    """
+    return spawn(device.test, (test_case,),
+                 name="test " + device.name,
+                 log_prefix=device.name + "_")
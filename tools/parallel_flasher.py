@@ -0,0 +1,170 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Parallel flasher. Reserve several devices of a model, flash the same image on
+all of them and run the test plan on each, concurrently.
+
+Every device is handled in its own task with its own log files
+(<device name>_aft.log etc.). The test results of all the devices are
+collected into one xunit report, results.xml, with one testsuite per device.
+"""
+
+import sys
+from xml.sax.saxutils import quoteattr
+
+from aft.logger import Logger as logger
+import aft.devices.common as common
+import aft.tools.image_state as image_state
+import aft.tools.orchestration as orchestration
+from aft.tester import Tester, save_merged_results
+
+
+def flash_parallel(args, device_manager):
+    """
+    Flash and test args.parallel devices of the model args.machine
+
+    Args:
+        args (argparse namespace argument object): Program arguments
+        device_manager (aft.devicesmanager): Device manager
+
+    Returns:
+        (integer): 0 if every device was flashed and tested, 1 otherwise
+    """
+    print("Reserving " + str(args.parallel) + " " + args.machine + " devices")
+    devices = device_manager.reserve_many(
+        args.machine,
+        args.parallel,
+        image_hash=image_state.get_requested_image_hash(args))
+    print("Reserved " + ", ".join(device.name for device in devices))
+
+    group = orchestration.TaskGroup(cancel_on_error=False)
+    try:
+        # Tasks run in threads, not Processes, so that the atexit handlers
+        # stopping the serial recorders are run. See
+        # device_configuration_checker.
+        with group:
+            for device in devices:
+                group.spawn(
+                    _flash_and_test,
+                    (args, device),
+                    name=device.name,
+                    log_prefix=device.name + "_")
+    finally:
+        for device in devices:
+            if not args.nopoweroff:
+                device.detach()
+            device_manager.release(device)
+
+    results = dict(
+        (device.name, outcome)
+        for device, outcome in zip(devices, group.results()))
+
+    if not args.notest:
+        location = save_merged_results(
+            [results[name][1] for name in sorted(results)])
+        print("Results of all devices saved to " + location)
+
+    failed = sorted(name for name in results if not results[name][0])
+    if failed:
+        print("Failed on " + ", ".join(failed))
+        logger.info("Parallel run failed on " + ", ".join(failed))
+        return 1
+    return 0
+
+
+def _flash_and_test(args, device):
+    """
+    Flash and test a single device. Run in a task of its own.
+
+    Args:
+        args (argparse namespace argument object): Program arguments
+        device (aft.Device): The reserved device
+
+    Returns:
+        Tuple (success, xunit testsuite)
+    """
+    testsuite_name = "aft." + device.name
+
+    try:
+        if args.record:
+            device.parameters["serial_log_name"] = device.name + "_serial.log"
+            device.record_serial()
+
+        if not args.noflash:
+            _flash(args, device)
+
+        if args.notest:
+            return (True, "")
+
+        tester = Tester(
+            device,
+            device.name + "_results.xml",
+            test_plan_name=args.test_plan)
+        print("Testing " + device.name + ".")
+        tester.execute()
+        return (True, tester.get_xunit_testsuite(testsuite_name))
+
+    except:
+        _err = sys.exc_info()
+        _err = str(_err[0]).split("'")[1] + ": " + str(_err[1])
+        logger.error(_err)
+        print(device.name + ": " + _err)
+        return (False, _get_error_testsuite(testsuite_name, _err))
+
+
+def _flash(args, device):
+    """
+    Flash the image, retrying up to args.flash_retries times. Blacklist the
+    device if every attempt fails.
+
+    Args:
+        args (argparse namespace argument object): Program arguments
+        device (aft.Device): The device
+
+    Raises:
+        The error of the last attempt, if all the attempts failed
+    """
+    for attempt in range(1, args.flash_retries + 1):
+        try:
+            print("Flashing " + device.name + ", attempt " + str(attempt) +
+                  " of " + str(args.flash_retries) + ".")
+            device.write_image(args.file_name, force=args.force_flash)
+            print("Flashing " + device.name + " successful.")
+            return
+        except:
+            _err = sys.exc_info()
+            logger.error(str(_err[0]).split("'")[1] + ": " + str(_err[1]))
+            if attempt == args.flash_retries:
+                msg = "Flashing failed " + str(attempt) + " times"
+                print(msg + ", blacklisting " + device.name)
+                logger.info(msg + ", blacklisting " + device.name)
+                common.blacklist_device(device.dev_id, device.name, msg)
+                raise
+
+
+def _get_error_testsuite(name, message):
+    """
+    Return an xunit testsuite reporting that a device could not be tested
+
+    Args:
+        name (str): Name of the testsuite
+        message (str): The error
+
+    Returns:
+        (str): The testsuite element
+    """
+    return ('<testsuite errors="1" failures="0" name={0} skips="0" '
+            'tests="1" time="0">\n'
+            '<testcase name="flash_and_test">'
+            '<error message={1}/></testcase>\n'
+            '</testsuite>\n').format(quoteattr(name), quoteattr(message))
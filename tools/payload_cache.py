@@ -0,0 +1,251 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Content addressed cache for test data pushed to the devices.
+
+Payloads (files or whole directories) are stored on the device under
+config.DUT_PAYLOAD_CACHE, named by the SHA-1 of their contents. A push first
+checks whether the device already holds the content, and only transfers it
+if not. Files are copied over compressed scp and checksummed on the device
+before they are accepted into the cache; directories are streamed as one
+compressed tar archive. The payload is then copied from the cache to its
+destination on the device.
+
+The cache lives on the flashed root filesystem, so flashing the device
+empties it. As flashing is skipped when the device already holds the image,
+the cache is also limited to config.DUT_PAYLOAD_CACHE_SIZE megabytes; the
+least recently used payloads are removed when it grows beyond that.
+
+The bytes transferred and skipped are counted per job (per thread, see
+pop_statistics).
+"""
+
+import os
+import pipes
+import hashlib
+import threading
+import subprocess32
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.tools.ssh as ssh
+import aft.tools.image_state as image_state
+
+# Removes the least recently used payloads from the cache once the payloads
+# used more recently take up the size limit, in kilobytes. The payload just
+# used is never removed.
+_EVICTION_COMMAND = (
+    "cd {cache} && total=0 && "
+    "for entry in $(ls -t); do "
+    "total=$((total + $(du -sk \"$entry\" | cut -f1))); "
+    "if [ $total -gt {limit} ] && [ \"$entry\" != {keep} ]; then "
+    "rm -rf \"$entry\"; "
+    "fi; "
+    "done")
+
+# Thread name -> transfer statistics
+_statistics = {}
+_lock = threading.Lock()
+
+
+def push(remote_ip, source, destination, timeout=600, user="root"):
+    """
+    Push a file or a directory into a directory on the device, unless the
+    device already holds the same content
+
+    Args:
+        remote_ip (str): Device ip address
+        source (str): The local file or directory
+        destination (str): The remote directory
+        timeout (integer): Timeout in seconds for the transfer
+        user (str): User that will be used with ssh
+
+    Returns:
+        (str): Path of the payload on the device
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired
+        subprocess32.CalledProcessError:
+            If the transfer or copying the payload into place failed
+    """
+    is_directory = os.path.isdir(source)
+    if is_directory:
+        content_hash, size = _hash_directory(source)
+    else:
+        content_hash = image_state.get_image_hash(source)
+        size = os.path.getsize(source)
+
+    cached = os.path.join(config.DUT_PAYLOAD_CACHE, content_hash)
+    target = os.path.join(destination, os.path.basename(source.rstrip("/")))
+
+    if _is_cached(remote_ip, cached, content_hash, is_directory, user):
+        logger.info(source + " is already cached on the device as " + cached)
+        _record(0, size)
+    else:
+        logger.info("Pushing " + source + " to the device cache as " + cached)
+        if is_directory:
+            _push_directory(remote_ip, source, cached, timeout, user)
+        else:
+            _push_file(remote_ip, source, cached, content_hash, timeout, user)
+        _record(size, 0)
+
+    ssh.remote_execute_batch(
+        remote_ip,
+        [
+            ["mkdir", "-p", destination],
+            ["rm", "-rf", target],
+            ["cp", "-a", cached, target],
+            # The modification time orders the payloads for eviction
+            ["touch", cached],
+            {
+                "command": [_EVICTION_COMMAND.format(
+                    cache=pipes.quote(config.DUT_PAYLOAD_CACHE),
+                    limit=int(config.DUT_PAYLOAD_CACHE_SIZE) * 1024,
+                    keep=content_hash)],
+                # A failed eviction leaves the cache larger, but the payload
+                # is in place
+                "ignore_return_codes": [1]
+            }],
+        user=user)
+    return target
+
+
+def _hash_directory(directory):
+    """
+    Compute the content hash of a directory, covering the relative paths and
+    the contents of its files
+
+    Args:
+        directory (str): The directory
+
+    Returns:
+        Tuple (hash as a hex string, total size of the files in bytes)
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    for root, directories, files in os.walk(directory):
+        directories.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, directory)
+            sha1.update(relative_path + "\0")
+            if os.path.islink(path):
+                sha1.update("link:" + os.readlink(path) + "\0")
+                continue
+            sha1.update(image_state.get_image_hash(path) + "\0")
+            size += os.path.getsize(path)
+        for name in directories:
+            sha1.update(os.path.relpath(os.path.join(root, name), directory) +
+                        "/\0")
+    return sha1.hexdigest(), size
+
+
+def _is_cached(remote_ip, cached, content_hash, is_directory, user):
+    """
+    Check whether the device cache holds the content. Cached files are
+    checksummed; directories are only put in place once they are complete.
+
+    Returns:
+        (boolean): True if the content is cached
+    """
+    if is_directory:
+        command = ["test", "-d", cached]
+    else:
+        command = ["sha1sum", cached]
+
+    results = ssh.remote_execute_batch(
+        remote_ip,
+        [
+            ["mkdir", "-p", config.DUT_PAYLOAD_CACHE],
+            command],
+        stop_on_error=False,
+        user=user)
+
+    if results[0]["returncode"] != 0:
+        raise subprocess32.CalledProcessError(
+            returncode=results[0]["returncode"],
+            cmd=results[0]["command"],
+            output=results[0]["output"])
+
+    if results[1]["returncode"] != 0:
+        return False
+    if is_directory:
+        return True
+    return results[1]["output"].split()[0] == content_hash
+
+
+def _push_file(remote_ip, source, cached, content_hash, timeout, user):
+    """
+    Copy a file into the device cache, and verify its checksum on the device
+    """
+    partial = cached + ".part"
+    ssh.push(remote_ip, source, partial, timeout=timeout, user=user,
+             compress=True)
+
+    output = ssh.remote_execute(remote_ip, ["sha1sum", partial], user=user)
+    if output.split()[0] != content_hash:
+        ssh.remote_execute(remote_ip, ["rm", "-f", partial], user=user)
+        raise subprocess32.CalledProcessError(
+            returncode=1,
+            cmd="sha1sum " + partial,
+            output="Checksum mismatch after transfer: " + output)
+
+    ssh.remote_execute(remote_ip, ["mv", "-f", partial, cached], user=user)
+
+
+def _push_directory(remote_ip, source, cached, timeout, user):
+    """
+    Stream a directory into the device cache. It is moved into place only once
+    it has been transferred completely.
+    """
+    partial = cached + ".part"
+    ssh.remote_execute(remote_ip, ["rm", "-rf", partial], user=user)
+    ssh.push_directory(remote_ip, source, partial, timeout=timeout, user=user)
+    ssh.remote_execute(remote_ip, ["mv", partial, cached], user=user)
+
+
+def _record(transferred, skipped):
+    """
+    Add to the transfer statistics of the calling thread
+    """
+    with _lock:
+        statistics = _statistics.setdefault(
+            threading.current_thread().name,
+            {"pushes": 0, "bytes_transferred": 0, "bytes_skipped": 0})
+        statistics["pushes"] += 1
+        statistics["bytes_transferred"] += transferred
+        statistics["bytes_skipped"] += skipped
+
+    logger.info("Payload cache: " + str(transferred) + " bytes transferred, " +
+                str(skipped) + " bytes skipped")
+
+
+def pop_statistics():
+    """
+    Return and reset the payload transfer statistics of the job running in
+    the calling thread. Long running processes run every job in a thread of
+    its own, so the statistics of finished jobs must not be left behind.
+
+    Returns:
+        Dictionary with the following format:
+        {
+            "pushes": number of payloads pushed,
+            "bytes_transferred": bytes actually transferred,
+            "bytes_skipped": bytes not transferred as the device had them
+        }
+    """
+    with _lock:
+        return _statistics.pop(
+            threading.current_thread().name,
+            {"pushes": 0, "bytes_transferred": 0, "bytes_skipped": 0})
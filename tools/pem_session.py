@@ -0,0 +1,233 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Long-lived PEM (peripheral emulator) session of a device.
+
+PEM has no timeouts of its own and blocks forever if the device does not
+answer, so it has to run in a process that can be killed. Instead of forking
+a process for every keystroke playback, a session keeps one worker process
+per device, which plays back keystroke files on request. The worker is only
+replaced if a playback times out or is cancelled.
+"""
+
+import os
+import multiprocessing
+
+from aft.logger import Logger as logger
+import aft.errors as errors
+import aft.tools.orchestration as orchestration
+import aft.tools.process_engine as process_engine
+
+from pem.main import main as pem_main
+
+# Seconds between checks for cancellation while waiting for the worker
+_CANCEL_CHECK_INTERVAL = 0.1
+
+
+def _serve(connection, interface, port):
+    """
+    Body of the worker process. Plays back the keystroke files received
+    through the connection, and answers with ("done", None) or
+    ("error", exception) for each.
+    """
+    connection.send(("ready", None))
+    while True:
+        try:
+            keystrokes = connection.recv()
+        except EOFError:
+            # The session has been closed
+            return
+
+        try:
+            pem_main(
+                [
+                    "pem",
+                    "--interface", interface,
+                    "--port", port,
+                    "--playback", keystrokes
+                ])
+        except Exception as err:
+            connection.send(("error", err))
+            continue
+        connection.send(("done", None))
+
+
+class PEMSession(object):
+    """
+    PEM session of a device
+
+    Attributes:
+        _interface (str): PEM interface, such as serialconnection
+        _port (str): PEM port, such as /dev/ttyUSB0
+        _process (multiprocessing.Process or None): The worker process
+        _connection (multiprocessing.Connection or None):
+            Connection to the worker process
+        _pid (integer or None): The process that started the worker
+        _statistics (dictionary): See get_statistics
+    """
+
+    def __init__(self, interface, port):
+        """
+        Constructor. The worker is started on first use.
+
+        Args:
+            interface (str): PEM interface, such as serialconnection
+            port (str): PEM port, such as /dev/ttyUSB0
+        """
+        self._interface = interface
+        self._port = port
+        self._process = None
+        self._connection = None
+        self._pid = None
+        self._statistics = {
+            "worker_starts": 0,
+            "playbacks": 0,
+            "timeouts": 0,
+            "latency": 0.0
+        }
+
+    def play(self, keystrokes, timeout=60):
+        """
+        Play back a keystroke file
+
+        Args:
+            keystrokes (str): PEM keystroke file
+            timeout (float): Timeout in seconds, including starting the worker
+
+        Returns:
+            (float): Seconds the playback took, including connecting to PEM
+
+        Raises:
+            aft.errors.AFTTimeoutError:
+                If the playback did not finish within timeout
+            aft.errors.AFTCancelledError:
+                If the task running the playback was cancelled
+            The error raised by PEM, if any
+        """
+        start = process_engine.monotonic()
+        deadline = start + timeout
+
+        if not self._is_running():
+            self._start_worker(deadline)
+
+        self._connection.send(keystrokes)
+        status, error = self._receive(deadline, "playing back " + keystrokes)
+        latency = process_engine.monotonic() - start
+
+        self._statistics["playbacks"] += 1
+        self._statistics["latency"] += latency
+        logger.info("PEM playback of " + keystrokes + " took " +
+                    str(round(latency, 2)) + " seconds")
+
+        if status == "error":
+            raise error
+        return latency
+
+    def close(self):
+        """
+        Stop the worker process, if it is running
+
+        Returns:
+            None
+        """
+        if self._is_running():
+            self._process.terminate()
+            self._process.join()
+            self._connection.close()
+        self._process = None
+        self._connection = None
+
+    def get_statistics(self):
+        """
+        Return the statistics of the session
+
+        Returns:
+            Dictionary with the following format:
+            {
+                "worker_starts": number of worker processes started,
+                "playbacks": number of finished playbacks,
+                "timeouts": number of playbacks that timed out,
+                "mean_latency": mean duration of the finished playbacks in
+                                seconds, or None
+            }
+        """
+        statistics = dict(self._statistics)
+        latency = statistics.pop("latency")
+        statistics["mean_latency"] = None
+        if statistics["playbacks"]:
+            statistics["mean_latency"] = latency / statistics["playbacks"]
+        return statistics
+
+    def _is_running(self):
+        """
+        Check whether this process has a live worker. A forked child of the
+        process that started the worker must start one of its own.
+
+        Returns:
+            (boolean): True if the worker is running
+        """
+        return self._pid == os.getpid() and self._process is not None and \
+            self._process.is_alive()
+
+    def _start_worker(self, deadline):
+        """
+        Start the worker process and wait until it is ready
+        """
+        self._connection, worker_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(worker_connection, self._interface, self._port))
+        # Do not leave the worker behind if AFT exits
+        self._process.daemon = True
+        self._pid = os.getpid()
+
+        start = process_engine.monotonic()
+        self._process.start()
+        worker_connection.close()
+        self._receive(deadline, "starting the PEM worker")
+
+        self._statistics["worker_starts"] += 1
+        logger.info("PEM worker for " + self._port + " started in " +
+                    str(round(process_engine.monotonic() - start, 2)) +
+                    " seconds")
+
+    def _receive(self, deadline, action):
+        """
+        Wait for the answer of the worker. The worker is stopped if it does
+        not answer by the deadline, or the calling task is cancelled.
+
+        Args:
+            deadline (float): Monotonic time to wait until
+            action (str): What the worker is doing, for messages
+
+        Returns:
+            (tuple): The answer
+        """
+        try:
+            while True:
+                orchestration.checkpoint()
+                remaining = deadline - process_engine.monotonic()
+                if remaining <= 0:
+                    self._statistics["timeouts"] += 1
+                    raise errors.AFTTimeoutError(
+                        "PEM timed out " + action + " on " + self._port)
+                if self._connection.poll(
+                        min(remaining, _CANCEL_CHECK_INTERVAL)):
+                    return self._connection.recv()
+        except EOFError:
+            self.close()
+            raise errors.AFTDeviceError(
+                "PEM worker for " + self._port + " exited while " + action)
+        except:
+            self.close()
+            raise
@@ -0,0 +1,446 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Shared engine for running child processes.
+
+A single I/O thread serves the output pipes of every child process started
+through run(). It sleeps in poll() until a pipe has data or the nearest
+deadline is reached, so there is no busy waiting and timeouts are exact, also
+with hundreds of concurrent children. Process exit is detected by a thread
+per child blocked in waitpid(), as children of the child (such as an ssh
+master connection) may keep the output pipe open after it has exited.
+
+Every child runs in a process group of its own. On timeout, or when AFT
+exits, the whole group is killed, so that no grandchildren are left behind.
+
+The output is passed to the line handlers in the thread that called run(),
+as loggers are per thread.
+"""
+
+import os
+import math
+import heapq
+import fcntl
+import errno
+import select
+import signal
+import atexit
+import ctypes
+import ctypes.util
+import itertools
+import threading
+import collections
+import subprocess32
+from Queue import Queue
+
+# Bytes read from a pipe at a time
+_READ_SIZE = 64 * 1024
+
+# Number of output lines kept by run() by default
+TAIL_LINES = 100
+
+# struct timespec of clock_gettime
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+_CLOCK_MONOTONIC = 1
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_clock_gettime = _libc.clock_gettime
+_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+
+def monotonic():
+    """
+    Return the time of a clock that is not affected by system clock changes
+
+    Returns:
+        (float): Seconds since an unspecified starting point
+    """
+    timespec = _Timespec()
+    if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+
+class _Job(object):
+    """
+    A child process served by the engine
+
+    Attributes:
+        process (subprocess32.Popen): The process
+        fd (integer): The output pipe
+        deadline (float): Monotonic time when the process is killed
+        events (Queue.Queue):
+            Output chunks (str) followed by the return code (integer)
+        timed_out (boolean): True if the process was killed on timeout
+        exited (boolean): True once the process has exited
+    """
+
+    def __init__(self, process, deadline):
+        self.process = process
+        self.fd = process.stdout.fileno()
+        self.deadline = deadline
+        self.events = Queue()
+        self.timed_out = False
+        self.exited = False
+
+
+class ProcessEngine(object):
+    """
+    The engine. Use the module level run() instead of creating more of these.
+
+    Attributes:
+        _lock (threading.Lock): Protects the attributes below
+        _jobs (dictionary): Output pipe -> _Job, for the unfinished jobs
+        _new_jobs (list(_Job)): Jobs not yet registered by the I/O thread
+        _exited_jobs (list(_Job)): Jobs whose process has exited
+        _thread (threading.Thread): The I/O thread, once started
+        _sequence (itertools.count): Orders jobs with the same deadline
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._new_jobs = []
+        self._exited_jobs = []
+        self._thread = None
+        self._sequence = itertools.count()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            _set_nonblocking(fd)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    def start(self, command, timeout):
+        """
+        Start a child process
+
+        Args:
+            command (list(str)): The command
+            timeout (float): Seconds until the process group is killed
+
+        Returns:
+            (_Job): The job, whose events receive the output and return code
+        """
+        process = subprocess32.Popen(command,
+                                     stdout=subprocess32.PIPE,
+                                     stderr=subprocess32.STDOUT,
+                                     start_new_session=True)
+        _set_nonblocking(process.stdout.fileno())
+        job = _Job(process, monotonic() + timeout)
+
+        with self._lock:
+            self._new_jobs.append(job)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._serve)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake_up()
+
+        waiter = threading.Thread(target=self._wait, args=(job,))
+        waiter.daemon = True
+        waiter.start()
+        return job
+
+    def kill_all(self):
+        """
+        Kill the process groups of all the running jobs
+
+        Returns:
+            None
+        """
+        with self._lock:
+            jobs = list(self._jobs.values()) + self._new_jobs
+        for job in jobs:
+            _kill_group(job.process)
+
+    def _wait(self, job):
+        """
+        Wait for the process of a job to exit, and tell the I/O thread
+        """
+        job.process.wait()
+        with self._lock:
+            self._exited_jobs.append(job)
+        self._wake_up()
+
+    def _wake_up(self):
+        """
+        Interrupt the poll() of the I/O thread
+        """
+        try:
+            os.write(self._wakeup_write, "x")
+        except OSError as err:
+            # The pipe is full, so the thread will wake up anyway
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def _serve(self):
+        """
+        The I/O thread
+        """
+        poller = select.poll()
+        poller.register(self._wakeup_read, select.POLLIN)
+        deadlines = []
+
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(
+                    int(math.ceil((deadlines[0][0] - monotonic()) * 1000)), 0)
+
+            for fd, _ in _retry_on_eintr(poller.poll, timeout):
+                if fd == self._wakeup_read:
+                    _drain(fd)
+                    continue
+                job = self._jobs.get(fd)
+                if job and not self._read(job):
+                    poller.unregister(fd)
+
+            with self._lock:
+                new_jobs, self._new_jobs = self._new_jobs, []
+                exited_jobs, self._exited_jobs = self._exited_jobs, []
+                for job in new_jobs:
+                    self._jobs[job.fd] = job
+
+            for job in new_jobs:
+                poller.register(job.fd, select.POLLIN)
+                heapq.heappush(
+                    deadlines, (job.deadline, next(self._sequence), job))
+
+            for job in exited_jobs:
+                job.exited = True
+                # Whatever is left in the pipe now belongs to the job; output
+                # written later by its children is not waited for
+                self._read(job)
+                try:
+                    poller.unregister(job.fd)
+                except KeyError:
+                    # Unregistered already when the pipe was closed
+                    pass
+                with self._lock:
+                    del self._jobs[job.fd]
+                job.process.stdout.close()
+                job.events.put(job.process.returncode)
+
+            now = monotonic()
+            while deadlines and (deadlines[0][2].exited or
+                                 deadlines[0][0] <= now):
+                job = heapq.heappop(deadlines)[2]
+                if not job.exited:
+                    job.timed_out = True
+                    _kill_group(job.process)
+
+    @staticmethod
+    def _read(job):
+        """
+        Read the available output of a job
+
+        Returns:
+            (boolean): False if the pipe has been closed
+        """
+        while True:
+            try:
+                data = os.read(job.fd, _READ_SIZE)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return True
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                return False
+            job.events.put(data)
+
+
+def _set_nonblocking(fd):
+    """
+    Set O_NONBLOCK on a file descriptor
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _drain(fd):
+    """
+    Read everything available from a non-blocking pipe
+    """
+    try:
+        while os.read(fd, _READ_SIZE):
+            pass
+    except OSError as err:
+        if err.errno != errno.EAGAIN:
+            raise
+
+
+def _retry_on_eintr(function, *args):
+    """
+    Call function, retrying if a signal interrupts it
+    """
+    while True:
+        try:
+            return function(*args)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+
+def _kill_group(process):
+    """
+    Kill the process group of a child process
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError as err:
+        # The group is already gone
+        if err.errno != errno.ESRCH:
+            raise
+
+
+_engine = ProcessEngine()
+
+# Do not leave children behind
+atexit.register(_engine.kill_all)
+
+# Functions called by run() for every started process, see add_start_hook
+_start_hooks = []
+
+
+def add_start_hook(hook):
+    """
+    Register a function that run() calls in the calling thread whenever it has
+    started a process
+
+    Args:
+        hook (function):
+            Called with a function without arguments that kills the process
+            group. May return a function that is called once the process has
+            finished.
+
+    Returns:
+        None
+    """
+    _start_hooks.append(hook)
+
+
+def run(command, line_handler=None, timeout=60, tail_lines=TAIL_LINES):
+    """
+    Run a command, passing its combined stdout and stderr to line_handler one
+    line at a time as it is produced. Only the last tail_lines lines are kept,
+    so output of any size can be handled.
+
+    Carriage returns end lines as well, so that progress meters that rewrite
+    their line are seen as a line per update. Line ends are passed on as \n.
+
+    Args:
+        command (list(str)): The command
+        line_handler (function):
+            Called with each output line, including its line terminator
+        timeout (float): Timeout in seconds. The process group is killed if
+                         the process has not finished by then
+        tail_lines (integer): Number of lines kept for the return value
+
+    Returns:
+        Tuple (return code, the last tail_lines lines of output)
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired. The output of the error is the output tail.
+    """
+    job = _engine.start(command, timeout)
+    tail = collections.deque(maxlen=tail_lines)
+
+    def handle(line):
+        # Line ends are converted to \n, like universal_newlines does
+        if line[-1] in "\r\n":
+            line = line.rstrip("\r\n") + "\n"
+        tail.append(line)
+        if line_handler:
+            line_handler(line)
+
+    finish_hooks = []
+    lines = _LineSplitter(handle)
+    try:
+        for hook in _start_hooks:
+            finish_hooks.append(hook(lambda: _kill_group(job.process)))
+
+        while True:
+            event = job.events.get()
+            if isinstance(event, str):
+                lines.feed(event)
+            else:
+                lines.close()
+                break
+    except:
+        # A line handler failed; do not leave the process running
+        _kill_group(job.process)
+        raise
+    finally:
+        for finish_hook in finish_hooks:
+            if finish_hook:
+                finish_hook()
+
+    if job.timed_out:
+        raise subprocess32.TimeoutExpired(cmd=command,
+                                          output="".join(tail),
+                                          timeout=timeout)
+    return event, "".join(tail)
+
+
+class _LineSplitter(object):
+    """
+    Splits output chunks into lines ended by \n, \r\n or \r
+    """
+
+    def __init__(self, handle):
+        """
+        Constructor
+
+        Args:
+            handle (function): Called with each line
+        """
+        self._handle = handle
+        self._pending = ""
+
+    def feed(self, data):
+        """
+        Split a chunk of output
+        """
+        self._pending += data
+        # A \r\n may be split between two chunks
+        end = len(self._pending)
+        if self._pending.endswith("\r"):
+            end -= 1
+
+        start = 0
+        while True:
+            newline = self._pending.find("\n", start, end)
+            carriage_return = self._pending.find("\r", start, end)
+            if newline == -1 and carriage_return == -1:
+                break
+            if carriage_return == -1 or -1 < newline < carriage_return:
+                line_end = newline + 1
+            elif self._pending[carriage_return + 1:carriage_return + 2] == "\n":
+                line_end = carriage_return + 2
+            else:
+                line_end = carriage_return + 1
+            self._handle(self._pending[start:line_end])
+            start = line_end
+        self._pending = self._pending[start:]
+
+    def close(self):
+        """
+        Pass on the last line, if it has no line end
+        """
+        if self._pending:
+            self._handle(self._pending)
+            self._pending = ""
@@ -0,0 +1,834 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Optional reservation broker daemon.
+
+The broker owns the device inventory, the blacklist and the lock state of
+the devices in memory, and serves reserve, release and status requests over
+a unix socket (config.BROKER_SOCKET). When the broker is running,
+DevicesManager forwards its reservations to it, so a reservation is a single
+round trip instead of probing every lock file.
+
+A reservation is bound to the client connection: if the client process dies,
+its devices are released automatically.
+
+The broker still takes the /var/lock/aft_<id> flocks on behalf of its
+clients, so AFT processes that do not use the broker keep working alongside
+it.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import select
+import socket
+import threading
+import SocketServer
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.errors as errors
+import aft.tools.json_socket as json_socket
+import aft.tools.reservation_queue as reservation_queue
+import aft.tools.blacklist as blacklist
+import aft.tools.selection_policies as selection_policies
+import aft.tools.federation as federation
+
+
+class BrokerClient(object):
+    """
+    Client side of the reservation broker protocol.
+
+    The client keeps its connection open for as long as it holds devices,
+    as the broker releases all the devices of a closed connection.
+    """
+
+    def __init__(self, connection):
+        """
+        Constructor
+
+        Args:
+            connection (socket.socket): Connected socket
+        """
+        self._connection = json_socket.JsonConnection(connection)
+
+    @staticmethod
+    def connect():
+        """
+        Connect to the broker
+
+        Returns:
+            (BrokerClient or None): The client, or None if the broker is not
+            running
+        """
+        connection = json_socket.connect_unix(config.BROKER_SOCKET)
+        if not connection:
+            return None
+        logger.info("Using reservation broker at " + config.BROKER_SOCKET)
+        return BrokerClient(connection)
+
+    def reserve(self, timeout, model=None, name=None, policy="topology",
+                priority="nightly", image_hash=None):
+        """
+        Reserve a device by model or by name
+
+        Args:
+            timeout (integer): Timeout in seconds
+            model (str): Device model
+            name (str): Device name
+            policy (str): Device selection policy, see
+                          aft.tools.selection_policies
+            priority (str): Reservation priority class, see
+                            aft.tools.reservation_queue.PRIORITY_CLASSES
+            image_hash (str or None): Prefer devices holding this image, see
+                                      aft.tools.image_state
+
+        Returns:
+            Tuple (str, float): The name of the reserved device and the time
+            spent waiting for it
+
+        Raises:
+            aft.errors.AFTConfigurationError if there are no matching devices
+            aft.errors.AFTTimeoutError if no device could be reserved in time
+        """
+        reply = self._request({
+            "op": "reserve",
+            "model": model,
+            "name": name,
+            "timeout": timeout,
+            "policy": policy,
+            "priority": priority,
+            "image_hash": image_hash,
+            "pid": os.getpid()})
+        return reply["devices"][0], reply["wait_time"]
+
+    def reserve_many(self, timeout, count, model=None, names=None,
+                     policy="topology", priority="nightly", image_hash=None):
+        """
+        Reserve several devices at once, all or nothing
+
+        Args:
+            timeout (integer): Timeout in seconds
+            count (integer): Number of devices
+            model (str): Device model
+            names (list(str)): Device names
+            policy (str): Device selection policy, see
+                          aft.tools.selection_policies
+            priority (str): Reservation priority class, see
+                            aft.tools.reservation_queue.PRIORITY_CLASSES
+            image_hash (str or None): Prefer devices holding this image, see
+                                      aft.tools.image_state
+
+        Returns:
+            Tuple (list(str), float): The names of the reserved devices and
+            the time spent waiting for them
+
+        Raises:
+            aft.errors.AFTConfigurationError if there are not enough matching
+            devices
+            aft.errors.AFTTimeoutError if the devices could not be reserved in
+            time
+        """
+        reply = self._request({
+            "op": "reserve",
+            "model": model,
+            "names": names,
+            "count": count,
+            "timeout": timeout,
+            "policy": policy,
+            "priority": priority,
+            "image_hash": image_hash,
+            "pid": os.getpid()})
+        return reply["devices"], reply["wait_time"]
+
+    def release(self, name):
+        """
+        Release a device
+
+        Args:
+            name (str): Name of the reserved device
+        """
+        self._request({"op": "release", "name": name})
+
+    def is_preempted(self, name):
+        """
+        Check whether a waiter of higher priority than the holder is waiting
+        for a device held through this connection
+
+        Args:
+            name (str): Name of the reserved device
+
+        Returns:
+            True if the device should be given up
+        """
+        return self._request({"op": "preempted", "name": name})["preempted"]
+
+    def status(self):
+        """
+        Query the broker state
+
+        Returns:
+            (dictionary): See ReservationBroker.get_status
+        """
+        return self._request({"op": "status"})["status"]
+
+    def _request(self, message):
+        """
+        Send a request and convert error replies into exceptions
+
+        Args:
+            message (dictionary): The request
+
+        Returns:
+            (dictionary): The reply
+        """
+        reply = self._connection.request(message)
+        if reply is None:
+            raise errors.AFTConnectionError(
+                "Reservation broker closed the connection")
+
+        error = reply.get("error")
+        if error == "timeout":
+            raise errors.AFTTimeoutError(reply["message"])
+        elif error == "configuration":
+            raise errors.AFTConfigurationError(reply["message"])
+        elif error:
+            raise errors.AFTConnectionError(
+                "Reservation broker error: " + reply["message"])
+        return reply
+
+    def close(self):
+        """
+        Close the connection, releasing every device held through it
+        """
+        self._connection.close()
+
+
+class _BrokerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Threaded unix socket server for the broker
+    """
+    daemon_threads = True
+
+
+class _BrokerRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a single client connection
+    """
+
+    def handle(self):
+        # Loggers are per thread name; share the log of the serving thread
+        # instead of creating a log file for every connection
+        threading.current_thread().name = self.server.thread_name
+
+        broker = self.server.broker
+        client = {"connection": self.connection, "devices": set()}
+        try:
+            while True:
+                message = json_socket.receive_message(self.rfile)
+                if message is None:
+                    return
+                reply = broker.handle_message(client, message)
+                json_socket.send_message(self.wfile, reply)
+        except socket.error as err:
+            logger.info("Broker client connection error: " + str(err))
+        finally:
+            broker.release_client(client)
+
+
+class ReservationBroker(object):
+    """
+    The reservation broker.
+
+    Attributes:
+        _devices (list(dictionary)): Device state in topology order
+        _devices_by_id (dictionary): Same device state, keyed by device id
+        _waiters (list(dictionary)): Waiting reservations in arrival order
+        _blacklist (dictionary): Blacklisted device id -> blacklist entry
+        _condition (threading.Condition): Protects all of the above
+    """
+
+    # How often the devices locked by processes that do not use the broker
+    # are checked, in case their owner died without notifying anyone
+    _FALLBACK_POLL_INTERVAL = 10
+
+    # How often a waiting client connection is checked for disconnection
+    _DISCONNECT_CHECK_INTERVAL = 1
+
+    def __init__(self, device_manager):
+        """
+        Constructor
+
+        Args:
+            device_manager (aft.DevicesManager):
+                Device manager which provides the device configurations
+        """
+        self._devices = []
+        self._devices_by_id = {}
+        self._devices_by_name = {}
+        for device_config in device_manager.get_configs():
+            device = {
+                "name": device_config["name"],
+                "model": device_config["model"],
+                "id": device_config["settings"]["id"],
+                "holder": None,
+                "rank": None,
+                "since": None,
+                "lockfile": None
+            }
+            self._devices.append(device)
+            self._devices_by_id[device["id"]] = device
+            self._devices_by_name[device["name"]] = device
+
+        self._waiters = []
+        self._waiter_counter = 0
+        self._blacklist = {}
+        self._blacklist_generation = None
+        self._condition = threading.Condition()
+
+        self._server = None
+        self._queue = None
+
+    def serve_forever(self):
+        """
+        Start serving requests on config.BROKER_SOCKET
+
+        Returns:
+            None
+        """
+        if json_socket.connect_unix(config.BROKER_SOCKET):
+            raise errors.AFTConfigurationError(
+                "Reservation broker is already running at " +
+                config.BROKER_SOCKET)
+
+        if os.path.exists(config.BROKER_SOCKET):
+            os.unlink(config.BROKER_SOCKET)
+
+        self._server = _BrokerServer(config.BROKER_SOCKET, _BrokerRequestHandler)
+        self._server.broker = self
+        self._server.thread_name = threading.current_thread().name
+        os.chmod(config.BROKER_SOCKET, 0666)
+
+        self._refresh_blacklist()
+
+        # Listen to the release notifications of AFT processes that do not
+        # use the broker. The ticket claims no devices.
+        self._queue = reservation_queue.ReservationQueue([])
+        notification_thread = threading.Thread(
+            target=self._notification_loop,
+            name=threading.current_thread().name)
+        notification_thread.daemon = True
+        notification_thread.start()
+
+        if config.FEDERATION_COORDINATOR:
+            publisher_thread = threading.Thread(
+                target=federation.publish_inventory,
+                args=(lambda: self.get_status()["devices"],),
+                name=threading.current_thread().name)
+            publisher_thread.daemon = True
+            publisher_thread.start()
+
+        logger.info("Reservation broker serving " + str(len(self._devices)) +
+                    " devices at " + config.BROKER_SOCKET)
+        print("Reservation broker listening at " + config.BROKER_SOCKET)
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._queue.close()
+            if os.path.exists(config.BROKER_SOCKET):
+                os.unlink(config.BROKER_SOCKET)
+
+    def _notification_loop(self):
+        """
+        Reload the blacklist and re-run the device assignment whenever
+        another process releases a device or changes the blacklist, or
+        periodically as a fallback.
+        """
+        while True:
+            self._queue.wait(self._FALLBACK_POLL_INTERVAL)
+            self._refresh_blacklist()
+            with self._condition:
+                if self._waiters and self._assign():
+                    self._condition.notify_all()
+
+    def handle_message(self, client, message):
+        """
+        Handle a single request
+
+        Args:
+            client (dictionary): Client connection state
+            message (dictionary): The request
+
+        Returns:
+            (dictionary): The reply
+        """
+        operation = message.get("op")
+        try:
+            if operation == "reserve":
+                return self._reserve(client, message)
+            elif operation == "release":
+                self._release(client, message["name"])
+                return {}
+            elif operation == "preempted":
+                return {"preempted": self._is_preempted(message["name"])}
+            elif operation == "status":
+                return {"status": self.get_status()}
+            else:
+                return {"error": "protocol",
+                        "message": "Unknown operation " + str(operation)}
+        except errors.AFTConfigurationError as err:
+            return {"error": "configuration", "message": str(err)}
+        except errors.AFTTimeoutError as err:
+            return {"error": "timeout", "message": str(err)}
+
+    def _reserve(self, client, message):
+        """
+        Handle a reservation request. Blocks until a device is assigned to the
+        client, the timeout expires or the client disconnects.
+
+        Args:
+            client (dictionary): Client connection state
+            message (dictionary): The request
+
+        Returns:
+            (dictionary): Reply containing the device name and wait time
+        """
+        start = time.time()
+        count = message.get("count", 1)
+        priority = message.get("priority", "nightly")
+        rank = reservation_queue.get_priority_rank(priority)
+
+        if message.get("names"):
+            wanted = ", ".join(message["names"])
+            candidates = []
+            for name in message["names"]:
+                if name.lower() not in self._devices_by_name:
+                    raise errors.AFTConfigurationError(
+                        "No device configuration for " + name)
+                candidates.append(self._devices_by_name[name.lower()])
+            ignore_blacklist = True
+        elif message.get("name"):
+            wanted = message["name"]
+            candidates = [device for device in self._devices
+                          if device["name"].lower() == wanted.lower()]
+            # Like DevicesManager.reserve_specific, specific reservations
+            # ignore the blacklist
+            ignore_blacklist = True
+        else:
+            wanted = message["model"]
+            candidates = [device for device in self._devices
+                          if device["model"].lower() == wanted.lower()]
+            ignore_blacklist = False
+
+            # Ordered once on arrival; the statistics change slowly enough
+            order = selection_policies.order_devices(
+                message.get("policy", "topology"),
+                [device["id"] for device in candidates],
+                message.get("image_hash"))
+            candidates = [self._devices_by_id[dev_id] for dev_id in order]
+
+        if not candidates:
+            raise errors.AFTConfigurationError(
+                "No device configurations when reserving " + str(wanted) +
+                " - check that given machine type or name is correct")
+
+        if len(candidates) < count:
+            raise errors.AFTConfigurationError(
+                "Cannot reserve " + str(count) + " devices of " + str(wanted) +
+                " - only " + str(len(candidates)) + " devices are configured")
+
+        if count > 1:
+            wanted = str(count) + " x " + wanted
+
+        with self._condition:
+            self._waiter_counter += 1
+            waiter = {
+                "ticket": self._waiter_counter,
+                "candidates": [device["id"] for device in candidates],
+                "count": count,
+                "priority": priority,
+                "rank": rank,
+                "ignore_blacklist": ignore_blacklist,
+                "client": client,
+                "pid": message.get("pid"),
+                "wanted": wanted,
+                "since": start,
+                "devices": []
+            }
+            self._waiters.append(waiter)
+
+            try:
+                if self._assign():
+                    self._condition.notify_all()
+
+                deadline = start + message["timeout"]
+                while True:
+                    # Releases and notifications run the assignment; here we
+                    # only wait for it
+                    if waiter["devices"]:
+                        break
+
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise errors.AFTTimeoutError(
+                            "Could not reserve " + str(wanted) + " in " +
+                            str(message["timeout"]) + " seconds.")
+
+                    self._condition.wait(
+                        min(remaining, self._DISCONNECT_CHECK_INTERVAL))
+
+                    if not waiter["devices"] and \
+                            self._is_disconnected(client["connection"]):
+                        raise errors.AFTTimeoutError(
+                            "Client disconnected while waiting")
+            finally:
+                self._waiters.remove(waiter)
+                # Our claim may have been blocking younger waiters
+                if not waiter["devices"] and self._assign():
+                    self._condition.notify_all()
+
+        wait_time = time.time() - start
+        names = [device["name"] for device in waiter["devices"]]
+        logger.info("Reserved " + ", ".join(names) + " for pid " +
+                    str(waiter["pid"]) + " after " + str(round(wait_time, 3)) +
+                    " seconds.")
+        return {"devices": names, "wait_time": wait_time}
+
+    @staticmethod
+    def _is_disconnected(connection):
+        """
+        Check whether the client has closed the connection
+
+        Args:
+            connection (socket.socket): The client connection
+
+        Returns:
+            True if the connection has been closed
+        """
+        readable, _, _ = select.select([connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return connection.recv(1, socket.MSG_PEEK) == ""
+        except socket.error:
+            return True
+
+    def _assign(self):
+        """
+        Assign free devices to waiters in FIFO order. Must be called with
+        self._condition held.
+
+        Returns:
+            True if any device was assigned
+        """
+        assigned = False
+        claimed = set()
+        # Highest priority first, FIFO within the same priority
+        for waiter in sorted(
+                self._waiters,
+                key=lambda waiter: (waiter["rank"], waiter["ticket"])):
+            if waiter["devices"]:
+                continue
+
+            available = []
+            for dev_id in waiter["candidates"]:
+                device = self._devices_by_id[dev_id]
+                if dev_id in claimed or device["holder"]:
+                    continue
+                if dev_id in self._blacklist and not waiter["ignore_blacklist"]:
+                    continue
+                available.append(device)
+
+            locked = []
+            if len(available) >= waiter["count"]:
+                locked = self._lock_many(available, waiter["count"])
+
+            if not locked:
+                # Still waiting: younger waiters may not take its devices.
+                # Blacklisted devices it cannot take are not claimed, so
+                # that they do not block reservations of specific devices.
+                if waiter["ignore_blacklist"]:
+                    claimed.update(waiter["candidates"])
+                else:
+                    claimed.update(dev_id for dev_id in waiter["candidates"]
+                                   if dev_id not in self._blacklist)
+                continue
+
+            for device in locked:
+                device["holder"] = waiter["client"]
+                device["rank"] = waiter["rank"]
+                device["pid"] = waiter["pid"]
+                device["since"] = time.time()
+                waiter["client"]["devices"].add(device["id"])
+            waiter["devices"] = locked
+            assigned = True
+
+        return assigned
+
+    def _lock_many(self, devices, count):
+        """
+        Lock count devices, all or nothing. Several devices are locked in
+        device id order, like DevicesManager does. Must be called with
+        self._condition held.
+
+        Args:
+            devices (list(dictionary)):
+                Free candidate devices, most preferred first
+            count (integer): Number of devices to lock
+
+        Returns:
+            (list(dictionary)): The locked devices, or an empty list if not
+            enough devices could be locked
+        """
+        if count > 1:
+            # The most preferred devices are tried first
+            devices = (
+                sorted(devices[:count], key=lambda device: device["id"]) +
+                sorted(devices[count:], key=lambda device: device["id"]))
+
+        locked = []
+        for device in devices:
+            if self._lock(device):
+                locked.append(device)
+                if len(locked) == count:
+                    return locked
+
+        # Nothing was released that anybody could take, so the waiters are
+        # not notified. That would also wake our own notification loop.
+        for device in locked:
+            self._unlock(device)
+        return []
+
+    def _lock(self, device):
+        """
+        Take the device lock file on behalf of a client
+
+        Args:
+            device (dictionary): Device state
+
+        Returns:
+            True if the lock was acquired, False if the device is locked by
+            some other process
+        """
+        path = os.path.join(config.LOCK_FILE, "aft_" + device["id"])
+        lockfile = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT, 0660), "w")
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            lockfile.close()
+            if err.errno in {errno.EACCES, errno.EAGAIN}:
+                return False
+            raise
+
+        try:
+            same_file = os.fstat(lockfile.fileno()).st_ino == os.stat(path).st_ino
+        except OSError:
+            same_file = False
+
+        if not same_file:
+            lockfile.close()
+            return False
+
+        device["lockfile"] = lockfile
+        return True
+
+    def _refresh_blacklist(self):
+        """
+        Reload the blacklist if it has changed. Reads the blacklist database,
+        so it must be called without self._condition held.
+
+        Returns:
+            None
+        """
+        generation = blacklist.get_generation()
+        if generation == self._blacklist_generation:
+            return
+
+        device_blacklist = blacklist.get_entries()
+        with self._condition:
+            self._blacklist_generation = generation
+            self._blacklist = device_blacklist
+
+    def _is_preempted(self, name):
+        """
+        Check whether a waiter of higher priority than the holder is waiting
+        for the device
+
+        Args:
+            name (str): Device name
+
+        Returns:
+            True if the holder should give up the device
+        """
+        with self._condition:
+            device = self._devices_by_name.get(name.lower())
+            if not device or not device["holder"]:
+                return False
+            for waiter in self._waiters:
+                if not waiter["devices"] and \
+                        waiter["rank"] < device["rank"] and \
+                        device["id"] in waiter["candidates"]:
+                    return True
+            return False
+
+    def _release(self, client, name):
+        """
+        Release a device held by the client
+
+        Args:
+            client (dictionary): Client connection state
+            name (str): Device name
+        """
+        with self._condition:
+            device = self._devices_by_name.get(name.lower())
+            if not device or device["id"] not in client["devices"]:
+                raise errors.AFTConfigurationError(
+                    "Device " + name + " is not reserved by this client")
+            self._unlock(device)
+            client["devices"].discard(device["id"])
+            self._assign()
+            self._condition.notify_all()
+
+        # Wake up AFT processes that do not use the broker
+        reservation_queue.notify_waiters()
+
+    def release_client(self, client):
+        """
+        Release every device held by a client. Called when the connection is
+        closed.
+
+        Args:
+            client (dictionary): Client connection state
+        """
+        with self._condition:
+            released = bool(client["devices"])
+            for dev_id in client["devices"]:
+                logger.info("Releasing " + self._devices_by_id[dev_id]["name"] +
+                            " of a closed connection")
+                self._unlock(self._devices_by_id[dev_id])
+            client["devices"].clear()
+            self._assign()
+            self._condition.notify_all()
+
+        if released:
+            # Wake up AFT processes that do not use the broker
+            reservation_queue.notify_waiters()
+
+    def _unlock(self, device):
+        """
+        Release the device lock and reset the device state, without waking
+        up the waiters. Must be called with self._condition held.
+
+        Args:
+            device (dictionary): Device state
+        """
+        path = os.path.join(config.LOCK_FILE, "aft_" + device["id"])
+        if os.path.isfile(path):
+            os.unlink(path)
+        device["lockfile"].close()
+        device["lockfile"] = None
+        device["holder"] = None
+        device["rank"] = None
+        device["pid"] = None
+        device["since"] = None
+
+    def get_status(self):
+        """
+        Return the state of all the devices and waiters
+
+        Returns:
+            Dictionary with the following format:
+            {
+                "devices": [
+                    {
+                        "name": "device_name",
+                        "model": "device_model",
+                        "id": "device_id",
+                        "state": "free" / "reserved" / "blacklisted",
+                        "pid": holder_pid_or_None,
+                        "held_for": seconds_or_None
+                    }, ...
+                ],
+                "waiters": [
+                    {
+                        "wanted": "model_or_name",
+                        "priority": "priority_class",
+                        "pid": waiter_pid,
+                        "waiting_for": seconds
+                    }, ...
+                ]
+            }
+        """
+        now = time.time()
+        with self._condition:
+            devices = []
+            for device in self._devices:
+                if device["holder"]:
+                    state = "reserved"
+                elif device["id"] in self._blacklist:
+                    state = "blacklisted"
+                else:
+                    state = "free"
+                devices.append({
+                    "name": device["name"],
+                    "model": device["model"],
+                    "id": device["id"],
+                    "state": state,
+                    "pid": device.get("pid"),
+                    "held_for": now - device["since"] if device["since"] else None
+                })
+
+            waiters = [{
+                "wanted": waiter["wanted"],
+                "priority": waiter["priority"],
+                "pid": waiter["pid"],
+                "waiting_for": now - waiter["since"]
+            } for waiter in sorted(
+                self._waiters,
+                key=lambda waiter: (waiter["rank"], waiter["ticket"]))
+              if not waiter["devices"]]
+
+        return {"devices": devices, "waiters": waiters}
+
+
+def format_status(status):
+    """
+    Format broker status as human readable text
+
+    Args:
+        status (dictionary): Status as returned by ReservationBroker.get_status
+
+    Returns:
+        (str): The formatted status
+    """
+    lines = ["Devices:"]
+    for device in status["devices"]:
+        line = "\t" + device["name"] + " (" + device["model"] + "): " + \
+            device["state"]
+        if device["state"] == "reserved":
+            line += " by pid " + str(device["pid"]) + " for " + \
+                str(int(device["held_for"])) + " seconds"
+        lines.append(line)
+
+    lines.append("Waiters:")
+    if not status["waiters"]:
+        lines.append("\tNone")
+    for waiter in status["waiters"]:
+        lines.append("\tpid " + str(waiter["pid"]) + " (" +
+                     waiter["priority"] + ") waiting for " +
+                     waiter["wanted"] + " for " +
+                     str(int(waiter["waiting_for"])) + " seconds")
+    return "\n".join(lines)
@@ -0,0 +1,355 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Cross-process FIFO queue for processes waiting for a device reservation.
+
+Every waiter registers a ticket file in the queue directory. The ticket file
+contains the ids of the devices the waiter is willing to take, and it is kept
+flocked by the waiter for as long as it waits, so tickets of crashed processes
+can be recognized and removed. The waiter replaces the ticket when the devices
+it can take change, e.g. when one is blacklisted. Next to the ticket, every
+waiter binds a unix datagram socket. Releasing a device or changing the
+blacklist sends a datagram to every waiter, which wakes them up immediately
+instead of them having to poll the lock files.
+
+Fairness is enforced by ticket order: a waiter may only try to lock a device
+if no waiter ahead of it in the queue is also waiting for that device.
+Tickets are ordered by priority class first and arrival time second, so a
+higher priority waiter gets the next free device even if lower priority
+waiters have waited longer.
+"""
+
+import os
+import json
+import time
+import fcntl
+import errno
+import select
+import socket
+import threading
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.errors as errors
+
+# Reservation priority classes, highest priority first
+PRIORITY_CLASSES = ["interactive", "premerge", "nightly", "maintenance"]
+
+_TICKET_SUFFIX = ".ticket"
+_SOCKET_SUFFIX = ".sock"
+_WAKEUP_MESSAGE = "wakeup"
+
+def _get_queue_directory():
+    """
+    Return the queue directory, creating it if necessary
+
+    Returns:
+        (str): Path to the queue directory
+    """
+    directory = os.path.join(config.LOCK_FILE, "aft_queue")
+    try:
+        os.makedirs(directory)
+        os.chmod(directory, 0777)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    return directory
+
+
+def get_priority_rank(priority):
+    """
+    Return the rank of a priority class. Smaller rank is higher priority.
+
+    Args:
+        priority (str): Priority class, one of PRIORITY_CLASSES
+
+    Returns:
+        (integer): The rank
+
+    Raises:
+        aft.errors.AFTConfigurationError if the priority class is unknown
+    """
+    if priority not in PRIORITY_CLASSES:
+        raise errors.AFTConfigurationError(
+            "Unknown reservation priority " + str(priority) + ". Valid " +
+            "priorities are: " + ", ".join(PRIORITY_CLASSES))
+    return PRIORITY_CLASSES.index(priority)
+
+
+def has_higher_priority_waiter(dev_id, priority):
+    """
+    Check whether a waiter of higher priority than the given class is
+    waiting for the device. Used by preemptible device holders.
+
+    Args:
+        dev_id (str): The device id
+        priority (str): Priority class of the device holder
+
+    Returns:
+        True if a higher priority waiter wants the device
+    """
+    directory = _get_queue_directory()
+    rank_prefix = "%d_" % get_priority_rank(priority)
+    for entry in sorted(os.listdir(directory)):
+        if not entry.endswith(_TICKET_SUFFIX):
+            continue
+        if entry >= rank_prefix:
+            break
+        dev_ids = _read_live_ticket(os.path.join(directory, entry))
+        if dev_ids and dev_id in dev_ids:
+            return True
+    return False
+
+
+def notify_waiters():
+    """
+    Wake up every process that is waiting for a device reservation.
+
+    Called whenever a device may have become available, e.g. after releasing
+    a lock or changing the blacklist. Stale sockets left behind by crashed
+    processes are removed.
+
+    Returns:
+        None
+    """
+    directory = _get_queue_directory()
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sender.setblocking(False)
+    try:
+        for entry in os.listdir(directory):
+            if not entry.endswith(_SOCKET_SUFFIX):
+                continue
+            path = os.path.join(directory, entry)
+            try:
+                sender.sendto(_WAKEUP_MESSAGE, path)
+            except socket.error as err:
+                if err.errno in {errno.ECONNREFUSED, errno.ENOENT}:
+                    _remove_file(path)
+                # EAGAIN: the waiter already has wakeups pending; that is enough
+    finally:
+        sender.close()
+
+
+def _remove_file(path):
+    """
+    Remove a file, ignoring the error if it has already been removed
+
+    Args:
+        path (str): The file that will be removed
+
+    Returns:
+        None
+    """
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _read_live_ticket(path):
+    """
+    Read the device ids from a ticket file if its owner is still alive.
+    Removes the ticket if the owner has died.
+
+    Args:
+        path (str): Path to the ticket file
+
+    Returns:
+        (list(str) or None): The device ids, or None if the ticket was
+        stale or disappeared while reading it
+    """
+    try:
+        ticket_file = open(path, "r")
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return None
+        raise
+
+    try:
+        try:
+            fcntl.flock(ticket_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno in {errno.EACCES, errno.EAGAIN}:
+                # Owner still holds the lock - the waiter is alive
+                return json.load(ticket_file)
+            raise
+
+        # The owner may have replaced or removed the ticket after we opened
+        # it, releasing the lock of the old one
+        try:
+            replaced = os.fstat(ticket_file.fileno()).st_ino != \
+                os.stat(path).st_ino
+        except OSError:
+            return None
+        if replaced:
+            return _read_live_ticket(path)
+
+        # We got the lock, so the owner is gone
+        logger.info("Removing stale reservation ticket " + path)
+        _remove_file(path)
+        _remove_file(path[:-len(_TICKET_SUFFIX)] + _SOCKET_SUFFIX)
+        return None
+    except ValueError:
+        # Owner is alive but the file is somehow corrupted; treat as empty
+        return None
+    finally:
+        ticket_file.close()
+
+
+class ReservationQueue(object):
+    """
+    A single waiter in the reservation queue.
+
+    Attributes:
+        _ticket (str): Ticket name. Tickets sort in priority and arrival
+                       order
+        _ticket_file (file): The open and flocked ticket file
+        _dev_ids (list(str)): The device ids in the ticket
+        _socket (socket.socket): The socket used to receive wake ups
+    """
+
+    _ticket_counter = 0
+    _ticket_counter_lock = threading.Lock()
+
+    def __init__(self, dev_ids, priority="nightly"):
+        """
+        Constructor. Registers the ticket in the queue.
+
+        Args:
+            dev_ids (list(str)): Ids of the devices the waiter can accept
+            priority (str): Priority class, one of PRIORITY_CLASSES
+        """
+        self._directory = _get_queue_directory()
+
+        with ReservationQueue._ticket_counter_lock:
+            ReservationQueue._ticket_counter += 1
+            counter = ReservationQueue._ticket_counter
+
+        # Zero padded so that lexicographical order is the priority and
+        # arrival order
+        self._ticket = "%d_%017d_%08d_%06d" % (
+            get_priority_rank(priority),
+            int(time.time() * 1000000),
+            os.getpid(),
+            counter)
+
+        self._socket_path = os.path.join(
+            self._directory, self._ticket + _SOCKET_SUFFIX)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._socket_path)
+        os.chmod(self._socket_path, 0666)
+
+        self._ticket_path = os.path.join(
+            self._directory, self._ticket + _TICKET_SUFFIX)
+        self._ticket_file = None
+        self._dev_ids = None
+        self._write_ticket(dev_ids)
+
+        logger.debug("Registered reservation ticket " + self._ticket)
+
+    def update(self, dev_ids):
+        """
+        Replace the device ids in the ticket, keeping its place in the queue
+
+        Args:
+            dev_ids (list(str)): Ids of the devices the waiter can accept
+
+        Returns:
+            None
+        """
+        if list(dev_ids) != self._dev_ids:
+            self._write_ticket(dev_ids)
+            logger.debug("Updated reservation ticket " + self._ticket)
+
+    def _write_ticket(self, dev_ids):
+        """
+        Write the ticket file, replacing the previous one
+        """
+        # Write the ticket contents into a temporary file, flock it and only
+        # then rename it, so that other waiters never see a partial ticket
+        temporary_path = self._ticket_path + ".tmp"
+        ticket_file = open(temporary_path, "w")
+        fcntl.flock(ticket_file, fcntl.LOCK_EX)
+        json.dump(list(dev_ids), ticket_file)
+        ticket_file.flush()
+        os.chmod(temporary_path, 0666)
+        os.rename(temporary_path, self._ticket_path)
+
+        if self._ticket_file:
+            self._ticket_file.close()
+        self._ticket_file = ticket_file
+        self._dev_ids = list(dev_ids)
+
+    def claimed_by_preceding_waiters(self):
+        """
+        Return the ids of devices that still living waiters ahead of this one
+        in the queue are waiting for.
+
+        Tickets of dead processes are removed as a side effect.
+
+        Returns:
+            (set(str)): Device ids claimed by preceding waiters
+        """
+        claimed = set()
+        for entry in sorted(os.listdir(self._directory)):
+            if not entry.endswith(_TICKET_SUFFIX):
+                continue
+            if entry[:-len(_TICKET_SUFFIX)] >= self._ticket:
+                break
+
+            path = os.path.join(self._directory, entry)
+            dev_ids = _read_live_ticket(path)
+            if dev_ids:
+                claimed.update(dev_ids)
+
+        return claimed
+
+    def wait(self, timeout):
+        """
+        Block until woken up by a notification or until timeout expires.
+
+        Args:
+            timeout (float): Maximum wait time in seconds
+
+        Returns:
+            True if woken up by a notification, False on timeout
+        """
+        readable, _, _ = select.select([self._socket], [], [], max(timeout, 0))
+        if not readable:
+            return False
+
+        # Drain every pending notification, one pass is enough for all of them
+        self._socket.setblocking(False)
+        try:
+            while True:
+                self._socket.recv(64)
+        except socket.error as err:
+            if err.errno not in {errno.EAGAIN, errno.EWOULDBLOCK}:
+                raise
+        finally:
+            self._socket.setblocking(True)
+        return True
+
+    def close(self):
+        """
+        Remove the ticket from the queue.
+
+        Returns:
+            None
+        """
+        _remove_file(self._ticket_path)
+        _remove_file(self._socket_path)
+        self._ticket_file.close()
+        self._socket.close()
+        logger.debug("Removed reservation ticket " + self._ticket)
@@ -0,0 +1,134 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Policies for choosing which free device of a model gets reserved.
+
+Every policy orders the candidate devices based on their statistics (see
+aft.tools.device_statistics); the first free device in that order is
+reserved. Devices without any history sort first, so that their statistics
+get collected. Ties are broken by the least recently used device, and then by
+topology order. If the image to be flashed is known, devices that already
+hold it come before all the others.
+"""
+
+import sqlite3
+
+from aft.logger import Logger as logger
+import aft.errors as errors
+import aft.tools.device_statistics as device_statistics
+import aft.tools.image_state as image_state
+
+
+def _least_recently_used(statistics):
+    """
+    Sort key preferring the device that has been idle for the longest time
+    """
+    return statistics["last_reserved"] or 0
+
+
+def _fastest(statistics):
+    """
+    Sort key preferring the device with the shortest flashing and boot time.
+    Devices whose recent flashings all failed have no flash time, and sort
+    last.
+    """
+    if not statistics["flashes"]:
+        flash_time = 0
+    elif statistics["flash_time"] is None:
+        flash_time = float("inf")
+    else:
+        flash_time = statistics["flash_time"]
+    return (flash_time, _least_recently_used(statistics))
+
+
+def _most_reliable(statistics):
+    """
+    Sort key preferring the device with the lowest recent failure rate
+    """
+    return (statistics["failure_rate"] or 0, _least_recently_used(statistics))
+
+
+_POLICIES = {
+    "topology": None,
+    "lru": _least_recently_used,
+    "fastest": _fastest,
+    "reliable": _most_reliable
+}
+
+
+def get_policy_names():
+    """
+    Return the names of the available policies
+
+    Returns:
+        (list(str)): The policy names
+    """
+    return sorted(_POLICIES.keys())
+
+
+def order_devices(policy, dev_ids, image_hash=None):
+    """
+    Order devices by the preference of the given policy
+
+    Args:
+        policy (str): The policy name
+        dev_ids (list(str)): Device ids, in topology order
+        image_hash (str or None):
+            Hash of the image that will be flashed. Devices that already hold
+            the image are preferred over all others, as flashing them can be
+            skipped. See aft.tools.image_state
+
+    Returns:
+        (list(str)): The same device ids, most preferred first
+
+    Raises:
+        aft.errors.AFTConfigurationError if the policy is unknown
+    """
+    if policy not in _POLICIES:
+        raise errors.AFTConfigurationError(
+            "Unknown device selection policy " + str(policy) + ". Valid " +
+            "policies are: " + ", ".join(get_policy_names()))
+
+    ordered = _order_by_policy(policy, dev_ids)
+    if not image_hash:
+        return ordered
+
+    images = image_state.get_device_images(dev_ids)
+    # sorted() is stable, so the policy order is kept within both groups
+    return sorted(ordered, key=lambda dev_id: images.get(dev_id) != image_hash)
+
+
+def _order_by_policy(policy, dev_ids):
+    """
+    Order devices by the sort key of the policy
+
+    Args:
+        policy (str): The policy name
+        dev_ids (list(str)): Device ids, in topology order
+
+    Returns:
+        (list(str)): The same device ids, most preferred first
+    """
+    sort_key = _POLICIES[policy]
+    if not sort_key:
+        return list(dev_ids)
+
+    try:
+        statistics = device_statistics.get_statistics(dev_ids)
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Device statistics unavailable, using topology " +
+                       "order: " + str(err))
+        return list(dev_ids)
+
+    # sorted() is stable, so topology order breaks the remaining ties
+    return sorted(dev_ids, key=lambda dev_id: sort_key(statistics[dev_id]))
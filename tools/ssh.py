@@ -14,13 +14,59 @@
 
 """
 Tools for remote controlling a device over ssh.
+
+Connections are pooled: the first ssh or scp call to an (ip, user) pair
+starts an OpenSSH master connection (ControlMaster), and later calls are
+multiplexed over it instead of doing a new key exchange. Masters stay open
+for config.SSH_CONTROL_PERSIST seconds when idle; 0 disables pooling.
+
+The master sockets are private to the process, so that a process closing
+its masters cannot break the sessions of another AFT process. Pooled
+connections do not survive the device powering off, so devices close them
+with close_connections() whenever they cut or restore the power. A call
+failing in ssh itself also closes the connection, so that a stale master is
+not reused, and keepalives make calls over a dead master fail in
+_SERVER_ALIVE_INTERVAL * _SERVER_ALIVE_COUNT_MAX seconds.
 """
 
 from aft.logger import Logger as logger
+import aft.config as config
 import aft.tools.misc as tools
+import aft.tools.process_engine as process_engine
 import os
+import time
+import socket
+import uuid
+import pipes
+import atexit
+import tempfile
+import threading
 import subprocess32
 
+# Master connection sockets of this process. Forked children share those of
+# their parent.
+_CONTROL_DIRECTORY = os.path.join(
+    tempfile.gettempdir(),
+    "aft_ssh_" + str(os.getuid()) + "_" + str(os.getpid()))
+
+# Seconds between keepalive messages, and the number of unanswered ones after
+# which ssh gives up on the connection
+_SERVER_ALIVE_INTERVAL = 15
+_SERVER_ALIVE_COUNT_MAX = 3
+
+# (ip, user) -> call statistics, for the connections used by this process
+_statistics = {}
+_lock = threading.Lock()
+
+# ip -> (monotonic time, /proc/version) of the last successful probe
+_probed_versions = {}
+
+# Seconds to wait for the ssh banner, and the first and the longest interval
+# between readiness probes
+_BANNER_TIMEOUT = 2
+_PROBE_INTERVAL = 0.25
+_MAX_PROBE_INTERVAL = 5
+
 def _get_proxy_settings():
     """
     Fetches proxy settings from the environment.
@@ -34,25 +80,371 @@ def _get_proxy_settings():
             proxy_env_command += "export " + var + '="' + val + '"; '
     return proxy_env_command
 
+def _get_control_path(remote_ip, user):
+    """
+    Return the path of the master connection socket of (remote_ip, user)
+    """
+    return os.path.join(_CONTROL_DIRECTORY, user + "@" + str(remote_ip))
+
+def _get_pool_options(remote_ip, user):
+    """
+    Return the ssh options for keepalives, and for multiplexing over the
+    pooled connection unless pooling is disabled.
+    """
+    keepalive = ["-o", "ServerAliveInterval=" + str(_SERVER_ALIVE_INTERVAL),
+                 "-o", "ServerAliveCountMax=" + str(_SERVER_ALIVE_COUNT_MAX)]
+    persist = int(config.SSH_CONTROL_PERSIST)
+    if persist <= 0:
+        return keepalive
+
+    if not os.path.isdir(_CONTROL_DIRECTORY):
+        try:
+            os.makedirs(_CONTROL_DIRECTORY, 0700)
+        except OSError:
+            if not os.path.isdir(_CONTROL_DIRECTORY):
+                raise
+
+    return keepalive + [
+        "-o", "ControlMaster=auto",
+        "-o", "ControlPath=" + _get_control_path(remote_ip, user),
+        "-o", "ControlPersist=" + str(persist)]
+
+def _execute(remote_ip, user, args, timeout, ignore_return_codes,
+             line_handler=None):
+    """
+    Run an ssh or scp command line and record its latency. Closes the pooled
+    connection if ssh itself fails or the call times out, as the master
+    connection may be stale. If line_handler is given, the output is streamed
+    to it and only the output tail is returned.
+    """
+    new_connection = not os.path.exists(_get_control_path(remote_ip, user))
+    start = time.time()
+    try:
+        if line_handler:
+            return tools.local_execute_stream(
+                args, line_handler, timeout, ignore_return_codes)
+        return tools.local_execute(args, timeout, ignore_return_codes)
+    except subprocess32.CalledProcessError as err:
+        # ssh returns 255 on its own errors, such as a broken connection
+        if err.returncode == 255:
+            close_connections(remote_ip)
+        raise
+    except subprocess32.TimeoutExpired:
+        close_connections(remote_ip)
+        raise
+    finally:
+        _record_call(remote_ip, user, time.time() - start, new_connection)
+
+def _record_call(remote_ip, user, duration, new_connection):
+    """
+    Update the latency statistics of (remote_ip, user)
+    """
+    with _lock:
+        statistics = _statistics.setdefault((str(remote_ip), user), {
+            "calls": 0,
+            "new_connections": 0,
+            "total_time": 0.0,
+            "max_time": 0.0})
+        statistics["calls"] += 1
+        statistics["new_connections"] += int(new_connection)
+        statistics["total_time"] += duration
+        statistics["max_time"] = max(statistics["max_time"], duration)
+
+    logger.info("Call to " + user + "@" + str(remote_ip) + " took " +
+                str(round(duration, 3)) + " s" +
+                (" (new connection)" if new_connection else ""),
+                filename="ssh.log")
+
+def get_statistics():
+    """
+    Return the latency statistics of the ssh and scp calls of this process
+
+    Returns:
+        Dictionary of (ip, user) -> statistics, where statistics have the
+        following format:
+        {
+            "calls": number of calls,
+            "new_connections": number of calls that opened a new connection,
+            "total_time": total duration of the calls in seconds,
+            "max_time": duration of the slowest call in seconds
+        }
+    """
+    with _lock:
+        return dict((key, dict(value)) for key, value in _statistics.items())
+
+def close_connections(remote_ip=None):
+    """
+    Close the pooled connections of this process to a device
+
+    Args:
+        remote_ip (str or None):
+            The device ip address. If None, every connection of this process
+            is closed.
+
+    Returns:
+        None
+    """
+    try:
+        names = os.listdir(_CONTROL_DIRECTORY)
+    except OSError:
+        # Nothing has been pooled
+        return
+
+    statistics = get_statistics()
+    for name in names:
+        user, _, ip = name.partition("@")
+        if remote_ip is not None and ip != str(remote_ip):
+            continue
+
+        control_path = _get_control_path(ip, user)
+        calls = statistics.get((ip, user))
+        if calls:
+            logger.info("Closing the connection to " + name + " after " +
+                        str(calls["calls"]) + " calls (" +
+                        str(calls["new_connections"]) +
+                        " new connections), mean latency " +
+                        str(round(calls["total_time"] / calls["calls"], 3)) +
+                        " s, max " + str(round(calls["max_time"], 3)) + " s",
+                        filename="ssh.log")
+        else:
+            logger.info("Closing the connection to " + name,
+                        filename="ssh.log")
+        try:
+            tools.local_execute(
+                ["ssh", "-o", "ControlPath=" + control_path, "-O", "exit",
+                 name],
+                timeout=10)
+        except (subprocess32.CalledProcessError,
+                subprocess32.TimeoutExpired) as err:
+            logger.warning("Closing the master connection failed: " + str(err),
+                           filename="ssh.log")
+
+        # The master may have died without removing its socket
+        try:
+            os.unlink(control_path)
+        except OSError:
+            pass
+
+def _close_all_connections():
+    """
+    Close every connection of this process, and remove its socket directory
+    """
+    close_connections()
+    try:
+        os.rmdir(_CONTROL_DIRECTORY)
+    except OSError:
+        pass
+
+# Do not leave master connections behind
+atexit.register(_close_all_connections)
+
+def probe_banner(remote_ip, timeout = 2, port = 22):
+    """
+    Check whether an ssh server answers on remote_ip, without logging in.
+    Connects over TCP and reads the ssh protocol banner.
+
+    Args:
+        remote_ip (str): Remote device IP
+        timeout (float): Timeout in seconds for connecting and for the banner
+        port (integer): The ssh port
+
+    Returns:
+        (boolean): True if an ssh banner was received
+    """
+    try:
+        connection = socket.create_connection((str(remote_ip), port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        # Servers may send other lines before the banner
+        banner = connection.recv(256)
+        return "SSH-" in banner
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        connection.close()
+
+def probe(remote_ip, timeout = 10, check_banner = True):
+    """
+    Check whether remote_ip can be logged into over ssh, and read its
+    /proc/version in the same round trip. The ssh banner is checked first, so
+    that unreachable addresses fail fast. The result is remembered for
+    get_probed_version.
+
+    Args:
+        remote_ip (str): Remote device IP
+        timeout (integer): Timeout in seconds for connecting
+        check_banner (boolean):
+            False if the caller has just seen the banner itself
+
+    Returns:
+        (str or None): Contents of /proc/version, or None if the device
+        could not be logged into
+    """
+    if check_banner and \
+            not probe_banner(remote_ip, min(timeout, _BANNER_TIMEOUT)):
+        logger.info("No ssh banner from " + str(remote_ip), filename="ssh.log")
+        return None
+
+    try:
+        version = remote_execute(remote_ip, ["cat", "/proc/version"],
+                                 connect_timeout = timeout)
+    except subprocess32.CalledProcessError as err:
+        logger.warning("Could not establish ssh-connection to " +
+                       str(remote_ip) + ". SSH return code: " +
+                       str(err.returncode) + ".")
+        return None
+    except subprocess32.TimeoutExpired:
+        logger.warning("Reading /proc/version from " + str(remote_ip) +
+                       " timed out.")
+        return None
+
+    with _lock:
+        _probed_versions[str(remote_ip)] = (process_engine.monotonic(),
+                                            version)
+    return version
+
+def get_probed_version(remote_ip, max_age = 10):
+    """
+    Return /proc/version of remote_ip as read by a recent successful probe
+
+    Args:
+        remote_ip (str): Remote device IP
+        max_age (float): How old the probe may be, in seconds
+
+    Returns:
+        (str or None): Contents of /proc/version, or None if there is no
+        recent probe
+    """
+    with _lock:
+        probed = _probed_versions.get(str(remote_ip))
+    if probed and process_engine.monotonic() - probed[0] <= max_age:
+        return probed[1]
+    return None
+
+def wait_until_ready(remote_ip, timeout):
+    """
+    Wait until remote_ip can be logged into over ssh. Polls the ssh banner
+    with exponential backoff, and only logs in once the banner is seen.
+
+    Args:
+        remote_ip (str): Remote device IP
+        timeout (float): Timeout in seconds
+
+    Returns:
+        (str or None): Contents of /proc/version, or None on timeout
+    """
+    deadline = process_engine.monotonic() + timeout
+    interval = _PROBE_INTERVAL
+    while True:
+        remaining = deadline - process_engine.monotonic()
+        if remaining <= 0:
+            return None
+
+        if probe_banner(remote_ip, min(remaining, _BANNER_TIMEOUT)):
+            version = probe(remote_ip, max(int(remaining), 1),
+                            check_banner = False)
+            if version is not None:
+                return version
+
+        remaining = deadline - process_engine.monotonic()
+        time.sleep(max(min(interval, remaining), 0))
+        interval = min(interval * 2, _MAX_PROBE_INTERVAL)
+
 def test_ssh_connectivity(remote_ip, timeout = 10):
     """
     Test whether remote_ip is accessible over ssh.
     """
+    return probe(remote_ip, timeout) is not None
+
+def push(remote_ip, source, destination, timeout = 60, ignore_return_codes = None, user = "root",
+         compress = False):
+    """
+    Transmit a file from local 'source' to remote 'destination' over SCP. If
+    compress is True, the transfer is compressed.
+    """
+    scp_args = ["scp"] + (["-C"] if compress else []) + \
+        _get_pool_options(remote_ip, user) + [
+        source,
+        user + "@" + str(remote_ip) + ":" + destination]
+    return _execute(remote_ip, user, scp_args, timeout, ignore_return_codes)
+
+def push_directory(remote_ip, source, destination, timeout = 60, user = "root",
+                   connect_timeout = 15):
+    """
+    Transmit the contents of the local directory 'source' into the remote
+    directory 'destination' as one compressed tar stream. The remote
+    directory is created if necessary.
+
+    Args:
+        remote_ip (str): Remote device IP
+        source (str): The local directory
+        destination (str): The remote directory
+        timeout (integer): Timeout in seconds for the operation
+        user (str): User that will be used with ssh
+        connect_timeout (integer): Timeout in seconds for connecting
+
+    Returns:
+        Combined output of tar and ssh
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired
+        subprocess32.CalledProcessError:
+            If either end of the transfer failed
+    """
+    logger.info("Pushing directory " + source + " to " + destination,
+                filename="ssh.log")
     try:
-        remote_execute(remote_ip, ["echo", "$?"], connect_timeout = timeout)
-        return True
+        return pipe_to_remote(
+            remote_ip,
+            ["tar", "-C", source, "-czf", "-", "."],
+            "mkdir -p " + pipes.quote(destination) + " && " +
+            "tar -C " + pipes.quote(destination) + " -xzf -",
+            timeout=timeout,
+            user=user,
+            connect_timeout=connect_timeout)
     except subprocess32.CalledProcessError as err:
-        logger.warning("Could not establish ssh-connection to " + remote_ip +
-                        ". SSH return code: " + str(err.returncode) + ".")
-        return False
+        logger.error("Push raised exception: " + str(err), filename="ssh.log")
+        logger.error("Output: " + str(err.output), filename="ssh.log")
+        raise err
 
-def push(remote_ip, source, destination, timeout = 60, ignore_return_codes = None, user = "root"):
+def pipe_to_remote(remote_ip, local_command, remote_command, timeout = 60,
+                   line_handler = None, user = "root", connect_timeout = 15):
     """
-    Transmit a file from local 'source' to remote 'destination' over SCP
+    Run a local command, and feed its output over ssh to a command on the
+    device. Fails if either command fails.
+
+    Args:
+        remote_ip (str): Remote device IP
+        local_command (list(str)): The local command
+        remote_command (str): The remote command, as a shell command line
+        timeout (integer): Timeout in seconds for the operation
+        line_handler (function):
+            If given, called with each line of the combined output of both
+            commands as it is produced
+        user (str): User that will be used with ssh
+        connect_timeout (integer): Timeout in seconds for connecting
+
+    Returns:
+        Combined output of both commands and ssh, or its tail if line_handler
+        is given
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired
+        subprocess32.CalledProcessError:
+            If either command failed
     """
-    scp_args = ["scp", source,
-                user + "@" + str(remote_ip) + ":" + destination]
-    return tools.local_execute(scp_args, timeout, ignore_return_codes)
+    ssh_args = _get_ssh_arguments(remote_ip, user, connect_timeout)
+    # The last argument is the remote proxy settings
+    pipeline = "set -o pipefail; " + \
+        " ".join(pipes.quote(arg) for arg in local_command) + " | " + \
+        " ".join(pipes.quote(arg) for arg in ssh_args[:-1]) + " " + \
+        pipes.quote(ssh_args[-1] + remote_command)
+
+    return _execute(remote_ip, user, ["bash", "-c", pipeline], timeout, None,
+                    line_handler)
 
 def pull(
     remote_ip,
@@ -88,10 +480,26 @@ def pull(
         "-o",
         "UserKnownHostsFile=/dev/null",
         "-o",
-        "StrictHostKeyChecking=no",
+        "StrictHostKeyChecking=no"] + _get_pool_options(remote_ip, user) + [
         user + "@" + str(remote_ip) + ":" + source,
         destination]
-    return tools.local_execute(scp_args, timeout, ignore_return_codes)
+    return _execute(remote_ip, user, scp_args, timeout, ignore_return_codes)
+
+def _get_ssh_arguments(remote_ip, user, connect_timeout):
+    """
+    Return the ssh command line for running commands on remote_ip, up to and
+    including the proxy settings
+    """
+    return ["ssh",
+            "-i", "".join([os.path.expanduser("~"), "/.ssh/id_rsa_testing_harness"]),
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "BatchMode=yes",
+            "-o", "LogLevel=ERROR",
+            "-o", "ConnectTimeout=" + str(connect_timeout)] + \
+           _get_pool_options(remote_ip, user) + [
+            user + "@" + str(remote_ip),
+            _get_proxy_settings(),]
 
 def remote_execute(remote_ip, command, timeout = 60, ignore_return_codes = None,
                    user = "root", connect_timeout = 15):
@@ -101,24 +509,196 @@ def remote_execute(remote_ip, command, timeout = 60, ignore_return_codes = None,
     subprocess32 errors.
     """
 
-    ssh_args = ["ssh",
-                "-i", "".join([os.path.expanduser("~"), "/.ssh/id_rsa_testing_harness"]),
-                "-o", "UserKnownHostsFile=/dev/null",
-                "-o", "StrictHostKeyChecking=no",
-                "-o", "BatchMode=yes",
-                "-o", "LogLevel=ERROR",
-                "-o", "ConnectTimeout=" + str(connect_timeout),
-                user + "@" + str(remote_ip),
-                _get_proxy_settings(),]
+    ssh_args = _get_ssh_arguments(remote_ip, user, connect_timeout)
 
     logger.info("Executing " + " ".join(command), filename="ssh.log")
 
     ret = ""
     try:
-        ret = tools.local_execute(ssh_args + command, timeout, ignore_return_codes)
+        ret = _execute(remote_ip, user, ssh_args + command, timeout,
+                       ignore_return_codes)
     except subprocess32.CalledProcessError as err:
         logger.error("Command raised exception: " + str(err), filename="ssh.log")
         logger.error("Output: " + str(err.output), filename="ssh.log")
         raise err
 
     return ret
+
+def remote_execute_stream(remote_ip, command, line_handler, timeout = 60,
+                          ignore_return_codes = None, user = "root",
+                          connect_timeout = 15):
+    """
+    Execute a Bash command over ssh on a remote device with IP 'remote_ip',
+    passing its output to line_handler one line at a time as it is produced.
+    Use this instead of remote_execute for commands with a lot of output.
+
+    Args:
+        remote_ip (str): Remote device IP
+        command (list(str)): The command
+        line_handler (function):
+            Called with each line of combined stdout and stderr
+        timeout (integer): Timeout in seconds for the operation
+        ignore_return_codes (list(integer)):
+            List of return codes that will be ignored
+        user (str): User that will be used with ssh
+        connect_timeout (integer): Timeout in seconds for connecting
+
+    Returns:
+        The last lines of output, see tools.misc.local_execute_stream
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired
+        subprocess32.CalledProcessError:
+            If the command returns non-zero, non-ignored return code. The
+            output of the error is the output tail.
+    """
+    ssh_args = _get_ssh_arguments(remote_ip, user, connect_timeout)
+
+    logger.info("Executing " + " ".join(command), filename="ssh.log")
+
+    try:
+        return _execute(remote_ip, user, ssh_args + command, timeout,
+                        ignore_return_codes, line_handler)
+    except subprocess32.CalledProcessError as err:
+        logger.error("Command raised exception: " + str(err), filename="ssh.log")
+        logger.error("Output tail: " + str(err.output), filename="ssh.log")
+        raise err
+
+def remote_execute_batch(remote_ip, steps, timeout = 60, stop_on_error = True,
+                         user = "root", connect_timeout = 15):
+    """
+    Execute a list of Bash commands over one ssh session, in order.
+
+    The steps are run by a single remote shell, which reports the exit code
+    and output of each step between marker lines. This saves a round trip
+    per command compared to calling remote_execute for each of them.
+
+    Args:
+        remote_ip (str): Remote device IP
+        steps (list(list(str) or dictionary)):
+            The commands, in the format of remote_execute. A step can also be
+            a dictionary {"command": [...], "ignore_return_codes": [...]}.
+        timeout (integer): Timeout in seconds for the whole batch
+        stop_on_error (boolean):
+            If True, the steps after the first failing step are not run, and
+            subprocess32.CalledProcessError is raised for the failing step
+        user (str): User that will be used with ssh
+        connect_timeout (integer): Timeout in seconds for connecting
+
+    Returns:
+        List of the results of the executed steps, in the following format:
+        {
+            "command": the command as a string,
+            "returncode": exit code of the command,
+            "output": combined stdout and stderr of the command
+        }
+
+    Raises:
+        subprocess32.TimeoutExpired:
+            If timeout expired
+        subprocess32.CalledProcessError:
+            If a step failed and stop_on_error is True, or if ssh itself
+            failed
+    """
+    marker = "AFT_STEP_" + uuid.uuid4().hex
+    commands = []
+    script = []
+    for index, step in enumerate(steps):
+        command, ignored = _get_step(step)
+        commands.append(command)
+
+        # The end marker starts with a newline, so that it is on a line of its
+        # own even if the output of the step does not end with one
+        script.append(
+            "echo " + marker + " begin " + str(index) + "; " +
+            "{ " + command + "; } 2>&1; " +
+            "_aft_rc=$?; " +
+            "printf '\\n%s end %d %d\\n' " + marker + " " + str(index) +
+            " $_aft_rc; ")
+        if stop_on_error:
+            failed = " -a ".join(
+                "$_aft_rc -ne " + str(code) for code in [0] + ignored)
+            script.append("if [ " + failed + " ]; then exit 0; fi; ")
+
+    logger.info("Executing batch of " + str(len(commands)) + " steps:\n" +
+                "\n".join(commands), filename="ssh.log")
+
+    ssh_args = _get_ssh_arguments(remote_ip, user, connect_timeout)
+    try:
+        output = _execute(remote_ip, user, ssh_args + ["".join(script)],
+                          timeout, None)
+    except subprocess32.CalledProcessError as err:
+        logger.error("Batch raised exception: " + str(err), filename="ssh.log")
+        logger.error("Output: " + str(err.output), filename="ssh.log")
+        raise err
+
+    results = _parse_batch_output(output, marker, commands)
+
+    for result in results:
+        logger.info("Step " + result["command"] + " returned " +
+                    str(result["returncode"]), filename="ssh.log")
+
+    if stop_on_error and results:
+        result = results[-1]
+        ignored = _get_step(steps[len(results) - 1])[1]
+        if result["returncode"] != 0 and result["returncode"] not in ignored:
+            logger.error("Step failed with output: " + result["output"],
+                         filename="ssh.log")
+            raise subprocess32.CalledProcessError(
+                returncode=result["returncode"],
+                cmd=result["command"],
+                output=result["output"])
+
+    return results
+
+def _get_step(step):
+    """
+    Return the command of a batch step as a string, and the return codes
+    ignored for it
+    """
+    if isinstance(step, dict):
+        return (" ".join(step["command"]),
+                step.get("ignore_return_codes") or [])
+    return " ".join(step), []
+
+def _parse_batch_output(output, marker, commands):
+    """
+    Split the output of a batch into the results of its steps
+
+    Args:
+        output (str): Output of the remote shell
+        marker (str): The step marker of the batch
+        commands (list(str)): The commands of the batch
+
+    Returns:
+        List of step results, see remote_execute_batch
+    """
+    results = []
+    begin = marker + " begin "
+    end = "\n" + marker + " end "
+    position = 0
+    while True:
+        start = output.find(begin, position)
+        if start == -1:
+            break
+        start = output.index("\n", start) + 1
+        stop = output.find(end, start)
+        if stop == -1:
+            # The remote shell died in the middle of the step
+            results.append({
+                "command": commands[len(results)],
+                "returncode": None,
+                "output": output[start:]})
+            break
+
+        line_end = output.find("\n", stop + len(end))
+        if line_end == -1:
+            line_end = len(output)
+        index, returncode = output[stop + len(end):line_end].split()
+        results.append({
+            "command": commands[int(index)],
+            "returncode": int(returncode),
+            "output": output[start:stop]})
+        position = line_end
+    return results
@@ -47,6 +47,7 @@ from ConfigParser import SafeConfigParser
 
 import aft.devices.common as common
 import aft.tools.ssh as ssh
+import aft.tools.lease_index as lease_index
 
 from aft.logger import Logger as logger
 from aft.cutters.clewarecutter import ClewareCutter
@@ -403,7 +404,7 @@ class TopologyBuilder(object):
 
         lease_file = "/var/lib/misc/dnsmasq.leases"
 
-        leases = common.get_mac_leases_from_dnsmasq(lease_file)
+        leases = lease_index.get_index(lease_file).get_all_leases()
         return [(lease["mac"], lease["ip"]) for lease in leases]
 
     def _find_active_pem_ports_from(self, wait_duration, device_files):
@@ -0,0 +1,370 @@
+# coding=utf-8
+# Copyright (c) 2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Persistent AFT worker daemon (aft --serve).
+
+The worker accepts flash and test jobs over a unix socket
+(config.WORKER_SOCKET), so that jobs do not pay for starting AFT, importing
+its dependencies and parsing the configurations. Device objects and their
+cutters are constructed once and shared by all the jobs.
+
+Every job is served in its own thread and runs on its own reserved device,
+so jobs for different devices run concurrently. Progress messages and the
+test results are streamed back to the client (aft --submit) as JSON lines.
+Each job logs into job<number>_aft.log in the working directory of the
+worker.
+
+Only the user running the worker and the members of config.WORKER_GROUP
+can connect to the socket.
+
+Restart the worker after changing the device topology.
+"""
+
+import os
+import grp
+import sys
+import socket
+import argparse
+import threading
+import SocketServer
+
+from aft.logger import Logger as logger
+import aft.config as config
+import aft.errors as errors
+import aft.devices.common as common
+import aft.tools.json_socket as json_socket
+import aft.tools.image_state as image_state
+from aft.devicesmanager import DevicesManager
+from aft.tester import Tester
+
+# Job options and their values when the client does not give them
+_JOB_DEFAULTS = {
+    "machine": None,
+    "file_name": None,
+    "device": "",
+    "test_plan": None,
+    "machine_retries": 2,
+    "flash_retries": 2,
+    "noflash": False,
+    "force_flash": False,
+    "notest": False,
+    "nopoweroff": False,
+    "preemptible": False,
+    "selection_policy": None,
+    "priority": None
+}
+
+
+def submit_job(args):
+    """
+    Run a job on the worker daemon and print its progress
+
+    Args:
+        args (argparse namespace argument object): The job arguments
+
+    Returns:
+        (integer): 0 if the job succeeded, 1 otherwise
+    """
+    connection = json_socket.connect_unix(config.WORKER_SOCKET)
+    if not connection:
+        print("AFT worker is not running at " + config.WORKER_SOCKET)
+        return 1
+
+    job = dict((option, getattr(args, option)) for option in _JOB_DEFAULTS)
+    if job["file_name"]:
+        job["file_name"] = os.path.abspath(job["file_name"])
+
+    connection = json_socket.JsonConnection(connection)
+    try:
+        connection.send({"op": "submit", "job": job})
+        while True:
+            message = connection.receive()
+            if message is None:
+                print("AFT worker closed the connection")
+                return 1
+
+            if message["event"] == "progress":
+                print(message["message"])
+            elif message["event"] == "result":
+                if message["results"]:
+                    with open("results.xml", "w") as results_file:
+                        results_file.write(message["results"])
+                    print("Results saved to " +
+                          os.path.join(os.getcwd(), "results.xml"))
+                return message["status"]
+    finally:
+        connection.close()
+
+
+class _WorkerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Threaded unix socket server for the worker
+    """
+    daemon_threads = True
+
+
+class _WorkerRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a single job submission
+    """
+
+    def handle(self):
+        message = json_socket.receive_message(self.rfile)
+        if message is None:
+            return
+
+        if message.get("op") != "submit":
+            json_socket.send_message(
+                self.wfile,
+                {"event": "result", "status": 1, "results": "",
+                 "message": "Unknown operation " + str(message.get("op"))})
+            return
+
+        connected = [True]
+
+        def send(event):
+            """
+            Send an event to the client. The job keeps running if the client
+            has gone away, so that the device is released properly.
+            """
+            if not connected[0]:
+                return
+            try:
+                json_socket.send_message(self.wfile, event)
+            except socket.error:
+                connected[0] = False
+
+        self.server.worker.run_job(message["job"], send)
+
+
+class Worker(object):
+    """
+    The worker daemon.
+
+    Attributes:
+        _args (argparse namespace argument object):
+            Arguments of the worker; the configuration file locations are
+            taken from these
+        _device_pool (dictionary):
+            Device id -> device object, shared by the jobs
+        _job_counter (integer): Number of jobs received
+        _lock (threading.Lock): Protects _job_counter
+    """
+
+    def __init__(self, args):
+        """
+        Constructor
+
+        Args:
+            args (argparse namespace argument object): Worker arguments
+        """
+        self._args = args
+        self._device_pool = {}
+        self._job_counter = 0
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        """
+        Start serving jobs on config.WORKER_SOCKET
+
+        Returns:
+            None
+        """
+        if json_socket.connect_unix(config.WORKER_SOCKET):
+            raise errors.AFTConfigurationError(
+                "AFT worker is already running at " + config.WORKER_SOCKET)
+
+        if os.path.exists(config.WORKER_SOCKET):
+            os.unlink(config.WORKER_SOCKET)
+
+        # Parse the configurations before the first job arrives
+        DevicesManager(self._args, self._device_pool)
+
+        # Nobody else may connect before the permissions are set below
+        umask = os.umask(0117)
+        try:
+            server = _WorkerServer(config.WORKER_SOCKET, _WorkerRequestHandler)
+        finally:
+            os.umask(umask)
+        server.worker = self
+
+        try:
+            # Jobs run as the worker user, so only trusted users may submit
+            # them
+            if config.WORKER_GROUP:
+                try:
+                    group = grp.getgrnam(config.WORKER_GROUP).gr_gid
+                except KeyError:
+                    raise errors.AFTConfigurationError(
+                        "Unknown worker group " + config.WORKER_GROUP)
+                os.chown(config.WORKER_SOCKET, -1, group)
+            os.chmod(config.WORKER_SOCKET, 0660)
+
+            logger.info("AFT worker listening at " + config.WORKER_SOCKET)
+            print("AFT worker listening at " + config.WORKER_SOCKET)
+
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if os.path.exists(config.WORKER_SOCKET):
+                os.unlink(config.WORKER_SOCKET)
+
+    def run_job(self, job, send):
+        """
+        Run a job in the calling thread
+
+        Args:
+            job (dictionary): Job options, see _JOB_DEFAULTS
+            send (function): Function that sends an event to the client
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._job_counter += 1
+            job_id = "job" + str(self._job_counter)
+
+        logger.init_thread(job_id + "_")
+        args = self._get_job_arguments(job)
+
+        def report(message):
+            logger.info(message)
+            send({"event": "progress", "message": message})
+
+        report("Running " + job_id + " for " + str(args.machine))
+
+        device_manager = None
+        device = None
+        try:
+            device_manager = DevicesManager(args, self._device_pool)
+            results = ""
+            while True:
+                device = self._reserve_and_flash(args, device_manager, report)
+                if args.notest:
+                    break
+
+                preemption_check = None
+                if args.preemptible:
+                    preemption_check = \
+                        lambda: device_manager.is_preempted(device)
+
+                report("Testing " + device.name + ".")
+                tester = Tester(
+                    device,
+                    job_id + "_results.xml",
+                    test_plan_name=args.test_plan)
+                try:
+                    tester.execute(preemption_check)
+                    results = ('<?xml version="1.0" encoding="utf-8"?>\n' +
+                               tester.get_xunit_testsuite())
+                    break
+                except errors.AFTPreemptedError as err:
+                    report(str(err) + ", requeuing the job")
+                    device_manager.release(device)
+                    device = None
+
+            report(job_id + " finished")
+            send({"event": "result", "status": 0, "results": results})
+
+        except Exception:
+            _err = sys.exc_info()
+            _err = str(_err[0]).split("'")[1] + ": " + str(_err[1])
+            logger.error(_err)
+            report(job_id + " failed: " + _err)
+            send({"event": "result", "status": 1, "results": ""})
+
+        finally:
+            if device:
+                if not args.nopoweroff:
+                    device.detach()
+                device_manager.release(device)
+            if device_manager:
+                device_manager.close()
+            logger.close_thread()
+
+    def _get_job_arguments(self, job):
+        """
+        Build the argument object of a job
+
+        Args:
+            job (dictionary): Job options from the client
+
+        Returns:
+            (argparse namespace argument object): The job arguments
+        """
+        options = dict(_JOB_DEFAULTS)
+        options.update(
+            (key, value) for key, value in job.items() if key in options)
+        # The configured defaults are only known once aft.config is parsed
+        options["selection_policy"] = \
+            options["selection_policy"] or config.SELECTION_POLICY
+        options["priority"] = options["priority"] or config.RESERVATION_PRIORITY
+        options["catalog"] = self._args.catalog
+        options["topology"] = self._args.topology
+        return argparse.Namespace(**options)
+
+    @staticmethod
+    def _reserve_and_flash(args, device_manager, report):
+        """
+        Reserve a device and flash it, trying args.machine_retries devices
+        args.flash_retries times each. Devices that cannot be flashed are
+        blacklisted. See main.try_flash_model.
+
+        Args:
+            args (argparse namespace argument object): The job arguments
+            device_manager (aft.DevicesManager): Device manager of the job
+            report (function): Function that reports progress
+
+        Returns:
+            (aft.Device): The reserved and flashed device
+        """
+        machine_attempt = 0
+        image_hash = None
+        if not args.device:
+            image_hash = image_state.get_requested_image_hash(args)
+
+        while True:
+            machine_attempt += 1
+
+            if args.device:
+                device = device_manager.reserve_specific(
+                    args.device,
+                    model=args.machine)
+            else:
+                device = device_manager.reserve(image_hash=image_hash)
+            report("Reserved " + device.name)
+
+            if args.noflash:
+                return device
+
+            for flash_attempt in range(1, args.flash_retries + 1):
+                try:
+                    report("Flashing " + device.name + ", attempt " +
+                           str(flash_attempt) + " of " +
+                           str(args.flash_retries) + ".")
+                    device.write_image(args.file_name, force=args.force_flash)
+                    report("Flashing successful.")
+                    return device
+                except Exception:
+                    _err = sys.exc_info()
+                    report(str(_err[0]).split("'")[1] + ": " + str(_err[1]))
+
+            msg = "Flashing failed " + str(args.flash_retries) + " times"
+            report(msg + ", blacklisting " + device.name)
+            common.blacklist_device(device.dev_id, device.name, msg)
+            device_manager.release(device)
+
+            if args.device or machine_attempt >= args.machine_retries:
+                raise errors.AFTDeviceError(
+                    msg + " on " + str(machine_attempt) + " devices")
+            report("Attempting flashing another machine")